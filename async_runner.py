@@ -0,0 +1,240 @@
+import os
+import time
+import queue
+import signal
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks read from stdout and stderr
+READ_SIZE = 64 * 1024
+
+CommandResult = namedtuple("CommandResult", ["cmd", "returncode", "stdout", "stderr", "start", "seconds", "timed_out"])
+CommandResult.__doc__ = """
+Outcome of a command. stdout and stderr hold the captured output or None, if it was passed to callbacks only. start is
+the wall clock time the command was started at, seconds its duration. A command, which timed out, was killed and has a
+negative returncode.
+"""
+
+
+class CommandRunner:
+    """
+    Runs external commands as asyncio subprocesses. At most max_concurrent commands run at the same time, further ones
+    wait for a slot. Output is read line by line and handed to callbacks as soon as it arrives, so nothing has to be
+    buffered. Commands exceeding their timeout are terminated together with their children and killed, if they do not
+    exit within kill_grace seconds.
+
+    Coroutines are meant to be awaited on an event loop of the caller. Threaded code uses the blocking run_sync and
+    stream, which execute on a private event loop running in a background thread, so the concurrency limit applies to
+    all threads sharing the runner.
+    """
+
+    def __init__(self, max_concurrent=8, default_timeout=None, kill_grace=5):
+        """
+        :param max_concurrent: number of commands running at the same time
+        :param default_timeout: timeout in seconds of commands without an explicit one, None for no timeout
+        :param kill_grace: seconds between SIGTERM and SIGKILL after a timeout
+        """
+        self.max_concurrent = max_concurrent
+        self.default_timeout = default_timeout
+        self.kill_grace = kill_grace
+        self._semaphores = {}
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _semaphore(self):
+        # Semaphores are bound to the loop they are used on
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphores[loop]
+
+    @staticmethod
+    async def _read_lines(stream, callback, captured):
+        # Reading chunks and splitting them is much faster than awaiting every single line
+        rest = b""
+
+        while True:
+            chunk = await stream.read(READ_SIZE)
+            lines = (rest + chunk).split(b"\n")
+            # The last part is an incomplete line or empty, it is completed by the next chunk
+            rest = lines.pop()
+            lines = [line + b"\n" for line in lines]
+            if not chunk and rest:
+                lines.append(rest)
+
+            for line in lines:
+                line = line.decode("utf-8", "surrogateescape")
+                if captured is not None:
+                    captured.append(line)
+                if callback is not None:
+                    result = callback(line)
+                    if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+                        # Asynchronous callbacks apply backpressure
+                        await result
+
+            if not chunk:
+                break
+
+    async def _terminate(self, process):
+        """
+        Terminates the process group of a command, which ran into its timeout.
+        """
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), self.kill_grace)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, cmd, timeout=None, on_stdout=None, on_stderr=None, capture=True):
+        """
+        Runs a command.
+
+        :param cmd: the command to execute in form of a list
+        :param timeout: timeout in seconds, the runner's default timeout if omitted
+        :param on_stdout: optional callable, which is passed every line of stdout including its line ending; if it
+        returns an awaitable, reading continues once it is done
+        :param on_stderr: like on_stdout for stderr
+        :param capture: if set, the output is collected in the result as well
+        :return: CommandResult
+        """
+        timeout = timeout if timeout is not None else self.default_timeout
+        stdout = [] if capture else None
+        stderr = [] if capture else None
+
+        async with self._semaphore():
+            start = time.time()
+            t = time.perf_counter()
+            # A session of its own, so a timeout kills the children of the command as well
+            process = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.PIPE,
+                                                           start_new_session=True)
+            timed_out = False
+
+            try:
+                await asyncio.wait_for(asyncio.gather(self._read_lines(process.stdout, on_stdout, stdout),
+                                                      self._read_lines(process.stderr, on_stderr, stderr),
+                                                      process.wait()), timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                logger.error(f"{cmd[0]} timed out after {timeout}s, killing it")
+                await self._terminate(process)
+            except asyncio.CancelledError:
+                await self._terminate(process)
+                raise
+
+            seconds = time.perf_counter() - t
+
+        return CommandResult(cmd, process.returncode, "".join(stdout) if capture else None,
+                             "".join(stderr) if capture else None, start, seconds, timed_out)
+
+    async def run_many(self, cmds, **kwargs):
+        """
+        Runs several commands concurrently, limited by max_concurrent.
+
+        :param cmds: list of commands
+        :param kwargs: see run
+        :return: list of CommandResult in the order of cmds
+        """
+        return await asyncio.gather(*(self.run(cmd, **kwargs) for cmd in cmds))
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="command-runner", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, cmd, **kwargs):
+        """
+        Starts a command on the background event loop.
+
+        :return: concurrent.futures.Future of the CommandResult
+        """
+        return asyncio.run_coroutine_threadsafe(self.run(cmd, **kwargs), self._get_loop())
+
+    def run_sync(self, cmd, **kwargs):
+        """
+        Runs a command on the background event loop and blocks until it is done, see run. Callbacks are called from
+        the thread of the event loop.
+        """
+        return self.submit(cmd, **kwargs).result()
+
+    def stream(self, cmd, timeout=None, on_stderr=None, queue_size=1024):
+        """
+        Runs a command on the background event loop and yields its stdout line by line in the calling thread. At most
+        queue_size lines are buffered, a slow consumer slows down reading. Closing the generator early kills the
+        command.
+
+        :param cmd: the command to execute in form of a list
+        :param timeout: see run
+        :param on_stderr: see run
+        :param queue_size: number of lines buffered between the command and the consumer
+        :return: generator of lines of stdout, its return value is the CommandResult
+        """
+        lines = queue.Queue(queue_size)
+        closed = threading.Event()
+        done = object()
+        loop = self._get_loop()
+
+        def put(item):
+            # Gives up, once the consumer is gone, so no executor thread is blocked forever
+            while not closed.is_set():
+                try:
+                    lines.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def on_stdout(line):
+            try:
+                lines.put_nowait(line)
+            except queue.Full:
+                # Waiting for the consumer happens in an executor thread rather than on the event loop
+                return loop.run_in_executor(None, put, line)
+
+        async def produce():
+            try:
+                return await self.run(cmd, timeout=timeout, on_stdout=on_stdout, on_stderr=on_stderr, capture=False)
+            finally:
+                await loop.run_in_executor(None, put, done)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), loop)
+        finished = False
+
+        try:
+            while True:
+                line = lines.get()
+                if line is done:
+                    finished = True
+                    break
+                yield line
+        finally:
+            closed.set()
+            if not finished:
+                # Kills the command, as the consumer stopped early
+                future.cancel()
+
+        return future.result()
+
+    def close(self):
+        """
+        Stops the background event loop, if it was started.
+        """
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = None
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import logging
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+from disk_processor import DiskProcessor
+from file_hasher import FileHasher
+from raw_image_processor import RawImageProcessor, READ_SIZE, pytsk3
+
+logger = logging.getLogger()
+
+# File sizes on a Windows system volume roughly follow a log-normal distribution with a median of a few KiB and a long
+# tail of large libraries, archives and databases
+SIZE_MEDIAN = 12 * 1024
+SIZE_SIGMA = 2.3
+MAX_FILE_SIZE = 256 * 1024 * 1024
+
+DIR_NAMES = ["Windows", "System32", "SysWOW64", "WinSxS", "Program Files", "ProgramData", "Users", "AppData", "Local",
+             "Temp", "Microsoft", "Common Files", "drivers", "en-US", "Fonts", "assembly", "INF", "Logs"]
+EXTENSIONS = [".dll", ".exe", ".sys", ".mui", ".dat", ".log", ".xml", ".manifest", ".cat", ".ttf", ".ini", ".txt"]
+
+
+def build_tree(root, total_bytes, seed=0, max_depth=5):
+    """
+    Builds a synthetic directory tree, whose file sizes follow a realistic Windows distribution. Creating the same tree
+    again with the same seed yields identical files.
+
+    :param root: directory to create the tree in
+    :param total_bytes: approximate size of all files
+    :param seed: seed of the random generator
+    :param max_depth: maximum nesting of directories
+    :return: dict with the number of files and bytes
+    """
+    rnd = random.Random(seed)
+    files = 0
+    written = 0
+    dirs = [root]
+    os.makedirs(root, exist_ok=True)
+
+    while written < total_bytes:
+        # Occasionally descend into a new subdirectory
+        parent = rnd.choice(dirs)
+        if rnd.random() < 0.05 and parent.count(os.sep) - root.count(os.sep) < max_depth:
+            parent = os.path.join(parent, f"{rnd.choice(DIR_NAMES)}{rnd.randrange(100)}")
+            os.makedirs(parent, exist_ok=True)
+            dirs.append(parent)
+
+        size = min(int(rnd.lognormvariate(0, SIZE_SIGMA) * SIZE_MEDIAN), MAX_FILE_SIZE, total_bytes - written)
+        path = os.path.join(parent, f"file{files}{rnd.choice(EXTENSIONS)}")
+
+        with open(path, "wb") as f:
+            remaining = size
+            while remaining:
+                chunk = min(remaining, 4 * 1024 * 1024)
+                f.write(rnd.getrandbits(8 * chunk).to_bytes(chunk, "little"))
+                remaining -= chunk
+
+        files += 1
+        written += size
+
+    return {"files": files, "bytes": written, "dirs": len(dirs)}
+
+
+def build_image(tree_dir, img_path):
+    """
+    Builds an ext4 image containing the given tree. mke2fs populates the file system itself, so no root privileges
+    are needed.
+
+    :return: path to the image or None, if mke2fs is not available
+    """
+    if not shutil.which("mke2fs"):
+        logger.info("mke2fs not found, skipping image based backends")
+        return None
+
+    size_mb = int(build_tree_stats(tree_dir)["bytes"] * 1.3 / 1024 ** 2) + 64
+    subprocess.run(["mke2fs", "-q", "-F", "-t", "ext4", "-d", tree_dir, img_path, f"{size_mb}M"], check=True)
+
+    return img_path
+
+
+def evict_from_cache(path):
+    """
+    Drops the pages of all files below path from the page cache, so the next run reads from disk. Works without root
+    privileges, as long as the pages are clean.
+    """
+    paths = [path] if os.path.isfile(path) else (os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs)
+
+    for p in paths:
+        fd = os.open(p, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _peak_rss_kb():
+    # Includes subprocesses like hashrat
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_case(case, queue):
+    """
+    Runs a single benchmark case. This is executed in a fresh process, so the peak RSS belongs to this case only.
+    """
+    result_dir = tempfile.mkdtemp(prefix="hashlab-bench-")
+    stages = {}
+
+    try:
+        t = time.perf_counter()
+        if case["backend"] == "raw":
+            dp = RawImageProcessor(case["image"])
+            hasher = FileHasher(case["workers"], buffer_size=READ_SIZE, physical_order=case["physical_order"])
+        else:
+            dp = DiskProcessor.from_volume_paths("bench", case["volumes"], os.path.dirname(case["tree"]),
+                                                 os.path.basename(case["tree"]))
+            hasher = FileHasher(case["workers"], physical_order=case["physical_order"])
+        stages["setup"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if case["backend"] == "hashrat":
+            dp.hash_with_hashrat(result_dir, case["volume_workers"])
+        else:
+            dp.hash_files(result_dir, hasher, volume_workers=case["volume_workers"])
+        stages["hash"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        del dp
+        stages["cleanup"] = time.perf_counter() - t
+
+        queue.put({"stages": stages, "peak_rss_kb": _peak_rss_kb()})
+    finally:
+        shutil.rmtree(result_dir)
+
+
+def benchmark(case, dataset, cold=True):
+    """
+    Runs a case in a child process and computes the throughput.
+    """
+    if cold:
+        evict_from_cache(case.get("image") or case["tree"])
+
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_case, args=(case, queue))
+
+    start = time.perf_counter()
+    process.start()
+    result = queue.get()
+    process.join()
+    seconds = time.perf_counter() - start
+
+    result.update({k: v for k, v in case.items() if k in ("backend", "workers", "volume_workers", "physical_order")})
+    result.update({
+        "seconds": seconds,
+        "mb_per_s": dataset["bytes"] / 1024 ** 2 / result["stages"]["hash"],
+        "files_per_s": dataset["files"] / result["stages"]["hash"],
+    })
+    logger.info(f"{case['backend']} ({case['workers']} workers, {case['volume_workers']} volume workers"
+                f"{', physical order' if case['physical_order'] else ''}): "
+                f"{result['mb_per_s']:.1f} MB/s, {result['files_per_s']:.0f} files/s, "
+                f"peak RSS {result['peak_rss_kb']} KiB")
+
+    return result
+
+
+def build_tree_stats(root):
+    """
+    Counts the files and bytes below root.
+    """
+    stats = {"files": 0, "bytes": 0, "dirs": 0}
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        stats["dirs"] += len(dirnames)
+        stats["files"] += len(filenames)
+        stats["bytes"] += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+
+    return stats
+
+
+def main(work_dir=None, size_mb=256, volumes=2, workers=None, seed=0, warm=False, output="-", keep=False):
+    work_dir = work_dir or tempfile.mkdtemp(prefix="hashlab-bench-data-")
+    tree = os.path.join(work_dir, "tree")
+    volume_paths = [os.path.join(tree, f"{i}-volume") for i in range(1, volumes + 1)]
+
+    logger.info(f"Building {volumes} synthetic volumes with {size_mb} MB in {tree}")
+    dataset = {"files": 0, "bytes": 0, "dirs": 0}
+    for i, path in enumerate(volume_paths):
+        stats = build_tree(path, size_mb * 1024 ** 2 // volumes, seed + i)
+        dataset = {k: dataset[k] + stats[k] for k in dataset}
+
+    cases = []
+    for w in workers or [1, os.cpu_count() or 1]:
+        cases.append({"backend": "builtin", "workers": w, "volume_workers": 1})
+    cases.append({"backend": "builtin", "workers": (workers or [os.cpu_count() or 1])[-1], "volume_workers": volumes})
+    # Same as the first case, but the files are read in the order of their data on disk
+    cases.append(dict(cases[0], physical_order=True))
+
+    if shutil.which("hashrat"):
+        cases.append({"backend": "hashrat", "workers": 1, "volume_workers": 1})
+
+    if pytsk3 is not None:
+        # The image only contains the first volume
+        image = build_image(volume_paths[0], os.path.join(work_dir, "volume.img"))
+        image_dataset = build_tree_stats(volume_paths[0])
+        if image:
+            for w in workers or [1, os.cpu_count() or 1]:
+                cases.append({"backend": "raw", "workers": w, "volume_workers": 1, "image": image})
+            cases.append({"backend": "raw", "workers": (workers or [1])[0], "volume_workers": 1, "image": image,
+                          "physical_order": True})
+    else:
+        logger.info("pytsk3 not installed, skipping raw image backend")
+
+    results = []
+    for case in cases:
+        case.setdefault("physical_order", False)
+        case.update(tree=tree, volumes=volume_paths)
+        results.append(benchmark(case, image_dataset if case["backend"] == "raw" else dataset, cold=not warm))
+
+    report = {
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "cold_cache": not warm,
+        "dataset": dataset,
+        "results": results,
+    }
+
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if not keep:
+        shutil.rmtree(work_dir)
+
+    return report
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the hashing stage of hashlab on synthetic data, no VirtualBox or vagrant needed. The results are written as JSON.")
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help="Directory for the synthetic data (default: a new temporary directory).")
+    parser.add_argument('--size-mb', type=int, default=256, help="Total size of the synthetic volumes in MB.")
+    parser.add_argument('--volumes', type=int, default=2, help="Number of synthetic volumes.")
+    parser.add_argument('--workers', type=int, nargs="+", default=None,
+                        help="Worker counts to benchmark (default: 1 and the number of CPUs).")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for generating the synthetic data.")
+    parser.add_argument('--warm', action='store_true', help="Do not evict the data from the page cache before each run.")
+    parser.add_argument('--output', type=str, default="-", help="File to write the JSON report to, '-' for stdout.")
+    parser.add_argument('--keep', action='store_true', help="Keep the synthetic data afterwards.")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stderr)
+    main(**vars(parse_args()))
@@ -0,0 +1,321 @@
+import os
+import mmap
+import time
+import heapq
+import struct
+import hashlib
+import logging
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import sparse
+
+try:
+    import numpy as np
+except ImportError:
+    # Constant blocks are detected by comparing every block against a constant one
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Size of the hashed blocks, the cluster size of NTFS and ext4
+BLOCK_SIZE = 4096
+
+# Number of blocks, which a worker processes at once
+BATCH_BLOCKS = 4096
+
+# Number of digests sorted in memory, before they are spilled to a run
+RUN_DIGESTS = 4 * 1024 * 1024
+
+STORE_MAGIC = b"HLBLKDB1"
+# Magic, block size, digest size, number of digests
+STORE_HEADER = struct.Struct("<8sIIQ")
+
+# Size of the chunks read from runs and stores while merging
+READ_SIZE = 1024 * 1024
+
+# Every 8-byte word of a constant block equals its first byte repeated
+BYTE_REPEAT = 0x0101010101010101
+
+
+def constant_mask(view, count, block_size=BLOCK_SIZE):
+    """
+    Determines, which of the blocks in view consist of a single repeated byte value, e.g. zeros or 0xff fill. With numpy
+    all blocks are checked at once as 64 bit words, otherwise every block is compared against a constant one.
+
+    :param view: buffer holding count consecutive blocks
+    :param count: number of blocks
+    :param block_size: size of the blocks, a multiple of 8
+    :return: list of booleans, True for constant blocks
+    """
+    if np is not None:
+        words = np.frombuffer(view, dtype="<u8", count=count * block_size // 8).reshape(count, block_size // 8)
+        first = words[:, 0]
+        return ((words == first[:, None]).all(axis=1) & (first == (first & 0xff) * np.uint64(BYTE_REPEAT))).tolist()
+
+    mask = []
+    for i in range(count):
+        block = view[i * block_size:(i + 1) * block_size]
+        mask.append(block == bytes(block[:1]) * block_size)
+    return mask
+
+
+def _read_digests(path, digest_size, offset=0):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            chunk = f.read(READ_SIZE - READ_SIZE % digest_size)
+            if not chunk:
+                break
+            for i in range(0, len(chunk), digest_size):
+                yield chunk[i:i + digest_size]
+
+
+def _unique(digests):
+    previous = None
+    for d in digests:
+        if d != previous:
+            yield d
+            previous = d
+
+
+class BlockStore:
+    """
+    Memory-mapped, immutable file of distinct block digests sorted ascending. Like the segments of the whitelist store,
+    lookups are binary searches on the mapping.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.block_size, self.digest_size, self.count = STORE_HEADER.unpack_from(self._mm, 0)
+
+        if magic != STORE_MAGIC:
+            raise ValueError(f"{path} is no block hash store")
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+    def __len__(self):
+        return self.count
+
+    def digest_at(self, i):
+        offset = STORE_HEADER.size + i * self.digest_size
+        return self._mm[offset:offset + self.digest_size]
+
+    def __contains__(self, digest):
+        lo, hi = 0, self.count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest_at(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo < self.count and self.digest_at(lo) == digest
+
+    def __iter__(self):
+        return _read_digests(self.path, self.digest_size, STORE_HEADER.size)
+
+    @staticmethod
+    def write(path, digests, block_size, digest_size):
+        """
+        Writes sorted digests to a new store, duplicates are dropped. The file appears atomically under its final name.
+
+        :param path: path of the store
+        :param digests: iterable of raw digests, sorted ascending
+        :param block_size: size of the hashed blocks
+        :param digest_size: size of the digests in bytes
+        :return: number of digests written
+        """
+        tmp_path = f"{path}.tmp"
+        count = 0
+
+        with open(tmp_path, "wb") as f:
+            # The count is not known in advance and patched in at the end
+            f.write(STORE_HEADER.pack(STORE_MAGIC, block_size, digest_size, 0))
+            for d in _unique(digests):
+                f.write(d)
+                count += 1
+            f.seek(0)
+            f.write(STORE_HEADER.pack(STORE_MAGIC, block_size, digest_size, count))
+
+        os.replace(tmp_path, path)
+        return count
+
+
+def merge_stores(paths, output_path):
+    """
+    Merges several block hash stores, e.g. of different boxes, into one with a k-way merge.
+
+    :param paths: paths of the stores, which must share block and digest size
+    :param output_path: path of the merged store
+    :return: number of distinct digests
+    """
+    stores = [BlockStore(p) for p in paths]
+
+    try:
+        if len({(s.block_size, s.digest_size) for s in stores}) > 1:
+            raise ValueError("Block hash stores with different block or digest sizes cannot be merged")
+
+        count = BlockStore.write(output_path, heapq.merge(*stores), stores[0].block_size, stores[0].digest_size)
+    finally:
+        for s in stores:
+            s.close()
+
+    logger.info(f"Merged {len(paths)} block hash stores into {output_path}: {count} distinct digests")
+    return count
+
+
+class BlockHasher:
+    """
+    Hashes every block of a raw image. The image is memory-mapped and split into batches of blocks, which a pool of
+    worker threads processes: constant blocks are sorted out with a single vectorized check per batch, all others are
+    hashed. Holes of sparse images are skipped without reading them. The digests are deduplicated, sorted in runs of
+    bounded size and merged into a BlockStore.
+    """
+
+    def __init__(self, workers=None, block_size=BLOCK_SIZE, algorithm="md5", batch_blocks=BATCH_BLOCKS,
+                 run_digests=RUN_DIGESTS):
+        """
+        Creates a BlockHasher
+
+        :param workers: number of worker threads, defaults to the number of CPUs
+        :param block_size: size of the hashed blocks, a multiple of 8
+        :param algorithm: name of the hashlib algorithm
+        :param batch_blocks: number of blocks per batch of a worker
+        :param run_digests: number of digests held in memory, before they are spilled to disk
+        """
+        if block_size % 8:
+            raise ValueError("The block size has to be a multiple of 8")
+
+        self.workers = workers or os.cpu_count() or 1
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.digest_size = hashlib.new(algorithm).digest_size
+        self.batch_blocks = batch_blocks
+        self.run_digests = run_digests
+
+    def _batches(self, f, size):
+        """
+        Splits the data extents of the image into batches of whole blocks. Extents are widened to block boundaries, a
+        trailing partial block is ignored.
+
+        :return: generator of (offset, number of blocks)
+        """
+        batch_size = self.batch_blocks * self.block_size
+        end_of_blocks = size - size % self.block_size
+        pos = 0
+
+        for start, end in sparse.data_extents(f, size):
+            start = max(start - start % self.block_size, pos)
+            end = min(end + -end % self.block_size, end_of_blocks)
+
+            for offset in range(start, end, batch_size):
+                yield offset, min(batch_size, end - offset) // self.block_size
+
+            pos = max(pos, end)
+
+    def _hash_batch(self, mm, offset, count):
+        """
+        Hashes the non-constant blocks of a batch.
+
+        :return: digests, constant - list of raw digests and the number of constant blocks
+        """
+        if hasattr(mm, "madvise"):
+            # madvise requires a page aligned start, which batches of other block sizes than 4096 do not have
+            aligned = offset - offset % mmap.PAGESIZE
+            mm.madvise(mmap.MADV_WILLNEED, aligned, offset - aligned + count * self.block_size)
+
+        view = memoryview(mm)[offset:offset + count * self.block_size]
+        try:
+            mask = constant_mask(view, count, self.block_size)
+            new = hashlib.new
+            algorithm = self.algorithm
+            bs = self.block_size
+            digests = [new(algorithm, view[i * bs:(i + 1) * bs]).digest() for i in range(count) if not mask[i]]
+        finally:
+            view.release()
+
+        return digests, count - len(digests)
+
+    def _spill(self, digests, tmp_dir):
+        digests = sorted(set(digests))
+
+        fd, path = tempfile.mkstemp(prefix="blocks-", dir=tmp_dir)
+        with open(fd, "wb") as f:
+            f.write(b"".join(digests))
+
+        return path
+
+    def hash_image(self, image_path, store_path, tmp_dir=None):
+        """
+        Hashes all blocks of a raw image and writes the distinct digests to a BlockStore.
+
+        :param image_path: path to the raw image
+        :param store_path: path of the resulting store
+        :param tmp_dir: directory for the sorted runs, defaults to the directory of the store
+        :return: dict of counts: blocks, hashed, constant and sparse blocks, distinct digests, bytes read, seconds
+        """
+        tmp_dir = tmp_dir or os.path.dirname(os.path.abspath(store_path))
+        stats = {"blocks": 0, "hashed": 0, "constant": 0, "sparse": 0, "distinct": 0, "bytes": 0}
+        start = time.perf_counter()
+        runs = []
+        pending_digests = []
+
+        with open(image_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            stats["blocks"] = size // self.block_size
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    window = deque()
+
+                    def collect(future):
+                        digests, constant = future.result()
+                        stats["hashed"] += len(digests)
+                        stats["constant"] += constant
+                        pending_digests.extend(digests)
+
+                        if len(pending_digests) >= self.run_digests:
+                            runs.append(self._spill(pending_digests, tmp_dir))
+                            pending_digests.clear()
+
+                    # At most a few batches per worker are in flight, so memory use does not depend on the image size
+                    for offset, count in (self._batches(f, size) if mm else ()):
+                        stats["bytes"] += count * self.block_size
+                        window.append(executor.submit(self._hash_batch, mm, offset, count))
+
+                        if len(window) >= 2 * self.workers:
+                            collect(window.popleft())
+
+                    while window:
+                        collect(window.popleft())
+            finally:
+                if mm is not None:
+                    mm.close()
+
+        if pending_digests:
+            runs.append(self._spill(pending_digests, tmp_dir))
+            pending_digests.clear()
+
+        try:
+            stats["distinct"] = BlockStore.write(store_path, heapq.merge(*(_read_digests(p, self.digest_size)
+                                                                          for p in runs)),
+                                                 self.block_size, self.digest_size)
+        finally:
+            for path in runs:
+                os.remove(path)
+
+        stats["sparse"] = stats["blocks"] - stats["bytes"] // self.block_size
+        stats["seconds"] = time.perf_counter() - start
+        logger.info(f"Hashed {stats['hashed']} of {stats['blocks']} blocks of {image_path} in {stats['seconds']:.2f}s "
+                    f"({stats['constant']} constant, {stats['sparse']} in holes): {stats['distinct']} distinct digests "
+                    f"in {store_path}")
+
+        return stats
@@ -1,11 +1,21 @@
 
 # Make sure to install: sudo apt-get install xmount ewf-tools afflib-tools sleuthkit disktype python-magic
-from imagemounter import ImageParser
+try:
+    from imagemounter import ImageParser
+except ImportError:
+    # Only needed for the mount backend, see RawImageProcessor for the mount-free alternative
+    ImageParser = None
 
 import os
 import utils
+import metrics
 import logging
 import datetime
+from concurrent.futures import ThreadPoolExecutor
+from file_hasher import FileHasher, HardLinks
+from file_policy import SkipStats
+from hashlist import HashlistWriter, hashlist_file_name
+from scheduler import box_context, current_box
 
 logger = logging.getLogger()
 
@@ -15,19 +25,55 @@ class DiskProcessor:
     Bundles functionality, needed for mounting and hashing disk images.
     """
 
-    def __init__(self, img_path):
+    def __init__(self, img_path, mount_parent="/tmp", output_format="md5sum", compression=None):
         """
         Creates a DiskProcessor corresponding to the given image
 
         :param img_path, absolute path to dd image
+        :param mount_parent, directory below which the image and its volumes are mounted
+        :param output_format: format of the hash lists, see HashlistWriter
+        :param compression: compression of the hash lists, None, "gzip" or "zstd"
         """
 
         self.img_path = img_path
         self.img_label = os.path.basename(img_path).split(".")[0]
-        self.mount_parent = "/tmp"
+        self.mount_parent = mount_parent
         self.mount_stub = "img_mnt"
-        self.mount_path, self.volume_mount_paths = self._mount_dd_img()
+        self.output_format = output_format
+        self.compression = compression
+        with metrics.stage("mount", image=self.img_label) as s:
+            self.mount_path, self.volume_mount_paths = self._mount_dd_img()
+            s.add(files=len(self.volume_mount_paths))
         self.is_mounted = True
+        self.owns_mounts = True
+
+    @classmethod
+    def from_volume_paths(cls, img_label, volume_paths, mount_parent="/tmp", mount_stub="img_mnt",
+                          output_format="md5sum", compression=None):
+        """
+        Creates a DiskProcessor for volumes, which are mounted already or are plain directories, e.g. for benchmarks.
+        Nothing is mounted and the destructor leaves the volumes untouched.
+
+        :param img_label: label of the image used for naming the hash lists
+        :param volume_paths: list of directories to treat as volumes
+        :param mount_parent: together with mount_stub the prefix, which is erased from the paths in the hash lists
+        :param mount_stub: see mount_parent
+        :param output_format: format of the hash lists, see HashlistWriter
+        :param compression: compression of the hash lists, None, "gzip" or "zstd"
+        """
+        dp = cls.__new__(cls)
+        dp.img_path = None
+        dp.img_label = img_label
+        dp.mount_parent = mount_parent
+        dp.mount_stub = mount_stub
+        dp.output_format = output_format
+        dp.compression = compression
+        dp.mount_path = os.path.join(mount_parent, mount_stub)
+        dp.volume_mount_paths = list(volume_paths)
+        dp.is_mounted = True
+        dp.owns_mounts = False
+
+        return dp
 
     # See https://github.com/ralphje/imagemounter/blob/master/examples/simple_cli.py#L64
     def _mount_dd_img(self):
@@ -58,26 +104,181 @@ class DiskProcessor:
 
         return parser.disks[0].mountpoint, volume_mount_paths
 
-    def hash_with_hashrat(self, result_dir):
+    def _result_path(self, result_dir, volume_path):
+        """
+        Builds the path of the hash list of a volume, which is named after the current datetime, the image and volume.
+
+        :param result_dir: path to directory, where the resulting hash lists will be stored.
+        :param volume_path: mount path of the volume
+        :return: path to the hash list
+        """
+        dt_label = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H%M")
+        vol_label = os.path.basename(volume_path)
+        return os.path.join(result_dir, f"{dt_label}_{self.img_label}_{vol_label}")
+
+    def _writer(self, result_path):
+        """
+        Creates the writer of a hash list in the output format of this processor.
+
+        :param result_path: path of the hash list without extensions
+        """
+        return HashlistWriter(result_path, self.output_format, self.compression)
+
+    def _strip_mount_prefix(self, path):
+        """
+        Erases the information stemming of the mount point from a path.
+        """
+        return path.replace(os.path.join(self.mount_parent, self.mount_stub), "")
+
+    def _for_each_volume(self, func, result_dir, volume_workers=1, journal=None, delta=False):
+        """
+        Calls func for every mounted volume. Volumes are independent of each other, so up to volume_workers of them
+        are processed at the same time. Exceptions of func are re-raised once all volumes are done. The workers are
+        attributed to the box of the calling thread.
+
+        With a journal, every volume is recorded as a step of its own. Volumes, which are done already, are skipped and
+        the partial hash lists of unfinished ones are removed, before they are hashed again.
+
+        :param func: callable, which is passed the mount path of a volume and the path of its hash list without the
+        extensions of the output format
+        :param result_dir: path to directory, where the resulting hash lists will be stored.
+        :param volume_workers: number of volumes processed concurrently
+        :param journal: optional BoxJournal of the box
+        :param delta: whether func writes a delta hash list besides the full one, see hash_files
+        """
+        box = current_box()
+
+        def run(d):
+            label = os.path.basename(d)
+            result_path = self._result_path(result_dir, d)
+
+            with box_context(box):
+                if journal is None:
+                    return func(d, result_path)
+
+                if journal.is_done("volume", label):
+                    logger.info(f"Volume {label} was hashed by a previous run, skipping it")
+                    return
+
+                paths = (result_path, f"{result_path}_delta") if delta else (result_path,)
+                files = [hashlist_file_name(p, self.output_format, self.compression) for p in paths]
+                with journal.step("volume", label, files=files):
+                    func(d, result_path)
+
+        with ThreadPoolExecutor(max_workers=max(1, volume_workers)) as executor:
+            futures = [executor.submit(run, d) for d in self.volume_mount_paths]
+
+        for f in futures:
+            f.result()
+
+    def hash_with_hashrat(self, result_dir, volume_workers=1, journal=None):
         """
-        Hashes all files in the directories, where the volumes are mounted on.
+        Hashes all files in the directories, where the volumes are mounted on. A volume, whose hashrat process exits
+        with a nonzero status, fails with subprocess.CalledProcessError.
 
         :param result_dir: path to directory, where the resulting hash lists will be stored.
+        :param volume_workers: number of volumes hashed concurrently, each by its own hashrat process
+        :param journal: optional BoxJournal to skip the volumes hashed by a previous run
         """
+        def hash_volume(d, result_path):
+            logger.info(f"Hashing {d}")
+
+            # Streams hashrat's output record by record into the hashlist, erasing the information stemming of
+            # the mount point on the fly
+            with metrics.stage("hash_volume", image=self.img_label, volume=os.path.basename(d), hasher="hashrat") \
+                    as s, self._writer(result_path) as w:
+                for line in utils.stream_cmd_output(["hashrat", "-trad", "-md5", "-r", d]):
+                    w.write_line(self._strip_mount_prefix(line))
+                # hashrat does not report sizes, so only the files are counted
+                s.add(files=w.count)
+
         if self.is_mounted:
             # Hash all volumes, requires hashrat
-            for d in self.volume_mount_paths:
-                logger.info(f"Hashing {d}")
-                hashresults = utils.run_cmd_with_output(["hashrat", "-trad", "-md5", "-r", d])
+            self._for_each_volume(hash_volume, result_dir, volume_workers, journal)
+
+    def _hash_volume_files(self, d, result_path, hasher, cache=None):
+        """
+        Hashes all files of a single mounted volume, see hash_files.
+        """
+        logger.info(f"Hashing {d} with {hasher.workers} workers")
+        skipped = SkipStats()
+        # Every file is read once, no matter how many hard links point to it
+        links = HardLinks()
+
+        with metrics.stage("hash_volume", image=self.img_label, volume=os.path.basename(d), hasher="builtin",
+                           workers=hasher.workers, incremental=cache is not None,
+                           physical_order=hasher.physical_order) as s:
+            if cache is None:
+                with self._writer(result_path) as w:
+                    for r in hasher.hash_tree(d, skipped, links):
+                        w.write_digest(r, self._strip_mount_prefix(r.path))
+                        s.add(r.size, 1)
+            else:
+                with self._writer(result_path) as w, self._writer(f"{result_path}_delta") as w_delta:
+                    for r, is_new in cache.hash_tree(hasher, d, self.img_label, os.path.basename(d), skipped, links):
+                        path = self._strip_mount_prefix(r.path)
+                        w.write_digest(r, path)
+                        if is_new:
+                            # Only files, which were actually read, count as processed
+                            w_delta.write_digest(r, path)
+                            s.add(r.size, 1)
+
+            self._report_skipped(d, skipped, s)
+            self._report_links(d, links, s)
+            self._report_throughput(d, s, links)
+
+    @staticmethod
+    def _report_skipped(d, skipped, stage):
+        """
+        Logs the files skipped by the hash policy and adds them to the metrics of the stage.
+        """
+        if skipped.total_files:
+            logger.info(f"Hash policy of {d}: {skipped.summary()}")
+        stage.labels["skipped_files"] = skipped.total_files
+        stage.labels["skipped_bytes"] = skipped.total_bytes
 
-                # Erases the information stemming of the mount point from hashlist
-                hashresults_clean = hashresults.replace(os.path.join(self.mount_parent, self.mount_stub), "")
+    @staticmethod
+    def _report_links(d, links, stage):
+        """
+        Logs the files, whose digest was taken over from another hard link, and adds them to the metrics of the stage.
+        """
+        if links.stats.files:
+            logger.info(f"Took over the digests of {links.stats.files} hard links of {d}, "
+                        f"{links.stats.bytes} bytes were not read again")
+        stage.labels["linked_files"] = links.stats.files
+        stage.labels["linked_bytes"] = links.stats.bytes
+
+    @staticmethod
+    def _report_throughput(d, stage, links=None):
+        """
+        Logs the read throughput of a volume and adds it to the metrics of the stage, so the effect of the hashing
+        order can be compared between runs. Files taken over from other hard links were not read and do not count.
+        """
+        nbytes = stage.bytes - (links.stats.bytes if links is not None else 0)
+        mib_per_s = stage.throughput(nbytes) / (1024 * 1024)
+        logger.info(f"Read {nbytes} bytes of {stage.files} files of {d} at {mib_per_s:.1f} MiB/s")
+        stage.labels["read_mib_per_s"] = round(mib_per_s, 1)
+
+    def hash_files(self, result_dir, hasher=None, cache=None, volume_workers=1, journal=None, changed_blocks=None):
+        """
+        Hashes all files in the directories, where the volumes are mounted on, with the built-in FileHasher. The hash
+        lists are formatted exactly like the ones of hash_with_hashrat, so hashrat is not required.
 
-                # Writes hashlist to disk
-                dt_label = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H%M")
-                vol_label = os.path.basename(d)
-                with open(os.path.join(result_dir, f"{dt_label}_{self.img_label}_{vol_label}"), "w") as f:
-                    f.write(hashresults_clean)
+        If a HashCache is given, only new or modified files are read and the digests of all other files are taken from
+        the cache. Besides the full hash list, a delta hash list (suffix "_delta") containing only the records of the
+        files, which were read, is written in that case.
+
+        :param result_dir: path to directory, where the resulting hash lists will be stored.
+        :param hasher: FileHasher to use, a default one with one worker per CPU is created if omitted
+        :param cache: optional HashCache for incremental hashing
+        :param volume_workers: number of volumes hashed concurrently, each one writes its own hash list
+        :param journal: optional BoxJournal to skip the volumes hashed by a previous run
+        :param changed_blocks: not supported by this backend, ignored
+        """
+        if self.is_mounted:
+            hasher = hasher or FileHasher()
+            self._for_each_volume(lambda d, result_path: self._hash_volume_files(d, result_path, hasher, cache),
+                                  result_dir, volume_workers, journal, delta=cache is not None)
 
     def __del__(self):
         """
@@ -85,16 +286,17 @@ class DiskProcessor:
         The mount_stub remains unchanged.
         """
 
-        if self.is_mounted:
-            for d in self.volume_mount_paths:
-                logger.info(f"Cleaning up {d}")
-                # Unmount and clean up
-                utils.run_shell_cmd(["sudo", "umount", d])
-                utils.run_shell_cmd(["sudo", "rm", "-r", d])
-
-            logger.info(f"Cleaning up {self.mount_path}")
-            utils.run_shell_cmd(["sudo", "umount", self.mount_path])
-            utils.run_shell_cmd(["sudo", "rm", "-r", self.mount_path])
+        if self.is_mounted and self.owns_mounts:
+            with metrics.stage("unmount", image=self.img_label):
+                for d in self.volume_mount_paths:
+                    logger.info(f"Cleaning up {d}")
+                    # Unmount and clean up
+                    utils.run_shell_cmd(["sudo", "umount", d], utils.control_timeout())
+                    utils.run_shell_cmd(["sudo", "rm", "-r", d], utils.control_timeout())
+
+                logger.info(f"Cleaning up {self.mount_path}")
+                utils.run_shell_cmd(["sudo", "umount", self.mount_path], utils.control_timeout())
+                utils.run_shell_cmd(["sudo", "rm", "-r", self.mount_path], utils.control_timeout())
 
 
 if __name__ == "__main__":
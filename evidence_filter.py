@@ -0,0 +1,87 @@
+import re
+import sys
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100000
+
+# Evidence hash lists in the format of md5sum or bare hashes, other tools put the hash first as well
+HASH_PATTERN = re.compile(r"^([0-9a-fA-F]{32})(?:\s|$)")
+
+
+@contextmanager
+def _open_text(path, mode):
+    """
+    Opens a text file or stdin/stdout, if path is "-".
+    """
+    if path == "-":
+        yield sys.stdin if "r" in mode else sys.stdout
+    else:
+        with open(path, mode, encoding="utf-8", errors="surrogateescape") as f:
+            yield f
+
+
+def _batches(lines, batch_size):
+    batch = []
+
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def filter_hashlist(store, evidence_path, output_path="-", known_path=None, batch_size=BATCH_SIZE):
+    """
+    Removes all records with a hash known to the whitelist store from an evidence hash list. The input is streamed in
+    batches, every batch is checked against the store with a single batch lookup. Lines without a leading MD5 hash are
+    passed through unchanged, so nothing is lost silently.
+
+    :param store: WhitelistStore
+    :param evidence_path: path to the evidence hash list, "-" reads stdin
+    :param output_path: path to write the unknown records to, "-" writes to stdout
+    :param known_path: optional path to write the known records to
+    :param batch_size: number of lines looked up at once
+    :return: dict with the number of lines, known, unknown and unparsable records, the runtime and the throughput
+    """
+    stats = {"lines": 0, "known": 0, "unknown": 0, "unparsable": 0}
+    start = time.perf_counter()
+
+    with _open_text(evidence_path, "r") as evidence, _open_text(output_path, "w") as out:
+        known_out = open(known_path, "w", encoding="utf-8", errors="surrogateescape") if known_path else None
+
+        try:
+            for batch in _batches(evidence, batch_size):
+                matches = [HASH_PATTERN.match(line) for line in batch]
+                found = iter(store.contains_batch([m.group(1).lower() for m in matches if m]))
+
+                for line, match in zip(batch, matches):
+                    if not match:
+                        stats["unparsable"] += 1
+                        out.write(line)
+                    elif next(found):
+                        stats["known"] += 1
+                        if known_out:
+                            known_out.write(line)
+                    else:
+                        stats["unknown"] += 1
+                        out.write(line)
+
+                stats["lines"] += len(batch)
+        finally:
+            if known_out:
+                known_out.close()
+
+    stats["seconds"] = time.perf_counter() - start
+    stats["lines_per_second"] = stats["lines"] / stats["seconds"] if stats["seconds"] else 0.0
+
+    logger.info(f"Filtered {stats['lines']} lines in {stats['seconds']:.2f}s ({stats['lines_per_second']:.0f} lines/s): "
+                f"{stats['known']} known, {stats['unknown']} unknown, {stats['unparsable']} unparsable")
+
+    return stats
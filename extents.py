@@ -0,0 +1,112 @@
+import os
+import fcntl
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ioctls of linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIBMAP = 1
+FIGETBSZ = 2
+
+# Start, length, flags, mapped extents, extent count, reserved
+FIEMAP_HEADER = struct.Struct("=QQIIII")
+# Logical, physical, length, 2 reserved, flags, 3 reserved
+FIEMAP_EXTENT = struct.Struct("=QQQ2QI3I")
+FIEMAP_FLAG_SYNC = 0x1
+# Extents, whose location is not known or which are not block aligned, e.g. delayed allocation or inline data
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_NOT_ALIGNED = 0x100
+FIEMAP_EXTENT_DATA_INLINE = 0x200
+
+# Number of bytes at the start of a file, which the kernel is asked to read ahead
+READAHEAD_SIZE = 32 * 1024 * 1024
+
+
+def _fiemap_first(fd):
+    buf = bytearray(FIEMAP_HEADER.size + FIEMAP_EXTENT.size)
+    FIEMAP_HEADER.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0)
+    fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+
+    if FIEMAP_HEADER.unpack_from(buf, 0)[3] == 0:
+        # No data at all, e.g. an empty or a sparse file
+        return None
+
+    _, physical, _, _, _, flags, _, _, _ = FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)
+    if flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_NOT_ALIGNED | FIEMAP_EXTENT_DATA_INLINE):
+        return None
+
+    return physical
+
+
+def _fibmap_first(fd):
+    block = struct.unpack("i", fcntl.ioctl(fd, FIBMAP, struct.pack("i", 0)))[0]
+    if block == 0:
+        return None
+
+    block_size = struct.unpack("i", fcntl.ioctl(fd, FIGETBSZ, struct.pack("i", 0)))[0]
+    return block * block_size
+
+
+def physical_offset(path):
+    """
+    Determines, where the data of a file starts on the device of its file system. FIEMAP is tried first, file systems
+    without it, like ntfs-3g mounted as fuseblk, usually still answer FIBMAP, which requires root privileges.
+
+    :param path: path to a regular file
+    :return: byte offset of the first extent or None, if the file has no data on its own, e.g. an empty file or NTFS
+    resident data, or the file system does not tell
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+
+    try:
+        for method in (_fiemap_first, _fibmap_first):
+            try:
+                return method(fd)
+            except OSError:
+                continue
+
+        return None
+    finally:
+        os.close(fd)
+
+
+def sort_physical(items, offset_of):
+    """
+    Sorts items ascending by the physical offset of their data, so reading them one after another sweeps the disk
+    instead of seeking back and forth. Items without a known offset come first in their original order, their data is
+    either tiny or cannot be placed anyway.
+
+    :param items: iterable of items, all of them are held in memory
+    :param offset_of: callable, which is passed an item and returns its physical offset or None
+    :return: list of the items
+    """
+    keyed = [(offset_of(item), i, item) for i, item in enumerate(items)]
+    located = sum(1 for offset, _, _ in keyed if offset is not None)
+    keyed.sort(key=lambda k: (k[0] is not None, k[0] or 0, k[1]))
+    logger.debug(f"Located {located} of {len(keyed)} files on disk")
+
+    return [item for _, _, item in keyed]
+
+
+def advise_sequential(fd, size=0):
+    """
+    Tells the kernel, that a file is read sequentially and starts reading its head ahead of time. Does nothing on
+    platforms without posix_fadvise.
+
+    :param fd: file descriptor
+    :param size: size of the file, the first READAHEAD_SIZE bytes of it are read ahead
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if size:
+            os.posix_fadvise(fd, 0, min(size, READAHEAD_SIZE), os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
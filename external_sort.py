@@ -0,0 +1,81 @@
+import os
+import heapq
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Number of lines sorted in memory at once
+RUN_SIZE = 1000000
+
+
+def _write_run(lines, key, tmp_dir):
+    lines.sort(key=key)
+
+    fd, path = tempfile.mkstemp(prefix="run-", dir=tmp_dir)
+    with open(fd, "w", encoding="utf-8", errors="surrogateescape") as f:
+        f.writelines(lines)
+
+    return path
+
+
+def sorted_runs(lines, key=None, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Splits lines into chunks of run_size lines, sorts every chunk in memory and spills it to a temporary file.
+
+    :param lines: iterable of lines including their line endings
+    :param key: optional key function for sorting
+    :param run_size: number of lines per run
+    :param tmp_dir: directory for the runs, defaults to the system's temporary directory
+    :return: list of paths to the sorted runs
+    """
+    runs = []
+    chunk = []
+
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= run_size:
+            runs.append(_write_run(chunk, key, tmp_dir))
+            chunk = []
+
+    if chunk:
+        runs.append(_write_run(chunk, key, tmp_dir))
+
+    return runs
+
+
+def _read_run(path):
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        yield from f
+
+
+def merge_runs(run_paths, key=None):
+    """
+    Merges sorted runs with a k-way merge, only one line per run is held in memory.
+
+    :param run_paths: paths to sorted runs
+    :param key: key function, the runs were sorted with
+    :return: generator of lines in sorted order
+    """
+    return heapq.merge(*(_read_run(p) for p in run_paths), key=key)
+
+
+def external_sort(lines, key=None, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Sorts an arbitrary number of lines with bounded memory. The runs are removed, once the generator is exhausted or
+    closed.
+
+    :param lines: iterable of lines including their line endings
+    :param key: optional key function for sorting
+    :param run_size: number of lines sorted in memory at once
+    :param tmp_dir: directory for the runs, defaults to the system's temporary directory
+    :return: generator of lines in sorted order
+    """
+    runs = sorted_runs(lines, key, run_size, tmp_dir)
+    logger.debug(f"Spilled {len(runs)} sorted runs")
+
+    try:
+        yield from merge_runs(runs, key)
+    finally:
+        for path in runs:
+            os.remove(path)
@@ -0,0 +1,305 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import threading
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds, after which a job, whose worker stopped sending heartbeats, is handed out again
+LEASE_SECONDS = 600
+
+# Number of times a job is handed out, before it is marked as failed for good
+MAX_ATTEMPTS = 3
+
+# Seconds an idle worker waits, before it looks for reclaimable jobs again
+POLL_INTERVAL = 30
+
+Job = namedtuple("Job", ["box", "vagrantfile", "stage", "attempts", "worker", "data"])
+
+
+class LeaseLostError(RuntimeError):
+    """
+    Raised, when a worker reports on a job, which was reclaimed in the meantime.
+    """
+
+
+def worker_name():
+    """
+    Returns a name for a worker process, which is unique across hosts.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """
+    Durable queue of boxes for the farm mode, stored in a SQLite database. Each job is a box, which is pending,
+    running, done or failed, and records the stage it reached and data of completed stages, e.g. where the cloned image
+    lives. Any number of worker processes claim jobs from the same database. A running job is leased to its worker,
+    which renews the lease with heartbeats; jobs of workers, which died, are handed out again once their lease
+    expired.
+
+    Leases are compared by wall clock, so the clocks of the hosts sharing a queue have to be in sync, and the
+    database has to live on a file system with working locks.
+    """
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """
+        Opens or creates the queue
+
+        :param db_path: path to the SQLite database file
+        :param lease_seconds: seconds a claim or heartbeat keeps a job leased to its worker
+        :param max_attempts: number of attempts, after which a job fails for good
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Heartbeats are sent from another thread, the connection is shared and guarded by a lock
+        self.db = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                box TEXT PRIMARY KEY,
+                vagrantfile TEXT NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                data TEXT NOT NULL,
+                error TEXT,
+                updated REAL NOT NULL
+            )""")
+
+    def close(self):
+        self.db.close()
+
+    def _transaction(self, func):
+        """
+        Runs func with the database locked for writing, so concurrent workers never claim the same job.
+        """
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func()
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+        return result
+
+    def add(self, box, vagrantfile):
+        """
+        Adds a box, unless the queue knows it already.
+
+        :return: True, if the box was added
+        """
+        return self._transaction(lambda: self.db.execute(
+            "INSERT OR IGNORE INTO jobs VALUES (?, ?, 'pending', 'vm', 0, NULL, NULL, '{}', NULL, ?)",
+            (box, vagrantfile, time.time())).rowcount > 0)
+
+    def _reclaim_stale(self, now):
+        failed = self.db.execute(
+            "UPDATE jobs SET status = 'failed', worker = NULL, lease_until = NULL, error = 'lease expired', updated = ? "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts)).rowcount
+        reclaimed = self.db.execute(
+            "UPDATE jobs SET status = 'pending', worker = NULL, lease_until = NULL, error = 'lease expired', "
+            "updated = ? WHERE status = 'running' AND lease_until < ?", (now, now)).rowcount
+
+        if failed or reclaimed:
+            logger.info(f"Reclaimed {reclaimed} jobs of workers, which stopped sending heartbeats, {failed} failed")
+
+    def claim(self, worker):
+        """
+        Hands the next pending job to a worker. Jobs, whose lease expired, are reclaimed first.
+
+        :param worker: name of the worker
+        :return: Job or None, if no job is pending
+        """
+        def claim_next():
+            now = time.time()
+            self._reclaim_stale(now)
+            row = self.db.execute("SELECT box, vagrantfile, stage, attempts, data FROM jobs WHERE status = 'pending' "
+                                  "ORDER BY rowid LIMIT 1").fetchone()
+            if row is None:
+                return None
+
+            box, vagrantfile, stage, attempts, data = row
+            self.db.execute("UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = ?, "
+                            "updated = ? WHERE box = ?", (worker, now + self.lease_seconds, attempts + 1, now, box))
+
+            return Job(box, vagrantfile, stage, attempts + 1, worker, json.loads(data))
+
+        return self._transaction(claim_next)
+
+    def _update_own(self, job, assignments, values):
+        """
+        Updates a job, which is still leased to the worker holding it.
+
+        :return: True, if the worker still holds the job
+        """
+        return self._transaction(lambda: self.db.execute(
+            f"UPDATE jobs SET {assignments}, updated = ? WHERE box = ? AND worker = ? AND status = 'running'",
+            (*values, time.time(), job.box, job.worker)).rowcount > 0)
+
+    def heartbeat(self, job):
+        """
+        Renews the lease of a job.
+
+        :return: False, if the job was reclaimed in the meantime
+        """
+        return self._update_own(job, "lease_until = ?", (time.time() + self.lease_seconds,))
+
+    def set_stage(self, job, stage, **data):
+        """
+        Records, that a job reached a stage, along with data of the completed stages, which a later attempt can take
+        over.
+
+        :return: Job with the new stage and data
+        """
+        job = job._replace(stage=stage, data=dict(job.data, **data))
+
+        if not self._update_own(job, "stage = ?, data = ?", (stage, json.dumps(job.data))):
+            raise LeaseLostError(f"Job {job.box} was reclaimed from {job.worker}")
+
+        return job
+
+    def complete(self, job):
+        if not self._update_own(job, "status = 'done', stage = 'done', lease_until = NULL, error = NULL", ()):
+            logger.warning(f"Job {job.box} was reclaimed from {job.worker}, before it completed")
+
+    def fail(self, job, error):
+        """
+        Records a failed attempt. The job is handed out again, until it used up its attempts.
+        """
+        status = "failed" if job.attempts >= self.max_attempts else "pending"
+        self._update_own(job, "status = ?, worker = NULL, lease_until = NULL, error = ?", (status, error))
+
+    def retry_failed(self):
+        """
+        Hands out failed jobs again with fresh attempts.
+
+        :return: number of jobs
+        """
+        return self._transaction(lambda: self.db.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, updated = ? WHERE status = 'failed'",
+            (time.time(),)).rowcount)
+
+    def counts(self):
+        """
+        Returns the number of jobs per status.
+        """
+        with self._lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def jobs(self):
+        """
+        Returns all jobs as dicts in the order they were added.
+        """
+        with self._lock:
+            cursor = self.db.execute("SELECT box, status, stage, attempts, worker, lease_until, error, updated "
+                                     "FROM jobs ORDER BY rowid")
+            names = [c[0] for c in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+class FarmWorker:
+    """
+    Claims jobs from a JobQueue and processes them one after another, while a background thread sends heartbeats for
+    the current job. Once no job is pending, the worker waits for the jobs of the other workers, as they may still be
+    reclaimed, and exits, when none is left running.
+    """
+
+    def __init__(self, queue, process_job, name=None, heartbeat_interval=None, poll_interval=POLL_INTERVAL):
+        """
+        Creates a FarmWorker
+
+        :param queue: JobQueue
+        :param process_job: callable, which is passed a Job and processes it, an exception fails the attempt
+        :param name: name of the worker, see worker_name
+        :param heartbeat_interval: seconds between heartbeats, a third of the lease by default
+        :param poll_interval: seconds to wait for reclaimable jobs, while other workers are busy
+        """
+        self.queue = queue
+        self.process_job = process_job
+        self.name = name or worker_name()
+        self.heartbeat_interval = heartbeat_interval or queue.lease_seconds / 3
+        self.poll_interval = poll_interval
+
+    def _heartbeat(self, job, stop):
+        while not stop.wait(self.heartbeat_interval):
+            if not self.queue.heartbeat(job):
+                logger.warning(f"Lost the lease of job {job.box}, another worker may process it as well")
+                return
+
+    def run_job(self, job):
+        logger.info(f"Worker {self.name} claimed {job.box} (attempt {job.attempts}, stage {job.stage})")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            self.process_job(job)
+        except Exception as e:
+            logger.exception(f"Job {job.box} failed")
+            self.queue.fail(job, f"{type(e).__name__}: {e}")
+            return False
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        self.queue.complete(job)
+        logger.info(f"Worker {self.name} completed {job.box}")
+        return True
+
+    def run(self):
+        """
+        Processes jobs until the queue is drained.
+
+        :return: number of jobs completed by this worker
+        """
+        completed = 0
+
+        while True:
+            job = self.queue.claim(self.name)
+
+            if job is None:
+                if not self.queue.counts().get("running"):
+                    break
+                time.sleep(self.poll_interval)
+                continue
+
+            completed += self.run_job(job)
+
+        logger.info(f"Worker {self.name} is done, it completed {completed} jobs")
+        return completed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inspects the job queue of hashlab's farm mode.")
+    parser.add_argument("db", help="job queue database, see hashlab.py --farm-db")
+    parser.add_argument("--retry-failed", action="store_true", help="hand out failed jobs again")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+    queue = JobQueue(args.db)
+
+    if args.retry_failed:
+        logger.info(f"{queue.retry_failed()} failed jobs are pending again")
+
+    for j in queue.jobs():
+        print(f"{j['box']:<40} {j['status']:<8} {j['stage']:<5} attempts {j['attempts']} {j['worker'] or ''} "
+              f"{j['error'] or ''}")
+    print(", ".join(f"{n} {status}" for status, n in sorted(queue.counts().items())))
+
+    queue.close()
@@ -0,0 +1,407 @@
+import os
+import stat
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import extents
+from file_policy import HEADER_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Digests, which are computed in a single read of each file
+ALGORITHMS = ("md5", "sha1", "sha256")
+
+FileDigest = namedtuple("FileDigest", ["path", "size", "mtime", "md5", "sha1", "sha256"])
+
+# Number of files with several links, which HardLinks keeps for links found later; links found after their file was
+# dropped are read again. On NTFS the DOS 8.3 name counts as a link, which is never visited, so most files of a volume
+# would be kept otherwise
+LINKS_WINDOW = 100000
+
+
+def stat_identity(st):
+    """
+    Identifies the file behind a stat result, if it has several links: device and inode, which is the NTFS file
+    reference on volumes mounted by ntfs-3g.
+
+    :return: ((st_dev, st_ino), st_nlink) or None for files with a single link
+    """
+    return ((st.st_dev, st.st_ino), st.st_nlink) if st.st_nlink > 1 else None
+
+
+def path_identity(path):
+    """
+    Identifies the file behind a path, if it has several links, see stat_identity.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+
+    return stat_identity(st)
+
+
+class LinkStats:
+    """
+    Counts the files, whose digest was taken over from another link to the same data, and the bytes not read thereby.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+
+class HardLinks:
+    """
+    Makes sure, that a file with several hard links is read only once per volume: the first link is hashed, all
+    further links wait for its digest and take it over under their own path. A file is forgotten, once all of its
+    links were seen, or once window other files with several links were found after it.
+    """
+
+    def __init__(self, identity=path_identity, relink=lambda digest, path: digest._replace(path=path), stats=None,
+                 window=LINKS_WINDOW):
+        """
+        :param identity: callable, which is passed an item and returns a key identifying the underlying file and its
+        number of links, if it has several links, or None
+        :param relink: callable, which is passed the FileDigest of the first link and an item and returns the
+        FileDigest of the item
+        :param stats: LinkStats to count the files taken over in, a new one by default
+        :param window: number of files kept for links found later
+        """
+        self.identity = identity
+        self.relink = relink
+        self.stats = stats or LinkStats()
+        self.window = window
+        # Key of the file -> [Future of the first link, number of links not seen yet]
+        self._first = OrderedDict()
+
+    def project(self, get, identity=None):
+        """
+        Returns HardLinks for items, which wrap the items of this one, e.g. entries holding a path. The files seen and
+        the counts are shared.
+
+        :param get: callable, which extracts the item of this HardLinks from a wrapping item
+        :param identity: optional callable, which identifies the file of a wrapping item itself, e.g. from a stat
+        result it holds, instead of the identity of this one
+        """
+        links = HardLinks(identity or (lambda i: self.identity(get(i))), lambda d, i: self.relink(d, get(i)),
+                          self.stats, self.window)
+        links._first = self._first
+        return links
+
+    def _take_over(self, digest, item):
+        if digest is None:
+            return None
+
+        self.stats.add(digest.size)
+        return self.relink(digest, item)
+
+    def submit(self, executor, func, item):
+        """
+        Submits func for an item, unless it is another link to a file submitted before.
+
+        :return: Future of the FileDigest of the item
+        """
+        identity = self.identity(item)
+
+        if identity is None:
+            return executor.submit(func, item)
+
+        key, nlink = identity
+        entry = self._first.get(key)
+
+        if entry is None:
+            future = executor.submit(func, item)
+            self._first[key] = [future, nlink - 1]
+            if len(self._first) > self.window:
+                self._first.popitem(last=False)
+            return future
+
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._first[key]
+
+        return _chain(entry[0], lambda digest: self._take_over(digest, item))
+
+
+def _chain(future, func):
+    """
+    Returns a future, which resolves to func applied to the result of the given one.
+    """
+    chained = Future()
+
+    def done(f):
+        try:
+            chained.set_result(func(f.result()))
+        except BaseException as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+class FileHasher:
+    """
+    In-process replacement for hashrat. Spreads the files of a directory tree over a pool of worker threads, reads every
+    file exactly once and feeds each chunk into MD5, SHA-1 and SHA-256 at the same time. hashlib releases the GIL for
+    larger chunks, so the workers really run in parallel.
+
+    In physical order, the files are read in the order their data is stored on disk instead of the directory order,
+    which turns the seeks across the image into mostly sequential reads.
+    """
+
+    def __init__(self, workers=None, buffer_size=1024 * 1024, policy=None, physical_order=False):
+        """
+        Creates a FileHasher
+
+        :param workers: number of worker threads, defaults to the number of CPUs
+        :param buffer_size: size of the read buffer, which every worker allocates once and reuses for all files
+        :param policy: optional FilePolicy, which selects the files to hash
+        :param physical_order: if set, files are hashed ascending by the physical offset of their data and read ahead,
+        the results are in that order as well
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.buffer_size = max(buffer_size, HEADER_SIZE)
+        self.policy = policy
+        self.physical_order = physical_order
+        self._local = threading.local()
+
+    def _get_buffer(self):
+        """
+        Returns the read buffer of the calling worker thread and allocates it on first use.
+        """
+        buf = getattr(self._local, "buf", None)
+
+        if buf is None:
+            buf = bytearray(self.buffer_size)
+            self._local.buf = buf
+
+        return buf
+
+    def hash_stream(self, f, stats=None, size=0):
+        """
+        Reads a binary file object until EOF and computes all digests in one pass. If the policy filters by type, only
+        the first bytes are read at first and the file is skipped, if its type is not allowed.
+
+        :param f: file object supporting readinto()
+        :param stats: optional SkipStats to count skipped files in
+        :param size: size of the file, only used for counting skipped bytes
+        :return: digests, bytes_read - a dict mapping algorithm names to hex digests and the number of bytes read, or
+        None, if the file was skipped
+        """
+        hashes = [hashlib.new(a) for a in ALGORITHMS]
+        buf = self._get_buffer()
+        view = memoryview(buf)
+        bytes_read = 0
+
+        if self.policy is not None and self.policy.needs_header:
+            n = f.readinto(view[:HEADER_SIZE])
+            reason = self.policy.check_header(view[:n])
+
+            if reason:
+                if stats is not None:
+                    stats.skip(reason, size)
+                return None
+
+            for h in hashes:
+                h.update(view[:n])
+            bytes_read += n
+
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            chunk = view[:n]
+            for h in hashes:
+                h.update(chunk)
+            bytes_read += n
+
+        return {a: h.hexdigest() for a, h in zip(ALGORITHMS, hashes)}, bytes_read
+
+    def hash_file(self, path, stats=None):
+        """
+        Hashes a single file.
+
+        :param path: path to the file
+        :param stats: optional SkipStats to count the file in, if the policy skips it
+        :return: FileDigest of the file or None, if it was skipped
+        """
+        with open(path, "rb", buffering=0) as f:
+            st = os.fstat(f.fileno())
+            if self.physical_order:
+                extents.advise_sequential(f.fileno(), st.st_size)
+            result = self.hash_stream(f, stats, st.st_size)
+
+        if result is None:
+            return None
+
+        digests, size = result
+        return FileDigest(path, size, st.st_mtime, **digests)
+
+    def _try_hash_file(self, path, stats=None):
+        try:
+            return self.hash_file(path, stats)
+        except OSError as e:
+            logger.warning(f"Could not hash {path}: {e}")
+            return None
+
+    def walk(self, root, stats=None):
+        """
+        Yields the paths of all regular files below root. Symlinks are not followed and the entries of each directory
+        are visited in sorted order, so the result does not depend on the order in which the file system lists them.
+        Files, which the policy rules out by path or size, are skipped without opening them.
+
+        In physical order, all paths are collected first and sorted by the physical offset of their data, see
+        extents.sort_physical.
+
+        :param root: directory to traverse
+        :param stats: optional SkipStats to count skipped files in
+        """
+        for path, _ in self.walk_entries(root, stats):
+            yield path
+
+    def walk_entries(self, root, stats=None):
+        """
+        Like walk, but yields the stat result of every file along with its path, so it does not have to be taken again.
+
+        :return: generator of (path, os.stat_result), the stat result is the one of os.lstat
+        """
+        if self.physical_order:
+            yield from extents.sort_physical(self._walk(root, stats), lambda e: extents.physical_offset(e[0]))
+        else:
+            yield from self._walk(root, stats)
+
+    def _walk(self, root, stats=None):
+        for dirpath, dirnames, filenames in os.walk(root, onerror=lambda e: logger.warning(f"Skipping {e.filename}: {e}")):
+            dirnames.sort()
+            rel_dir = "/" + os.path.relpath(dirpath, root) if dirpath != root else ""
+
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+
+                if self.policy is not None:
+                    reason = self.policy.check_path(f"{rel_dir}/{name}", st.st_size)
+                    if reason:
+                        if stats is not None:
+                            stats.skip(reason, st.st_size)
+                        continue
+
+                yield path, st
+
+    def _in_order(self, futures):
+        """
+        Resolves futures in the order of the input, while at most a few futures per worker are in flight, so memory
+        use does not depend on the number of files.
+
+        :param futures: lazy iterable of futures, which submits work as it is consumed
+        :return: generator of the results
+        """
+        window = 4 * self.workers
+        pending = deque()
+
+        for future in futures:
+            pending.append(future)
+
+            if len(pending) >= window:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def map_ordered(self, func, items, links=None):
+        """
+        Applies func to all items with the worker pool.
+
+        :param func: callable, which is passed a single item and returns a result or None
+        :param items: iterable of items
+        :param links: optional HardLinks, func is applied only once to all links to the same file
+        :return: generator of the results in the order of the input, None results are skipped
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            submit = links.submit if links is not None else lambda e, f, i: e.submit(f, i)
+            for result in self._in_order(submit(executor, func, i) for i in items):
+                if result is not None:
+                    yield result
+
+    def hash_paths(self, paths, stats=None, links=None):
+        """
+        Hashes the given files with the worker pool.
+
+        :param paths: iterable of file paths
+        :param stats: optional SkipStats to count files skipped by the policy in
+        :param links: optional HardLinks, files with several links are read only once
+        :return: generator of FileDigest in the order of the input, files which could not be read are skipped
+        """
+        return self.map_ordered(lambda p: self._try_hash_file(p, stats), paths, links)
+
+    def map_incremental(self, func, items, lookup, links=None):
+        """
+        Applies func to the items with the worker pool, but only to those, for which lookup does not know a result.
+
+        :param func: callable, which is passed a single item and returns a result or None
+        :param items: iterable of items
+        :param lookup: callable, which is passed an item and returns a known result or None
+        :param links: optional HardLinks, func is applied only once to all links to the same file
+        :return: generator of (result, is_new) in the order of the input, is_new is False for known results, None
+        results are skipped
+        """
+        def submit_all(executor):
+            for item in items:
+                known = lookup(item)
+
+                if known:
+                    future = Future()
+                    future.set_result((known, False))
+                    yield future
+                elif links is not None:
+                    yield _chain(links.submit(executor, func, item), lambda r: (r, True))
+                else:
+                    yield executor.submit(lambda i: (func(i), True), item)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result, is_new in self._in_order(submit_all(executor)):
+                if result:
+                    yield result, is_new
+
+    def hash_paths_incremental(self, paths, lookup, stats=None):
+        """
+        Hashes the given files with the worker pool, but only reads those, for which lookup does not know a digest.
+
+        :param paths: iterable of file paths
+        :param lookup: callable, which is passed a path and returns a known FileDigest or None
+        :param stats: optional SkipStats to count files skipped by the policy in
+        :return: generator of (FileDigest, is_new) in the order of the input, is_new is False for known digests
+        """
+        return self.map_incremental(lambda p: self._try_hash_file(p, stats), paths, lookup)
+
+    def hash_tree(self, root, stats=None, links=None):
+        """
+        Hashes all regular files below root, which the policy selects.
+
+        :param root: directory to traverse
+        :param stats: optional SkipStats to count files skipped by the policy in
+        :param links: optional HardLinks, files with several links are read only once
+        :return: generator of FileDigest in traversal order
+        """
+        if links is not None:
+            links = links.project(lambda e: e[0], lambda e: stat_identity(e[1]))
+
+        return self.map_ordered(lambda e: self._try_hash_file(e[0], stats), self.walk_entries(root, stats), links)
+
@@ -0,0 +1,269 @@
+import os
+import re
+import fnmatch
+import logging
+import threading
+from collections import Counter
+
+import utils
+
+try:
+    import magic
+except ImportError:
+    # MIME type filters need python-magic, the built-in signatures work without it
+    magic = None
+
+logger = logging.getLogger(__name__)
+
+# Name of the policy file, which is looked up next to the vagrantfile like the "cumulate" marker
+POLICY_FILE = "hash_policy.yml"
+
+# Number of leading bytes read to determine the type of a file
+HEADER_SIZE = 2048
+
+# Volatile files and directories of Windows, which are never worth hashing, see "exclude_volatile"
+VOLATILE_EXCLUDES = [
+    "/pagefile.sys",
+    "/hiberfil.sys",
+    "/swapfile.sys",
+    "/$Recycle.Bin/**",
+    "/System Volume Information/**",
+    "/Windows/Temp/**",
+    "/Users/*/AppData/Local/Temp/**",
+    "**/INetCache/**",
+    "**/Google/Chrome/User Data/*/Cache/**",
+    "**/Mozilla/Firefox/Profiles/*/cache2/**",
+]
+
+# Leading bytes of the built-in file types
+SIGNATURES = {
+    "pe": (b"MZ",),
+    "elf": (b"\x7fELF",),
+    "macho": (b"\xfe\xed\xfa\xce", b"\xfe\xed\xfa\xcf", b"\xce\xfa\xed\xfe", b"\xcf\xfa\xed\xfe", b"\xca\xfe\xba\xbe"),
+    "script": (b"#!",),
+    "zip": (b"PK\x03\x04",),
+    "ole": (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",),
+}
+
+# Names, which stand for several built-in types
+TYPE_GROUPS = {
+    "executable": ("pe", "elf", "macho"),
+    "library": ("pe", "elf", "macho"),
+}
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """
+    Parses a size like 4096, "512K" or "2G".
+
+    :return: size in bytes or None
+    """
+    if value is None or isinstance(value, int):
+        return value
+
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)i?B?\s*", str(value), re.I)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+
+def glob_to_regex(pattern):
+    """
+    Translates a path glob into a regular expression. "*" and "?" do not match "/", "**" matches across directories.
+    Patterns starting with "/" are anchored at the root of the volume, all others match at any depth.
+    """
+    parts = []
+    i = 0
+
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    prefix = "" if pattern.startswith("/") else "(?:.*/)?"
+    return prefix + "".join(parts)
+
+
+def detect_type(header):
+    """
+    Determines the built-in type of a file by its leading bytes.
+
+    :return: name of the type or None
+    """
+    for name, signatures in SIGNATURES.items():
+        if header.startswith(signatures):
+            return name
+
+    return None
+
+
+class SkipStats:
+    """
+    Counts the files and bytes skipped per reason. Workers of several volumes may update it at the same time.
+    """
+
+    def __init__(self):
+        self.files = Counter()
+        self.bytes = Counter()
+        self._lock = threading.Lock()
+
+    def skip(self, reason, size):
+        with self._lock:
+            self.files[reason] += 1
+            self.bytes[reason] += size
+
+    @property
+    def total_files(self):
+        return sum(self.files.values())
+
+    @property
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+    def summary(self):
+        details = ", ".join(f"{reason}: {self.files[reason]} files, {self.bytes[reason]} bytes"
+                            for reason in sorted(self.files))
+        return f"{self.total_files} files ({self.total_bytes} bytes) skipped" + (f" - {details}" if details else "")
+
+
+class FilePolicy:
+    """
+    Decides, which files of a volume are hashed. Files are selected by path globs and size limits, which only need the
+    metadata of a file, and optionally by their type, which is determined from the first bytes before the rest of the
+    file is read.
+
+    A file is hashed, if it matches one of the include globs (or there are none), matches none of the exclude globs,
+    its size is within the limits and its type is one of the allowed types (or there are none). Paths are matched
+    relative to the root of the volume, e.g. "/Windows/System32/kernel32.dll".
+    """
+
+    def __init__(self, exclude=(), include=(), min_size=None, max_size=None, types=(), case_sensitive=False):
+        """
+        Creates a FilePolicy
+
+        :param exclude: globs of files to skip
+        :param include: globs of files to hash, all files if empty
+        :param min_size: minimum size in bytes
+        :param max_size: maximum size in bytes
+        :param types: allowed types: built-in ones ("pe", "elf", "macho", "script", "zip", "ole" or the groups
+        "executable" and "library") or MIME type globs like "application/x-*", which require python-magic
+        :param case_sensitive: whether globs are matched case sensitively, which is wrong for NTFS and FAT
+        """
+        flags = 0 if case_sensitive else re.I
+        self.exclude = re.compile("|".join(f"(?:{glob_to_regex(p)})" for p in exclude) + "$", flags) \
+            if exclude else None
+        self.include = re.compile("|".join(f"(?:{glob_to_regex(p)})" for p in include) + "$", flags) \
+            if include else None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.types = set()
+        self.mime_types = []
+
+        for t in types:
+            if "/" in t:
+                self.mime_types.append(t)
+            elif t in TYPE_GROUPS:
+                self.types.update(TYPE_GROUPS[t])
+            elif t in SIGNATURES:
+                self.types.add(t)
+            else:
+                raise ValueError(f"Unknown file type {t}")
+
+        if self.mime_types and magic is None:
+            raise RuntimeError("MIME type filters require python-magic")
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates a FilePolicy from a parsed policy file, e.g.
+
+        exclude_volatile: true
+        exclude:
+          - "/Windows/SoftwareDistribution/Download/**"
+        max_size: 512M
+        types: [executable]
+        """
+        config = config or {}
+        exclude = list(config.get("exclude") or [])
+        if config.get("exclude_volatile"):
+            exclude += VOLATILE_EXCLUDES
+
+        return cls(exclude=exclude, include=config.get("include") or [],
+                   min_size=parse_size(config.get("min_size")), max_size=parse_size(config.get("max_size")),
+                   types=config.get("types") or [], case_sensitive=bool(config.get("case_sensitive", False)))
+
+    @classmethod
+    def load(cls, vd):
+        """
+        Loads the policy of a box, if there is a policy file next to its vagrantfile.
+
+        :param vd: directory of the vagrantfile
+        :return: FilePolicy or None
+        """
+        path = os.path.join(vd, POLICY_FILE)
+
+        if not os.path.isfile(path):
+            return None
+
+        logger.info(f"Hash policy set for {vd}")
+        return cls.from_config(utils.read_config(path))
+
+    @property
+    def needs_header(self):
+        return bool(self.types or self.mime_types)
+
+    def check_path(self, rel_path, size):
+        """
+        Evaluates the globs and size limits.
+
+        :param rel_path: path relative to the root of the volume, starting with "/"
+        :param size: size of the file in bytes
+        :return: reason for skipping the file or None, if it is selected
+        """
+        if self.include is not None and not self.include.match(rel_path):
+            return "not included"
+        if self.exclude is not None and self.exclude.match(rel_path):
+            return "excluded"
+        if self.min_size is not None and size < self.min_size:
+            return "too small"
+        if self.max_size is not None and size > self.max_size:
+            return "too large"
+
+        return None
+
+    def check_header(self, header):
+        """
+        Evaluates the type filters on the first bytes of a file.
+
+        :param header: up to HEADER_SIZE leading bytes
+        :return: reason for skipping the file or None, if it is selected
+        """
+        if not self.needs_header:
+            return None
+
+        header = bytes(header)
+
+        if self.types and detect_type(header) in self.types:
+            return None
+
+        if self.mime_types:
+            mime = magic.from_buffer(header, mime=True)
+            if any(fnmatch.fnmatch(mime, m) for m in self.mime_types):
+                return None
+
+        return "type"
@@ -0,0 +1,216 @@
+import os
+import json
+import logging
+import time
+import sqlite3
+import threading
+from collections import deque
+
+from file_hasher import FileDigest, stat_identity
+
+logger = logging.getLogger(__name__)
+
+
+class HashCache:
+    """
+    Persistent on-disk cache of file digests, which allows re-runs of cumulating boxes to only read new or modified
+    files. Entries are keyed by box, volume and the path relative to the volume and are only reused, if size, mtime
+    and the file ID still match. On volumes mounted by ntfs-3g the inode number is the NTFS file reference, so a file,
+    which was replaced by another one with the same name and timestamps, is still detected.
+
+    The cache also keeps the state of the VDI chain of every box, so the next run can tell the disk blocks changed in
+    between, see vdi_reader.changed_blocks_since.
+
+    Several boxes may be hashed at the same time, also by other processes, into the same database. Digests are
+    therefore written in batches of COMMIT_INTERVAL files or COMMIT_SECONDS, whichever comes first, so no write
+    transaction locks out the others for long. As batches are committed along the way, the latest run of every
+    volume is recorded as well. Entries of a run, which was interrupted, are rolled back by the next run of the
+    volume, as the hash lists of the interrupted run are discarded: their files are read again and end up in the
+    delta hash list.
+    """
+
+    COMMIT_INTERVAL = 1000
+    COMMIT_SECONDS = 2
+    # Seconds a connection waits for the write lock, while another one commits
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, db_path):
+        """
+        Opens or creates the cache database
+
+        :param db_path: path to the SQLite database file
+        """
+        self.db_path = db_path
+        # Volumes may be hashed concurrently, the connection is shared and guarded by a lock. Other boxes use
+        # connections of their own, WAL lets them read, while one of them writes
+        self.db = sqlite3.connect(db_path, timeout=self.LOCK_TIMEOUT, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                box TEXT NOT NULL,
+                volume TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                file_id INTEGER NOT NULL,
+                md5 TEXT NOT NULL,
+                sha1 TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                run INTEGER NOT NULL,
+                PRIMARY KEY (box, volume, path)
+            )""")
+        # Latest run of every volume, complete is 0 until all of its files were hashed
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS runs (
+                box TEXT NOT NULL,
+                volume TEXT NOT NULL,
+                run INTEGER NOT NULL,
+                complete INTEGER NOT NULL,
+                PRIMARY KEY (box, volume)
+            )""")
+        # State of the disk images of a box after its last run, see vdi_reader.disk_state
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS disk_state (
+                box TEXT PRIMARY KEY,
+                state TEXT NOT NULL
+            )""")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _file_key(st):
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get_disk_state(self, box):
+        """
+        Returns the state of the disk images of a box recorded after its last run or None.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT state FROM disk_state WHERE box = ?", (box,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def set_disk_state(self, box, state):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO disk_state VALUES (?, ?)", (box, json.dumps(state)))
+            self.db.commit()
+
+    def _start_run(self, box, volume):
+        """
+        Records a new run of a volume, after rolling back the entries of its previous run, if that was interrupted.
+
+        :return: number of the new run
+        """
+        with self._lock:
+            previous = self.db.execute("SELECT run, complete FROM runs WHERE box = ? AND volume = ?",
+                                       (box, volume)).fetchone()
+
+            if previous is not None and not previous[1]:
+                rolled_back = self.db.execute("DELETE FROM files WHERE box = ? AND volume = ? AND run = ?",
+                                              (box, volume, previous[0])).rowcount
+                logger.info(f"Previous run of {box}/{volume} was interrupted, rolled back {rolled_back} entries")
+
+            run = max(previous[0] if previous else 0,
+                      self.db.execute("SELECT MAX(run) FROM files WHERE box = ? AND volume = ?",
+                                      (box, volume)).fetchone()[0] or 0) + 1
+            self.db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, 0)", (box, volume, run))
+            self.db.commit()
+
+        return run
+
+    def hash_tree(self, hasher, root, box, volume, stats=None, links=None):
+        """
+        Hashes all regular files below root with the given FileHasher and reuses the cached digests of unchanged files.
+        Afterwards the cache reflects the current state of the volume, entries of deleted files are dropped.
+
+        :param hasher: FileHasher, which reads new and modified files
+        :param root: directory, where the volume is mounted on
+        :param box: name of the box, usually the label of the image
+        :param volume: label of the volume
+        :param stats: optional SkipStats to count files skipped by the policy of the hasher in
+        :param links: optional HardLinks for paths, new files with several links are read only once
+        :return: generator of (FileDigest, is_new), is_new is True for files, which were not taken from the cache
+        """
+        def entries():
+            # The walker takes the stat results of regular files, they are the same as those of os.stat
+            for path, st in hasher.walk_entries(root, stats):
+                yield (path, st), path, os.path.relpath(path, root), self._file_key(st), st.st_mtime
+
+        if links is not None:
+            links = links.project(lambda e: e[0], lambda e: stat_identity(e[1]))
+
+        return self.hash_entries(hasher, entries(), lambda e: hasher._try_hash_file(e[0], stats), box, volume,
+                                 links=links)
+
+    def hash_entries(self, hasher, entries, hash_entry, box, volume, is_unchanged=None, links=None):
+        """
+        Hashes the given files with the worker pool of a FileHasher and reuses the cached digests of unchanged files.
+        Afterwards the cache reflects the current state of the volume, entries of deleted files are dropped.
+
+        :param hasher: FileHasher, which provides the worker pool
+        :param entries: iterable of (item, path, rel_path, key, mtime): item is passed to hash_entry, path is the path
+        reported in the FileDigest, rel_path the path relative to the volume, key the tuple (size, mtime_ns, file_id)
+        and mtime the modification time in seconds
+        :param hash_entry: callable, which is passed an item and returns its FileDigest or None
+        :param box: name of the box, usually the label of the image
+        :param volume: label of the volume
+        :param is_unchanged: optional callable, which is passed an entry and the cached key and decides, if the cached
+        digest is still valid, by default the keys have to be equal
+        :param links: optional HardLinks for the items, new files with several links are read only once
+        :return: generator of (FileDigest, is_new), is_new is True for files, which were not taken from the cache
+        """
+        run = self._start_run(box, volume)
+        # Entries looked up, whose result was not consumed yet, in the order of the input
+        pending = deque()
+        counts = {"cached": 0, "new": 0}
+        batch = []
+        flushed = time.monotonic()
+
+        def flush():
+            with self._lock:
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+                self.db.commit()
+            batch.clear()
+            return time.monotonic()
+
+        def lookup(entry):
+            _, path, rel_path, key, mtime = entry
+            pending.append((path, rel_path, key))
+            with self._lock:
+                row = self.db.execute("SELECT size, mtime_ns, file_id, md5, sha1, sha256 FROM files "
+                                      "WHERE box = ? AND volume = ? AND path = ?", (box, volume, rel_path)).fetchone()
+
+            if row is None:
+                return None
+            if is_unchanged(entry, tuple(row[:3])) if is_unchanged else tuple(row[:3]) == key:
+                return FileDigest(path, key[0], mtime, *row[3:])
+
+            return None
+
+        if links is not None:
+            links = links.project(lambda e: e[0])
+
+        for digest, is_new in hasher.map_incremental(lambda e: hash_entry(e[0]), entries, lookup, links):
+            # Results come in the order of the entries, entries without a result could not be read and are dropped
+            path, rel_path, (size, mtime_ns, file_id) = pending.popleft()
+            while path != digest.path:
+                path, rel_path, (size, mtime_ns, file_id) = pending.popleft()
+            batch.append((box, volume, rel_path, size, mtime_ns, file_id, digest.md5, digest.sha1, digest.sha256, run))
+            if len(batch) >= self.COMMIT_INTERVAL or time.monotonic() - flushed >= self.COMMIT_SECONDS:
+                flushed = flush()
+
+            counts["new" if is_new else "cached"] += 1
+
+            yield digest, is_new
+
+        flush()
+        with self._lock:
+            removed = self.db.execute("DELETE FROM files WHERE box = ? AND volume = ? AND run != ?",
+                                      (box, volume, run)).rowcount
+            self.db.execute("UPDATE runs SET complete = 1 WHERE box = ? AND volume = ?", (box, volume))
+            self.db.commit()
+        logger.info(f"Incremental hashing of {box}/{volume}: {counts['new']} files read, {counts['cached']} reused, "
+                    f"{removed} removed")
@@ -6,9 +6,26 @@ import vagrant
 import os
 import logging
 import re
+import shutil
+import socket
+import datetime
+import multiprocessing
 import utils
+import sparse
+import metrics
+import hashlist
 from virtualbox_vm_handler import VMHandler
 from disk_processor import DiskProcessor
+from file_hasher import FileHasher
+from block_hasher import BlockHasher
+from file_policy import FilePolicy
+from hash_cache import HashCache
+from journal import RunJournal, JOURNAL_FILE
+from farm import JobQueue, FarmWorker, worker_name
+from raw_image_processor import RawImageProcessor, READ_SIZE
+from vdi_reader import find_vdi_chain, open_vdi, disk_state, changed_blocks_since
+from async_runner import CommandRunner
+from scheduler import PipelineScheduler, ResourcePool, BoxLogFilter, box_context
 
 #sh = logger.StreamHandler()
 #logger = logger.getLogger(__name__)
@@ -47,6 +64,30 @@ def get_virtualbox_vm_name(vagrantfile):
         return None
 
 
+def get_virtualbox_vm_resources(vagrantfile):
+    """
+    Retrieves the memory and the number of CPUs of the VM as specified in the vagrantfile like this
+
+    config.vm.provider :virtualbox do |vb|
+       vb.memory = 4096
+       vb.cpus = 2
+    end
+
+    :param vagrantfile: absolute path to vagrant file
+    :return: ram, cpus: memory in MB and number of CPUs, VirtualBox' defaults of vagrant, if not specified
+    """
+    with open(vagrantfile, "r") as f:
+        data = f.read()
+
+    ram_match = re.search(r"vb.memory\s?=\s?\"?(\d+)\"?", data)
+    cpus_match = re.search(r"vb.cpus\s?=\s?\"?(\d+)\"?", data)
+
+    ram = int(ram_match.group(1)) if ram_match else 512
+    cpus = int(cpus_match.group(1)) if cpus_match else 1
+
+    return ram, cpus
+
+
 def check_operation_mode(vd):
     """
     Checks, if a snapshot has to be stored and/or provisioning for everytime. This is assumed, when a file name
@@ -91,7 +132,7 @@ def find_vagrantfiles(box_dir):
     return vfiles
 
 
-def control_virtualbox_vm(vf, clonedir="/tmp"):
+def control_virtualbox_vm(vf, clonedir="/tmp", direct_vdi=False, reserve_scratch=None):
     """
     Controls the hdd cloning of VM, which vagrant created. It creates a snapshot at first, then clones the disk as raw
     to the given directory (clonedir). Afterwards the UUID of the disk is retrieved, to clone it.
@@ -100,6 +141,8 @@ def control_virtualbox_vm(vf, clonedir="/tmp"):
 
     :param vf: abs path to vagrantfile of the VM, which is currently up and running
     :param clonedir: path to directory, where image will be stored
+    :param direct_vdi: if set, the disk is not cloned and the path to the VDI of the current state is returned instead
+    :param reserve_scratch: optional callable, which is passed the estimated size of the clone before cloning
 
     :return: vm_name: name of the corresponding VM as seen by VirtualBox/vboxmanage
     """
@@ -112,48 +155,90 @@ def control_virtualbox_vm(vf, clonedir="/tmp"):
 
     # Take snapshot after full provisioning
     snap_name = "tmp"
-    handler.gen_snap(snap_name)
+    with metrics.stage("snapshot", vm=vm_name):
+        handler.gen_snap(snap_name)
 
     # Save machine state
-    handler.save()
+    with metrics.stage("savestate", vm=vm_name):
+        handler.save()
     logger.info(f"Saved state of {vm_name} ")
 
+    if direct_vdi:
+        # The VDI is read in place by the raw image backend
+        disk_fp = handler.locate_vm_vdi()
+        logger.info(f"Reading disk of {vm_name} from {disk_fp}")
+        return vm_name, disk_fp
+
     disk_fp = os.path.join(clonedir, f"{vm_name}.dd")
 
+    needed = check_scratch_space(handler, clonedir)
+
+    if reserve_scratch:
+        reserve_scratch(needed)
+
     # Set this for parsing UUID of disk
-    handler.dump_vm_vdi(disk_fp)
-    logger.info(f"Cloned disk of {vm_name} to {disk_fp}")
+    with metrics.stage("clone", vm=vm_name) as s:
+        handler.dump_vm_vdi(disk_fp)
+        s.add(os.path.getsize(disk_fp), 1)
+        s.labels["allocated_bytes"] = sparse.allocated_size(disk_fp)
+    logger.info(f"Cloned disk of {vm_name} to {disk_fp} ({os.path.getsize(disk_fp)} bytes apparent, "
+                f"{sparse.allocated_size(disk_fp)} bytes allocated)")
 
     #handler.del_snap(snap_name)
 
     return vm_name, disk_fp
 
 
-def main(box_dir="../boxes", result_dir="../results", interactive=False, time=False):
-    setup_logging(args.time)
-    logger.info(f"Processing boxes in {box_dir}")
-    logger.info(f"Storing results in {result_dir}")
+def check_scratch_space(handler, clonedir):
+    """
+    Makes sure, that the sparse raw image of a VM fits into clonedir. The space needed is estimated by the bytes
+    allocated by the VDI files of the VM, not by the apparent size of the virtual disk.
 
-    vfiles = find_vagrantfiles(box_dir)
+    :param handler: VMHandler of the VM to clone
+    :param clonedir: path to directory, where image will be stored
+    :return: needed, estimated size of the clone in bytes, 0 if unknown
+    """
+    try:
+        needed = sum(sparse.allocated_size(p) for p in find_vdi_chain(handler.locate_vm_vdi()))
+    except (OSError, ValueError, TypeError) as e:
+        logger.info(f"Could not estimate the size of the clone, skipping space check: {e}")
+        return 0
 
-    logger.info(f"Found {len(vfiles)} vagrantfiles")
+    free = shutil.disk_usage(clonedir).free
+    logger.info(f"Clone needs up to {needed} bytes, {free} bytes free in {clonedir}")
+
+    if needed > free:
+        raise RuntimeError(f"Not enough scratch space in {clonedir}: {needed} bytes needed, {free} bytes free")
+
+    return needed
 
-    # Process all vagrant boxes
-    for vf in vfiles:
-        vd = os.path.dirname(vf)
-        logger.info(f"Starting vagrantfile in {vd}")
-        vbox = vagrant.Vagrant(vd)
 
-        is_cumulate, is_always_provision = check_operation_mode(vd)
+def run_vm_stage(vf, interactive=False, direct_vdi=False, reserve_scratch=None):
+    """
+    Brings up a vagrant box, clones its disk and halts it again.
+
+    :param vf: abs path to vagrantfile
+    :param interactive: if set, wait for user input before cloning
+    :param direct_vdi: if set, the disk is not cloned, but read in place later on
+    :param reserve_scratch: optional callable, which is passed the estimated size of the clone before cloning
+    :return: vm_name, disk_fp, is_cumulate
+    """
+    vd = os.path.dirname(vf)
+    logger.info(f"Starting vagrantfile in {vd}")
+    vbox = vagrant.Vagrant(vd)
+
+    is_cumulate, is_always_provision = check_operation_mode(vd)
 
-        if is_cumulate:
-            try:
+    if is_cumulate:
+        try:
+            with metrics.stage("snapshot_pop"):
                 vbox.snapshot_pop()
-            except RuntimeError:
-                logger.info("No pushed snapshot, skipping restore")
-                pass
+        except RuntimeError:
+            logger.info("No pushed snapshot, skipping restore")
+            pass
 
-        # Brings vagrant box up
+    # Brings vagrant box up
+    with metrics.stage("vagrant_up", provision=is_always_provision):
         if is_always_provision:
             logger.info("Calling vagrant up --provision")
             vbox.up(provision=True)
@@ -161,36 +246,408 @@ def main(box_dir="../boxes", result_dir="../results", interactive=False, time=Fa
             logger.info("Calling vagrant up --provision")
             vbox.up()
 
-        if interactive:
-            logger.info("Modify the running VM. Waiting until user input.")
+    if interactive:
+        logger.info("Modify the running VM. Waiting until user input.")
+        with metrics.stage("interactive"):
             utils.wait_for_confirm()
 
-        vm_name, disk_fp = control_virtualbox_vm(vf)
+    vm_name, disk_fp = control_virtualbox_vm(vf, direct_vdi=direct_vdi, reserve_scratch=reserve_scratch)
 
-        if is_cumulate:
+    if is_cumulate:
+        with metrics.stage("snapshot_push"):
             vbox.snapshot_push()
 
+    with metrics.stage("vagrant_halt"):
         vbox.halt()
 
+    return vm_name, disk_fp, is_cumulate
+
+
+def run_hash_stage(vf, disk_fp, is_cumulate, result_dir, hasher="builtin", workers=None, cache_db=None,
+                   backend="mount", direct_vdi=False, volume_workers=1, mount_parent="/tmp", block_db=None,
+                   journal=None, output_format="md5sum", compression=None, changed_blocks=False,
+                   physical_order=False):
+    """
+    Hashes all volumes of a disk image, stores the hashlists in result_dir and cleans up afterwards.
+
+    :param vf: abs path to vagrantfile, the image stems from
+    :param disk_fp: path to the image
+    :param is_cumulate: boolean - whether the box cumulates its states and can be hashed incrementally
+    :param result_dir: path to the directory, where the resulting hashlists should be stored
+    :param volume_workers: number of volumes of the image hashed concurrently
+    :param mount_parent: directory, below which the mount backend mounts the image
+    :param block_db: optional directory, where a store of the hashes of all blocks of the image is written to
+    :param journal: optional BoxJournal, the steps done by a previous run are skipped
+    :param output_format: format of the hash lists, see HashlistWriter
+    :param compression: compression of the hash lists, None, "gzip" or "zstd"
+    :param changed_blocks: if set, cumulating boxes only re-read files touching disk blocks, which changed since the
+    previous run according to the VDI chain, requires the raw backend
+    :param physical_order: if set, the builtin hasher reads the files of a volume in the order their data is stored on
+    disk
+    """
+    if backend == "raw" and hasher == "hashrat":
+        raise ValueError("hashrat requires mounted volumes, use the builtin hasher with the raw image backend")
+
+    # Optional selection of the files to hash, see hash_policy.yml
+    policy = FilePolicy.load(os.path.dirname(vf))
+    if policy is not None and hasher == "hashrat":
+        logger.warning("hashrat hashes all files, the hash policy is ignored")
+
+    if backend == "raw":
+        # Read volumes straight from the image
+        dp = RawImageProcessor(disk_fp, output_format, compression)
+        file_hasher = FileHasher(workers, buffer_size=READ_SIZE, policy=policy, physical_order=physical_order)
+    else:
         # Mount image
-        dp = DiskProcessor(disk_fp)
-        # Hash all volumes with hashrat and store result in result_dir
-        dp.hash_with_hashrat(result_dir)
-        # Unmount and clean up
+        dp = DiskProcessor(disk_fp, mount_parent, output_format, compression)
+        file_hasher = FileHasher(workers, policy=policy, physical_order=physical_order)
+
+    # Hash all volumes and store result in result_dir
+    if hasher == "hashrat":
+        dp.hash_with_hashrat(result_dir, volume_workers, journal)
+    elif is_cumulate:
+        # Cumulating boxes are re-run after each update round, so only changed files are read
+        cache = HashCache(cache_db or os.path.join(result_dir, ".hashlab_cache.sqlite"))
+        blocks, state = find_changed_blocks(vf, disk_fp, direct_vdi, dp.img_label, cache) if changed_blocks \
+            else (None, None)
+        dp.hash_files(result_dir, file_hasher, cache, volume_workers, journal, blocks)
+        if state is not None:
+            # The next run compares its VDI chain against this one
+            cache.set_disk_state(dp.img_label, state)
+        cache.close()
+    else:
+        dp.hash_files(result_dir, file_hasher, volume_workers=volume_workers, journal=journal)
+
+    if block_db:
+        if journal is not None and journal.is_done("blocks"):
+            logger.info("Block hashes were computed by a previous run, skipping them")
+        elif journal is not None:
+            with journal.step("blocks"):
+                run_block_hash_stage(vf, disk_fp, block_db, workers, direct_vdi)
+        else:
+            run_block_hash_stage(vf, disk_fp, block_db, workers, direct_vdi)
+
+    # Unmount and clean up
+    with metrics.stage("cleanup"):
         del dp
 
         # Delete cloned medium
-        utils.run_shell_cmd(["rm", disk_fp])  # further cleanup is done by DiskProcessor's destructor
-        logger.info(f"Completed processing of {vf}")
+        if not direct_vdi:
+            utils.run_shell_cmd(["rm", disk_fp])  # further cleanup is done by DiskProcessor's destructor
+    logger.info(f"Completed processing of {vf}")
+
+
+def find_changed_blocks(vf, disk_fp, direct_vdi, box, cache):
+    """
+    Determines the blocks of the disk of a box, which changed since its previous run, from the block maps of the VDI
+    chain of the VM.
+
+    :param vf: abs path to vagrantfile
+    :param disk_fp: path to the image, the VDI itself if direct_vdi is set
+    :param direct_vdi: whether disk_fp is the VDI of the current state
+    :param box: key of the box in the cache
+    :param cache: HashCache, which holds the state of the VDI chain of the previous run
+    :return: ChangedBlocks or None, if they cannot be determined, and the current state of the VDI chain or None
+    """
+    try:
+        leaf = disk_fp if direct_vdi else VMHandler(get_virtualbox_vm_name(vf), "vagrant", "vagrant").locate_vm_vdi()
+        image = open_vdi(leaf)
+    except (OSError, ValueError, TypeError) as e:
+        logger.info(f"Cannot read the VDI chain, changed blocks are unknown: {e}")
+        return None, None
+
+    try:
+        state = disk_state(image)
+        blocks = changed_blocks_since(image, cache.get_disk_state(box))
+    finally:
+        image.close()
+
+    if blocks is None:
+        logger.info("Changed blocks are unknown, files are compared by size, mtime and inode")
+    else:
+        logger.info(f"{len(blocks)} blocks ({blocks.size} bytes) of the disk changed since the previous run")
+
+    return blocks, state
+
+
+def run_block_hash_stage(vf, disk_fp, block_db, workers=None, direct_vdi=False):
+    """
+    Hashes all blocks of the raw image into BLOCK_DB/<box>.blk, before the image is deleted.
+
+    :param vf: abs path to vagrantfile, the image stems from
+    :param disk_fp: path to the raw image
+    :param block_db: directory of the block hash stores
+    :param workers: number of worker threads
+    :param direct_vdi: if set, disk_fp is a VDI, whose blocks cannot be hashed
+    """
+    if direct_vdi:
+        logger.warning("Block hashes need the raw image, they are not computed with --direct-vdi")
+        return
+
+    os.makedirs(block_db, exist_ok=True)
+    store_path = os.path.join(block_db, f"{PipelineScheduler.box_name(vf)}.blk")
+
+    with metrics.stage("hash_blocks", image=disk_fp) as s:
+        stats = BlockHasher(workers).hash_image(disk_fp, store_path)
+        s.add(stats["bytes"], 1)
+        s.labels.update(hashed_blocks=stats["hashed"], constant_blocks=stats["constant"],
+                        distinct_blocks=stats["distinct"])
+
+
+def main(box_dir="../boxes", result_dir="../results", interactive=False, time=False, hasher="builtin", workers=None,
+         cache_db=None, backend="mount", direct_vdi=False, volume_workers=1, pipeline=False, max_vms=1, max_hashers=1,
+         max_ram=None, max_cpus=None, max_scratch=None, metrics_file=None, max_commands=8, command_timeout=None,
+         block_db=None, resume=False, output_format="md5sum", compression="none", changed_blocks=False,
+         physical_order=False, farm_db=None, farm_workers=1):
+    setup_logging(args.time)
+    logger.info(f"Processing boxes in {box_dir}")
+    logger.info(f"Storing results in {result_dir}")
+
+    if farm_db:
+        # Boxes are handed out to worker processes through a job queue, which other hosts can work on as well
+        hash_options = dict(result_dir=result_dir, hasher=hasher, workers=workers, cache_db=cache_db, backend=backend,
+                            direct_vdi=direct_vdi, volume_workers=volume_workers, block_db=block_db,
+                            output_format=output_format, compression=None if compression == "none" else compression,
+                            changed_blocks=changed_blocks, physical_order=physical_order)
+        run_farm(farm_db, farm_workers, box_dir, hash_options, time, metrics_file, max_commands, command_timeout)
+        return
+
+    run = setup_metrics(result_dir, metrics_file)
+    # Progress of every box is journaled, so an interrupted run can be continued with --resume
+    os.makedirs(result_dir, exist_ok=True)
+    journal = RunJournal(os.path.join(result_dir, JOURNAL_FILE), run, resume)
+    # VBoxManage, hashrat, umount and the like run through a shared runner, which bounds them. Only short control
+    # commands are timed out, cloning and hashing take as long as the disk is large.
+    runner = CommandRunner(max_commands)
+    utils.set_command_runner(runner, command_timeout)
+    try:
+        with metrics.stage("run", pipeline=pipeline, backend=backend, hasher=hasher):
+            process_boxes(box_dir, result_dir, interactive, hasher, workers, cache_db, backend, direct_vdi,
+                          volume_workers, pipeline, max_vms, max_hashers, max_ram, max_cpus, max_scratch, block_db,
+                          journal, output_format, None if compression == "none" else compression, changed_blocks,
+                          physical_order)
+    finally:
+        journal.close()
+        utils.set_command_runner(None)
+        runner.close()
+        metrics.close()
+
+
+def setup_metrics(result_dir, metrics_file=None, worker=None):
+    """
+    Records the metrics of this run to metrics_file, by default to a file named after the run in RESULT_DIR/metrics.
+
+    :param worker: name of the farm worker, which is appended to the default file name
+    :return: label of the run
+    """
+    run = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H%M%S")
+
+    if not metrics_file:
+        metrics_dir = os.path.join(result_dir, "metrics")
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics_file = os.path.join(metrics_dir, f"{run}-{worker}.jsonl" if worker else f"{run}.jsonl")
+
+    metrics.configure(metrics_file, run)
+
+    return run
+
+
+def process_boxes(box_dir, result_dir, interactive, hasher, workers, cache_db, backend, direct_vdi, volume_workers,
+                  pipeline, max_vms, max_hashers, max_ram, max_cpus, max_scratch, block_db=None, journal=None,
+                  output_format="md5sum", compression=None, changed_blocks=False, physical_order=False):
+    vfiles = find_vagrantfiles(box_dir)
+
+    logger.info(f"Found {len(vfiles)} vagrantfiles")
+
+    if journal is not None:
+        done = journal.done_boxes()
+        vfiles = [vf for vf in vfiles if PipelineScheduler.box_name(vf) not in done]
+        if done:
+            logger.info(f"Skipping boxes completed by a previous run, {len(vfiles)} boxes left")
+
+    hash_options = dict(result_dir=result_dir, hasher=hasher, workers=workers, cache_db=cache_db, backend=backend,
+                        direct_vdi=direct_vdi, volume_workers=volume_workers, block_db=block_db,
+                        output_format=output_format, compression=compression, changed_blocks=changed_blocks,
+                        physical_order=physical_order)
+
+    if pipeline:
+        # Overlap VM runtime of the next boxes with hashing of the previous ones
+        resources = ResourcePool(ram=max_ram, cpus=max_cpus, scratch=max_scratch * 1024 ** 3 if max_scratch else None)
+
+        def vm_stage(vf, reserve_scratch):
+            return run_journaled_vm_stage(vf, journal, direct_vdi=direct_vdi, reserve_scratch=reserve_scratch)
+
+        def hash_stage(vf, vm_result):
+            # Every image gets its own mount directory, as several images may be mounted at the same time
+            mount_parent = os.path.join("/tmp", f"hashlab_{vm_result[0]}")
+            run_journaled_hash_stage(vf, vm_result, journal, mount_parent=mount_parent, **hash_options)
+
+        scheduler = PipelineScheduler(vm_stage, hash_stage, get_virtualbox_vm_resources, resources, max_vms,
+                                      max_hashers)
+        scheduler.run(vfiles)
+        return
+
+    # Process all vagrant boxes
+    for vf in vfiles:
+        # Attributes log messages and metrics to the box
+        with box_context(PipelineScheduler.box_name(vf)):
+            vm_result = run_journaled_vm_stage(vf, journal, interactive, direct_vdi)
+            run_journaled_hash_stage(vf, vm_result, journal, **hash_options)
+
+
+def run_farm(farm_db, farm_workers, box_dir, hash_options, log_with_time=False, metrics_file=None, max_commands=8,
+             command_timeout=None):
+    """
+    Adds the boxes of box_dir to the job queue of the farm and processes the queue with local worker processes. Boxes
+    known to the queue already are not added again, so every host of the farm can be started the same way.
+
+    :param farm_db: path to the job queue database
+    :param farm_workers: number of worker processes on this host
+    :param box_dir: directory of the vagrantfiles
+    :param hash_options: see run_hash_stage
+    """
+    queue = JobQueue(farm_db)
+    try:
+        added = sum(queue.add(PipelineScheduler.box_name(vf), vf) for vf in find_vagrantfiles(box_dir))
+        logger.info(f"Added {added} boxes to the job queue {farm_db}, starting {farm_workers} workers")
+    finally:
+        queue.close()
+
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=run_farm_worker, args=(farm_db, hash_options, log_with_time, metrics_file,
+                                                           max_commands, command_timeout))
+                 for _ in range(farm_workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    queue = JobQueue(farm_db)
+    try:
+        counts = queue.counts()
+    finally:
+        queue.close()
+    logger.info(f"Job queue {farm_db}: {', '.join(f'{n} {status}' for status, n in sorted(counts.items()))}")
+
+
+def run_farm_worker(farm_db, hash_options, log_with_time=False, metrics_file=None, max_commands=8,
+                    command_timeout=None):
+    """
+    Entry point of a worker process of the farm: claims boxes from the job queue, until it is drained.
+    """
+    setup_logging(log_with_time)
+    name = worker_name()
+    setup_metrics(hash_options["result_dir"], metrics_file, name)
+    runner = CommandRunner(max_commands)
+    utils.set_command_runner(runner, command_timeout)
+    queue = JobQueue(farm_db)
+
+    try:
+        with metrics.stage("farm_worker", worker=name) as s:
+            s.add(files=FarmWorker(queue, lambda job: run_farm_job(job, queue, hash_options), name).run())
+    finally:
+        queue.close()
+        utils.set_command_runner(None)
+        runner.close()
+        metrics.close()
+
+
+def run_farm_job(job, queue, hash_options):
+    """
+    Processes a box claimed from the job queue. The VM stage of an earlier attempt on the same host is taken over, if
+    its image is still there.
+
+    :param job: farm.Job
+    :param queue: JobQueue, the stages of the box are recorded in
+    :param hash_options: see run_hash_stage
+    """
+    vf = job.vagrantfile
+    direct_vdi = hash_options.get("direct_vdi", False)
+    vm = job.data.get("vm")
+
+    with box_context(job.box):
+        if vm and vm["host"] == socket.gethostname() and (direct_vdi or os.path.exists(vm["disk_fp"])):
+            logger.info(f"VM stage was completed by a previous attempt, continuing with {vm['disk_fp']}")
+            vm_result = vm["vm_name"], vm["disk_fp"], vm["is_cumulate"]
+        else:
+            vm_result = run_journaled_vm_stage(vf, None, direct_vdi=direct_vdi)
+            vm_name, disk_fp, is_cumulate = vm_result
+            job = queue.set_stage(job, "hash", vm=dict(host=socket.gethostname(), vm_name=vm_name, disk_fp=disk_fp,
+                                                       is_cumulate=is_cumulate))
+
+        # Several workers of a host hash at the same time, so every image gets its own mount directory
+        mount_parent = os.path.join("/tmp", f"hashlab_{vm_result[0]}")
+        run_journaled_hash_stage(vf, vm_result, None, mount_parent=mount_parent, **hash_options)
+
+
+def run_journaled_vm_stage(vf, journal, interactive=False, direct_vdi=False, reserve_scratch=None):
+    """
+    Runs the VM stage of a box and records it in the journal. If a previous run completed the VM stage and its image
+    is still there, the image is taken over instead. Otherwise all steps recorded for the box are discarded, as the
+    VM is brought up again and its disk changes.
+
+    :param vf: abs path to vagrantfile
+    :param journal: RunJournal or None
+    :return: vm_name, disk_fp, is_cumulate
+    """
+    if journal is None:
+        with metrics.stage("vm_stage"):
+            return run_vm_stage(vf, interactive, direct_vdi, reserve_scratch)
+
+    box_journal = journal.for_box(PipelineScheduler.box_name(vf))
+    record = box_journal.get("vm")
+
+    if record is not None and record["status"] == "done":
+        if direct_vdi or os.path.exists(record["disk_fp"]):
+            logger.info(f"VM stage was completed by a previous run, continuing with {record['disk_fp']}")
+            if reserve_scratch and not direct_vdi:
+                reserve_scratch(sparse.allocated_size(record["disk_fp"]))
+            return record["vm_name"], record["disk_fp"], record["is_cumulate"]
+
+        logger.info(f"Image {record['disk_fp']} of a previous run is gone, starting the box from scratch")
+        box_journal.reset()
+
+    with box_journal.step("vm") as data, metrics.stage("vm_stage"):
+        vm_name, disk_fp, is_cumulate = run_vm_stage(vf, interactive, direct_vdi, reserve_scratch)
+        data.update(vm_name=vm_name, disk_fp=disk_fp, is_cumulate=is_cumulate)
+
+    return vm_name, disk_fp, is_cumulate
+
+
+def run_journaled_hash_stage(vf, vm_result, journal, **hash_options):
+    """
+    Runs the hash stage of a box, volumes hashed by a previous run are skipped. Once it is done, the box is recorded
+    as completed.
+
+    :param vf: abs path to vagrantfile
+    :param vm_result: vm_name, disk_fp, is_cumulate as returned by the VM stage
+    :param journal: RunJournal or None
+    :param hash_options: see run_hash_stage
+    """
+    vm_name, disk_fp, is_cumulate = vm_result
+
+    if journal is None:
+        with metrics.stage("hash_stage"):
+            run_hash_stage(vf, disk_fp, is_cumulate, **hash_options)
+        return
+
+    box_journal = journal.for_box(PipelineScheduler.box_name(vf))
+
+    with box_journal.step("box"), metrics.stage("hash_stage"):
+        run_hash_stage(vf, disk_fp, is_cumulate, journal=box_journal, **hash_options)
 
 
 def setup_logging(log_with_time=False):
     logger.setLevel(logging.INFO)
     console_log = logging.StreamHandler()
+    # Prefixes messages with the box they belong to, when boxes are processed concurrently
+    console_log.addFilter(BoxLogFilter())
 
     if log_with_time:
-        formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(funcName)-30s %(message)s')
-        console_log.setFormatter(formatter)
+        formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(funcName)-30s %(box)s%(message)s')
+    else:
+        formatter = logging.Formatter('%(box)s%(message)s')
+    console_log.setFormatter(formatter)
 
     console_log.setLevel(logging.INFO)
     logger.addHandler(console_log)
@@ -210,16 +667,84 @@ def parse_args():
     parser.add_argument('--interactive', help='Pause after vagrant up to interactively/manualy modify VM',
                         action='store_true')
     parser.add_argument('--time', help='Log with timestamps', action='store_true')
-
-    return parser.parse_args()
+    parser.add_argument('--hasher', choices=["builtin", "hashrat"], default="builtin",
+                        help="Hashing backend. 'builtin' hashes in-process with a pool of workers, 'hashrat' calls the external hashrat binary.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Number of worker threads of the builtin hasher (default: number of CPUs).")
+    parser.add_argument('--cache-db', type=str, default=None,
+                        help="Path to the digest cache used for incremental hashing of cumulating boxes (default: RESULT_DIR/.hashlab_cache.sqlite).")
+    parser.add_argument('--backend', choices=["mount", "raw"], default="mount",
+                        help="How volumes are accessed. 'mount' mounts the image with imagemounter (requires root), 'raw' reads the file systems straight from the image with the sleuthkit.")
+
+    parser.add_argument('--direct-vdi', action='store_true',
+                        help="Read the VDI of the VM in place instead of cloning it to a raw image first. Requires --backend raw.")
+
+    parser.add_argument('--volume-workers', type=int, default=1,
+                        help="Number of volumes of an image hashed concurrently.")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Process boxes in a pipeline, so that VMs of the next boxes run while the previous ones are hashed.")
+    parser.add_argument('--max-vms', type=int, default=1,
+                        help="Number of VMs running at the same time in pipeline mode.")
+    parser.add_argument('--max-hashers', type=int, default=1,
+                        help="Number of images hashed at the same time in pipeline mode.")
+    parser.add_argument('--max-ram', type=int, default=None,
+                        help="Memory in MB, which the running VMs may use in total in pipeline mode.")
+    parser.add_argument('--max-cpus', type=int, default=None,
+                        help="Number of CPUs, which the running VMs may use in total in pipeline mode.")
+    parser.add_argument('--max-scratch', type=int, default=None,
+                        help="Scratch space in GB, which the cloned images may use in total in pipeline mode.")
+    parser.add_argument('--max-commands', type=int, default=8,
+                        help="Number of external commands like VBoxManage or hashrat running at the same time.")
+    parser.add_argument('--command-timeout', type=int, default=None,
+                        help="Timeout in seconds, after which short control commands like VBoxManage showvminfo or umount are killed. Cloning and hashing are not timed out (default: no timeout).")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="File to record the duration, bytes processed and exit status of every stage and command to, as JSON lines (default: RESULT_DIR/metrics/<datetime of the run>.jsonl).")
+    parser.add_argument('--changed-blocks', action='store_true',
+                        help="Re-read only the files of cumulating boxes, whose data lies in disk blocks written since the previous run according to the block maps of the differencing VDIs. Requires --backend raw.")
+    parser.add_argument('--physical-order', action='store_true',
+                        help="Hash the files of each volume ascending by the disk offset of their data (FIEMAP/FIBMAP when mounted, the file system's data runs with --backend raw) with read-ahead, instead of directory order. The hash lists are written in that order.")
+    parser.add_argument('--output-format', choices=["md5sum", "jsonl", "columnar"], default="md5sum",
+                        help="Format of the hash lists. 'md5sum' is the format of hashrat -trad, 'jsonl' holds MD5, SHA-1, SHA-256, size and mtime of each file as JSON lines, 'columnar' stores the same fields column by column in binary blocks.")
+    parser.add_argument('--compression', choices=["none", "gzip", "zstd"], default="none",
+                        help="Compression of the hash lists, zstd requires the zstandard package.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue an interrupted run: boxes completed according to RESULT_DIR/journal.jsonl are skipped, images cloned already are reused and only volumes not hashed yet are hashed.")
+    parser.add_argument('--block-db', type=str, default=None,
+                        help="Directory to write a sorted store of the hashes of all non-constant 4 KiB blocks of every raw image to, one BOX.blk per box (requires the cloned .dd, not --direct-vdi).")
+    parser.add_argument('--farm-db', type=str, default=None,
+                        help="Farm mode: add the boxes to the job queue in this SQLite database and process it with --farm-workers worker processes. Workers on other hosts sharing the database and the box directory claim boxes from the same queue, boxes of workers, which stopped sending heartbeats, are handed out again.")
+    parser.add_argument('--farm-workers', type=int, default=1,
+                        help="Number of worker processes of this host in farm mode.")
+
+    args = parser.parse_args()
+
+    if args.backend == "raw" and args.hasher == "hashrat":
+        parser.error("--hasher hashrat requires --backend mount")
+    if args.direct_vdi and args.backend != "raw":
+        parser.error("--direct-vdi requires --backend raw")
+    if args.compression == "zstd" and hashlist.zstandard is None:
+        parser.error("--compression zstd requires the zstandard package")
+    if args.changed_blocks and args.backend != "raw":
+        parser.error("--changed-blocks requires --backend raw")
+    if args.physical_order and args.hasher == "hashrat":
+        parser.error("--physical-order requires --hasher builtin")
+    if args.block_db and args.direct_vdi:
+        parser.error("--block-db requires the raw image, it cannot be combined with --direct-vdi")
+    if args.farm_db and (args.pipeline or args.interactive or args.resume):
+        parser.error("--farm-db cannot be combined with --pipeline, --interactive or --resume, the job queue keeps track of the boxes itself")
+    if args.pipeline and args.interactive:
+        parser.error("--interactive cannot be combined with --pipeline")
+
+    return args
 
 
 if __name__ == '__main__':
     # Example call:
     # sudo venv/bin/python3.7 hashlab.py --box-dir /home/user01/boxes --result-dir /home/user01/Desktop/
 
+    args = parse_args()
+
     # Note sudo is needed for image mounting!
-    if os.geteuid() != 0:
+    if args.backend == "mount" and os.geteuid() != 0:
         exit("[!] You need to have root privileges to run this script.\n[+] Please try again, 'sudo'. Exiting.")
-    args = parse_args()
     main(**vars(args))
@@ -0,0 +1,387 @@
+import io
+import os
+import re
+import gzip
+import json
+import struct
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed for zstd compressed hash lists
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Result files are named "{datetime}_{img}_{vol}", volume labels start with the index imagemounter assigned
+# Suffixes of hash lists derived from a full one, like the delta of incremental runs or diffs between runs
+DERIVED_SUFFIXES = ("_delta", "_added", "_removed", "_changed")
+
+RESULT_NAME_PATTERN = re.compile(r"^(?P<run>\d{4}-\d{2}-\d{2}T\d{4})_(?P<box>.+?)_(?P<volume>\d[\d.]*-.*?|[^_]+)$")
+
+# Output formats and the extensions of their files, md5sum is the format of hashrat -trad
+FORMAT_EXTENSIONS = {"md5sum": "", "jsonl": ".jsonl", "columnar": ".hlc"}
+COMPRESSION_EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+COLUMNAR_MAGIC = b"HLCOLv1\n"
+# Number of records, number of bytes of all paths, flags of the optional columns
+COLUMNAR_BLOCK_HEADER = struct.Struct("<IIB")
+COLUMNAR_SHA1 = 1
+COLUMNAR_SHA256 = 2
+# Number of records per block of the columnar format, which bounds the memory of writer and reader
+COLUMNAR_BLOCK_SIZE = 65536
+
+
+def format_md5sum(md5, path):
+    """
+    Formats a single record like md5sum and hashrat -trad do.
+
+    :param md5: hex digest
+    :param path: file path
+    :return: line including the trailing newline
+    """
+    return f"{md5}  {path}\n"
+
+
+def parse_md5sum_line(line):
+    """
+    Splits a record in the format of md5sum.
+
+    :param line: record with or without line ending
+    :return: md5, path or None, if the line is no valid record
+    """
+    line = line.rstrip("\n")
+
+    if len(line) < 35 or line[32:34] != "  ":
+        return None
+
+    return line[:32].lower(), line[34:]
+
+
+def hashlist_file_name(path, output_format="md5sum", compression=None):
+    """
+    Appends the extensions of a format and compression to the path of a hash list.
+    """
+    return path + FORMAT_EXTENSIONS[output_format] + COMPRESSION_EXTENSIONS[compression]
+
+
+def split_extensions(path):
+    """
+    Determines format and compression of a hash list by its extensions.
+
+    :param path: path to the hash list
+    :return: path without the extensions, output format, compression
+    """
+    compression = next((c for c, ext in COMPRESSION_EXTENSIONS.items() if ext and path.endswith(ext)), None)
+    path = path[:len(path) - len(COMPRESSION_EXTENSIONS[compression])]
+    output_format = next((f for f, ext in FORMAT_EXTENSIONS.items() if ext and path.endswith(ext)), "md5sum")
+    path = path[:len(path) - len(FORMAT_EXTENSIONS[output_format])]
+
+    return path, output_format, compression
+
+
+def _open_binary(path, mode, compression):
+    """
+    Opens a file, which is compressed or decompressed on the fly while it is streamed.
+    """
+    if compression == "gzip":
+        return gzip.open(path, mode)
+
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compressed hash lists require zstandard")
+        f = open(path, mode)
+        if "w" in mode:
+            return zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+
+    return open(path, mode)
+
+
+def _open_text(path, mode, compression):
+    # surrogateescape allows undecodable file names to round trip unchanged
+    if compression is None:
+        # Line buffered, so an interrupted run leaves a valid, albeit partial, hash list behind
+        return open(path, mode, buffering=1 if "w" in mode else -1, encoding="utf-8", errors="surrogateescape")
+
+    return io.TextIOWrapper(_open_binary(path, mode + "b", compression), encoding="utf-8", errors="surrogateescape")
+
+
+def _encode_path(path):
+    return path.encode("utf-8", "surrogateescape")
+
+
+class _Md5sumEncoder:
+    def __init__(self, path, compression):
+        self._f = _open_text(path, "w", compression)
+
+    def write_line(self, line):
+        self._f.write(line)
+
+    def write(self, md5, path, size=None, mtime=None, sha1=None, sha256=None):
+        self._f.write(format_md5sum(md5, path))
+
+    def close(self):
+        self._f.close()
+
+
+class _JsonlEncoder(_Md5sumEncoder):
+    """
+    One JSON object per file. Digests and metadata, which are unknown, e.g. because hashrat only reports MD5, are
+    left out.
+    """
+
+    def write_line(self, line):
+        record = parse_md5sum_line(line)
+        if record:
+            self.write(*record)
+
+    def write(self, md5, path, size=None, mtime=None, sha1=None, sha256=None):
+        record = {"md5": md5, "path": path, "size": size, "mtime": mtime, "sha1": sha1, "sha256": sha256}
+        # ensure_ascii keeps undecodable file names, which are surrogate escaped, valid JSON
+        self._f.write(json.dumps({k: v for k, v in record.items() if v is not None}) + "\n")
+
+
+class _ColumnarEncoder:
+    """
+    Binary layout storing each field of a block of records contiguously: raw MD5 digests, sizes, mtimes, path lengths
+    and the concatenated paths, followed by SHA-1 and SHA-256 digests, if the block has them. Unknown sizes are stored
+    as -1, unknown mtimes as NaN. Loaders read whole columns with a single unpack instead of parsing every line.
+    """
+
+    def __init__(self, path, compression):
+        self._f = _open_binary(path, "wb", compression)
+        self._f.write(COLUMNAR_MAGIC)
+        self._block = []
+
+    def write_line(self, line):
+        record = parse_md5sum_line(line)
+        if record:
+            self.write(*record)
+
+    def write(self, md5, path, size=None, mtime=None, sha1=None, sha256=None):
+        self._block.append((md5, path, size, mtime, sha1, sha256))
+
+        if len(self._block) >= COLUMNAR_BLOCK_SIZE:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._block:
+            return
+
+        md5s, paths, sizes, mtimes, sha1s, sha256s = zip(*self._block)
+        n = len(self._block)
+        paths = [_encode_path(p) for p in paths]
+        flags = (COLUMNAR_SHA1 if any(sha1s) else 0) | (COLUMNAR_SHA256 if any(sha256s) else 0)
+
+        self._f.write(COLUMNAR_BLOCK_HEADER.pack(n, sum(len(p) for p in paths), flags))
+        self._f.write(b"".join(bytes.fromhex(d) for d in md5s))
+        self._f.write(struct.pack(f"<{n}q", *(-1 if s is None else s for s in sizes)))
+        self._f.write(struct.pack(f"<{n}d", *(float("nan") if t is None else t for t in mtimes)))
+        self._f.write(struct.pack(f"<{n}I", *(len(p) for p in paths)))
+        self._f.write(b"".join(paths))
+        if flags & COLUMNAR_SHA1:
+            self._f.write(b"".join(bytes.fromhex(d) if d else bytes(20) for d in sha1s))
+        if flags & COLUMNAR_SHA256:
+            self._f.write(b"".join(bytes.fromhex(d) if d else bytes(32) for d in sha256s))
+
+        self._block = []
+
+    def close(self):
+        self._flush_block()
+        self._f.close()
+
+
+ENCODERS = {"md5sum": _Md5sumEncoder, "jsonl": _JsonlEncoder, "columnar": _ColumnarEncoder}
+
+
+def _read_exactly(f, size):
+    data = f.read(size)
+    while len(data) < size:
+        chunk = f.read(size - len(data))
+        if not chunk:
+            raise EOFError("Truncated columnar hash list")
+        data += chunk
+    return data
+
+
+def read_columnar(path, compression=None):
+    """
+    Reads a hash list in the columnar format block by block.
+
+    :param path: path to the hash list
+    :param compression: None, "gzip" or "zstd"
+    :return: generator of dicts with md5, path, size, mtime, sha1 and sha256, unknown values are None
+    """
+    with _open_binary(path, "rb", compression) as f:
+        if _read_exactly(f, len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError(f"{path} is no columnar hash list")
+
+        while True:
+            header = f.read(COLUMNAR_BLOCK_HEADER.size)
+            if not header:
+                break
+            header += _read_exactly(f, COLUMNAR_BLOCK_HEADER.size - len(header)) \
+                if len(header) < COLUMNAR_BLOCK_HEADER.size else b""
+
+            n, paths_size, flags = COLUMNAR_BLOCK_HEADER.unpack(header)
+            md5s = _read_exactly(f, 16 * n)
+            sizes = struct.unpack(f"<{n}q", _read_exactly(f, 8 * n))
+            mtimes = struct.unpack(f"<{n}d", _read_exactly(f, 8 * n))
+            lengths = struct.unpack(f"<{n}I", _read_exactly(f, 4 * n))
+            paths = _read_exactly(f, paths_size)
+            sha1s = _read_exactly(f, 20 * n) if flags & COLUMNAR_SHA1 else None
+            sha256s = _read_exactly(f, 32 * n) if flags & COLUMNAR_SHA256 else None
+            offset = 0
+
+            for i in range(n):
+                path_i = paths[offset:offset + lengths[i]].decode("utf-8", "surrogateescape")
+                offset += lengths[i]
+                yield {"md5": md5s[16 * i:16 * (i + 1)].hex(), "path": path_i,
+                       "size": None if sizes[i] < 0 else sizes[i],
+                       "mtime": None if mtimes[i] != mtimes[i] else mtimes[i],
+                       "sha1": sha1s[20 * i:20 * (i + 1)].hex() if sha1s else None,
+                       "sha256": sha256s[32 * i:32 * (i + 1)].hex() if sha256s else None}
+
+
+def read_records(path):
+    """
+    Reads a hash list of any of the output formats record by record. The format is determined by the extensions of
+    the file. Invalid lines are skipped.
+
+    :param path: path to the hash list
+    :return: generator of dicts with at least md5 and path
+    """
+    _, output_format, compression = split_extensions(path)
+
+    if output_format == "columnar":
+        yield from read_columnar(path, compression)
+        return
+
+    with _open_text(path, "r", compression) as f:
+        for line in f:
+            if output_format == "jsonl":
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+            else:
+                record = parse_md5sum_line(line)
+                if record:
+                    yield {"md5": record[0], "path": record[1]}
+
+
+def read_hashlist(path):
+    """
+    Reads a hash list record by record. Besides the format of md5sum, all other output formats are understood as well.
+    Invalid lines are skipped.
+
+    :param path: path to the hash list
+    :return: generator of (md5, path)
+    """
+    if split_extensions(path)[1:] == ("md5sum", None):
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            for line in f:
+                record = parse_md5sum_line(line)
+                if record:
+                    yield record
+        return
+
+    for record in read_records(path):
+        yield record["md5"], record["path"]
+
+
+def parse_result_name(result_path):
+    """
+    Parses the name of a result file written by DiskProcessor.
+
+    :param result_path: path to the result file, the extensions of its format are ignored
+    :return: run, box, volume or None, if the name does not match
+    """
+    match = RESULT_NAME_PATTERN.match(split_extensions(os.path.basename(result_path))[0])
+
+    if match:
+        return match.group("run"), match.group("box"), match.group("volume")
+
+    return None
+
+
+def find_hashlists(result_dir):
+    """
+    Lists the full hash lists in a result directory. Derived hash lists and other files are left out.
+
+    :param result_dir: path to the result directory
+    :return: sorted list of paths
+    """
+    return sorted(os.path.join(result_dir, name) for name in os.listdir(result_dir)
+                  if not split_extensions(name)[0].endswith(DERIVED_SUFFIXES) and parse_result_name(name) is not None
+                  and os.path.isfile(os.path.join(result_dir, name)))
+
+
+class HashlistWriter:
+    """
+    Writes a hash list record by record through a streaming encoder, so memory use does not depend on the number of
+    records. Uncompressed text formats are line buffered, so every record is on disk as soon as it is written and an
+    interrupted run leaves a valid, albeit partial, hash list behind. Compressed files are readable up to the point of
+    an interruption.
+
+    Formats:
+
+    - md5sum: "{md5}  {path}" like md5sum and hashrat -trad, the default
+    - jsonl: one JSON object per file with all digests, the size and the mtime
+    - columnar: blocks of records stored column by column, see _ColumnarEncoder
+    """
+
+    def __init__(self, path, output_format="md5sum", compression=None):
+        """
+        :param path: path of the hash list to create, the extensions of format and compression are appended
+        :param output_format: "md5sum", "jsonl" or "columnar"
+        :param compression: None, "gzip" or "zstd"
+        """
+        self.path = hashlist_file_name(path, output_format, compression)
+        self.output_format = output_format
+        self.compression = compression
+        self.count = 0
+        self._encoder = None
+
+    def __enter__(self):
+        self._encoder = ENCODERS[self.output_format](self.path, self.compression)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._encoder.close()
+        logger.info(f"Wrote {self.count} records to {self.path}")
+
+    def write_line(self, line):
+        """
+        Writes an already formatted record in the format of md5sum, other formats parse it.
+
+        :param line: record including its line ending
+        """
+        self._encoder.write_line(line)
+        self.count += 1
+
+    def write(self, md5, path, size=None, mtime=None, sha1=None, sha256=None):
+        """
+        Writes a record. Only the structured formats store more than MD5 and path.
+
+        :param md5: hex digest
+        :param path: file path
+        :param size: size in bytes
+        :param mtime: modification time as seconds since the epoch
+        :param sha1: hex digest
+        :param sha256: hex digest
+        """
+        self._encoder.write(md5, path, size, mtime, sha1, sha256)
+        self.count += 1
+
+    def write_digest(self, digest, path=None):
+        """
+        Writes a FileDigest.
+
+        :param digest: FileDigest
+        :param path: path to record instead of the one of the digest
+        """
+        self.write(digest.md5, path if path is not None else digest.path, digest.size, digest.mtime, digest.sha1,
+                   digest.sha256)
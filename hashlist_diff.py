@@ -0,0 +1,87 @@
+import logging
+
+from external_sort import external_sort, RUN_SIZE
+from hashlist import HashlistWriter, read_hashlist, parse_result_name, find_hashlists, split_extensions
+
+logger = logging.getLogger(__name__)
+
+
+def _sorted_records(hashlist_path, run_size, tmp_dir):
+    """
+    Yields the records of a hash list of any output format sorted by path, using an external sort.
+    """
+    lines = (f"{path}\0{md5}\n" for md5, path in read_hashlist(hashlist_path))
+
+    for line in external_sort(lines, run_size=run_size, tmp_dir=tmp_dir):
+        path, md5 = line.rstrip("\n").split("\0")
+        yield path, md5
+
+
+def diff_hashlists(old_path, new_path, out_prefix, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Compares two hash lists of the same box and volume. Both are sorted by path with an external sort and compared
+    with a streaming merge, so memory use does not depend on their size. Three hash lists are written:
+
+    - {out_prefix}_added: files only contained in the new hash list
+    - {out_prefix}_removed: files only contained in the old hash list
+    - {out_prefix}_changed: files contained in both with a different hash, as recorded in the new hash list
+
+    :param old_path: path to the hash list of the earlier run
+    :param new_path: path to the hash list of the later run
+    :param out_prefix: prefix of the resulting hash lists
+    :param run_size: number of records sorted in memory at once
+    :param tmp_dir: directory for temporary files
+    :return: dict with the number of added, removed and changed records
+    """
+    old = _sorted_records(old_path, run_size, tmp_dir)
+    new = _sorted_records(new_path, run_size, tmp_dir)
+
+    with HashlistWriter(f"{out_prefix}_added") as added, HashlistWriter(f"{out_prefix}_removed") as removed, \
+            HashlistWriter(f"{out_prefix}_changed") as changed:
+        old_record = next(old, None)
+        new_record = next(new, None)
+
+        while old_record or new_record:
+            if new_record is None or (old_record is not None and old_record[0] < new_record[0]):
+                removed.write(old_record[1], old_record[0])
+                old_record = next(old, None)
+            elif old_record is None or new_record[0] < old_record[0]:
+                added.write(new_record[1], new_record[0])
+                new_record = next(new, None)
+            else:
+                if old_record[1] != new_record[1]:
+                    changed.write(new_record[1], new_record[0])
+                old_record = next(old, None)
+                new_record = next(new, None)
+
+        counts = {"added": added.count, "removed": removed.count, "changed": changed.count}
+
+    logger.info(f"Diff of {old_path} and {new_path}: {counts['added']} added, {counts['removed']} removed, "
+                f"{counts['changed']} changed")
+
+    return counts
+
+
+def find_latest_runs(result_dir, box, volume):
+    """
+    Finds the hash lists of the two most recent runs of a box and volume in a result directory.
+
+    :return: old_path, new_path
+    """
+    paths = [p for p in find_hashlists(result_dir) if parse_result_name(p)[1:] == (box, volume)]
+
+    if len(paths) < 2:
+        raise FileNotFoundError(f"Less than two runs of {box}/{volume} in {result_dir}")
+
+    # The names start with the datetime of the run, so the sort order is chronological
+    return paths[-2], paths[-1]
+
+
+def diff_latest_runs(result_dir, box, volume, out_prefix=None, run_size=RUN_SIZE, tmp_dir=None):
+    """
+    Compares the two most recent runs of a box and volume, see diff_hashlists. The resulting hash lists are stored
+    next to the newer one, unless out_prefix is given.
+    """
+    old_path, new_path = find_latest_runs(result_dir, box, volume)
+
+    return diff_hashlists(old_path, new_path, out_prefix or split_extensions(new_path)[0], run_size, tmp_dir)
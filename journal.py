@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Name of the journal in the result directory
+JOURNAL_FILE = "journal.jsonl"
+
+
+class RunJournal:
+    """
+    Records the progress of a run, so an interrupted run can be resumed. The journal is a file of JSON lines, one per
+    step of a box: when it was started, done or failed and the result files it wrote. Every line is flushed and synced
+    right away, so a killed process or a full disk leaves a consistent journal behind.
+
+    Every run appends to the same journal. A run, which is not resumed, starts from scratch and ignores all earlier
+    records, a resumed run continues from the state recorded since the last run, which was not resumed.
+    """
+
+    def __init__(self, path, run=None, resume=False):
+        """
+        Creates a RunJournal
+
+        :param path: path of the journal
+        :param run: label of the run, which is added to every record
+        :param resume: if set, the steps recorded by the previous runs are taken over
+        """
+        self.path = path
+        self.run = run
+        self._lock = threading.Lock()
+        # Latest record of each (box, step, volume)
+        self._steps = {}
+
+        if resume and os.path.isfile(path):
+            self._load()
+
+        self._f = open(path, "a", buffering=1, encoding="utf-8")
+        self._write({"step": "run", "status": "started", "resume": resume})
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a journal may be cut off
+                    logger.debug(f"Skipping invalid line of {self.path}")
+                    continue
+
+                if record.get("step") == "run":
+                    if not record.get("resume"):
+                        self._steps.clear()
+                    continue
+
+                if record.get("step") == "reset":
+                    self._clear_box(record.get("box"))
+                    continue
+
+                self._steps[(record.get("box"), record.get("step"), record.get("volume"))] = record
+
+        logger.info(f"Resuming from {self.path}: {len(self.done_boxes())} boxes done")
+
+    def _write(self, record):
+        with self._lock:
+            self._f.write(json.dumps(dict(run=self.run, time=time.time(), **record)) + "\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+            if "box" in record:
+                self._steps[(record["box"], record["step"], record.get("volume"))] = record
+
+    def _clear_box(self, box):
+        for key in [k for k in self._steps if k[0] == box]:
+            del self._steps[key]
+
+    def close(self):
+        self._f.close()
+
+    def get(self, box, step, volume=None):
+        """
+        Returns the latest record of a step or None.
+        """
+        with self._lock:
+            return self._steps.get((box, step, volume))
+
+    def is_done(self, box, step, volume=None):
+        record = self.get(box, step, volume)
+        return record is not None and record["status"] == "done"
+
+    def done_boxes(self):
+        with self._lock:
+            return {box for (box, step, _), r in self._steps.items() if step == "box" and r["status"] == "done"}
+
+    def _discard_unfinished(self, record):
+        """
+        Removes the result files of a step, which was started, but not done, so no partial results are left behind.
+        """
+        for path in record.get("files") or []:
+            if os.path.exists(path):
+                logger.info(f"Removing partial result {path}")
+                os.remove(path)
+
+    @contextmanager
+    def step(self, box, step, volume=None, files=()):
+        """
+        Records a step, which is done, if the block completes without an exception. Values added to the yielded dict
+        are recorded along with the completion, e.g. what later steps need to resume.
+
+        :param box: name of the box
+        :param step: name of the step
+        :param volume: label of the volume for steps, which are recorded per volume
+        :param files: result files, which the step writes; they are removed, when an unfinished step is retried
+        """
+        previous = self.get(box, step, volume)
+        if previous is not None and previous["status"] != "done":
+            self._discard_unfinished(previous)
+
+        key = dict(box=box, step=step) if volume is None else dict(box=box, step=step, volume=volume)
+        self._write(dict(key, status="started", files=list(files)))
+        data = {}
+
+        try:
+            yield data
+        except BaseException as e:
+            self._write(dict(key, status="failed", error=repr(e), files=list(files)))
+            raise
+
+        self._write(dict(key, status="done", files=[p for p in files if os.path.exists(p)], **data))
+
+    def reset(self, box):
+        """
+        Discards all steps of a box recorded so far, e.g. because its image has to be created again.
+        """
+        self._write({"box": box, "step": "reset", "status": "done"})
+        with self._lock:
+            self._clear_box(box)
+
+    def for_box(self, box):
+        return BoxJournal(self, box)
+
+
+class BoxJournal:
+    """
+    View on the journal for the steps of a single box, which is handed to the disk processors.
+    """
+
+    def __init__(self, journal, box):
+        self.journal = journal
+        self.box = box
+
+    def get(self, step, volume=None):
+        return self.journal.get(self.box, step, volume)
+
+    def is_done(self, step, volume=None):
+        return self.journal.is_done(self.box, step, volume)
+
+    def step(self, step, volume=None, files=()):
+        return self.journal.step(self.box, step, volume, files)
+
+    def reset(self):
+        self.journal.reset(self.box)
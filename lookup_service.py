@@ -0,0 +1,293 @@
+import re
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Number of lookups kept in the LRU cache
+CACHE_SIZE = 100000
+
+# Number of requests, whose latencies the percentiles are computed from
+LATENCY_WINDOW = 100000
+
+# Largest accepted request body
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+MD5_PATTERN = re.compile(r"^[0-9a-fA-F]{32}$")
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LatencyStats:
+    """
+    Latencies of the latest requests, from which percentiles are computed on demand.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+        self._latencies.append(seconds)
+        self.count += 1
+
+    def percentiles(self, ps=(50, 90, 99, 99.9)):
+        """
+        :return: dict mapping "p50" and so on to milliseconds, empty without requests
+        """
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return {}
+
+        result = {f"p{p:g}": latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000 for p in ps}
+        result["max"] = latencies[-1] * 1000
+        return result
+
+
+class LookupService:
+    """
+    Looks up MD5 digests in a WhitelistStore and keeps the results of the most recent lookups, known and unknown ones,
+    in an LRU cache. Batches are checked against the store with a single vectorized pass first, so only the known
+    digests of a batch are resolved to their paths and sources.
+    """
+
+    def __init__(self, store, cache_size=CACHE_SIZE):
+        """
+        :param store: WhitelistStore
+        :param cache_size: number of digests kept in the cache
+        """
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(md5):
+        if not isinstance(md5, str) or not MD5_PATTERN.match(md5):
+            raise HTTPError(400, f"Invalid MD5 digest: {md5!r}")
+        return md5.lower()
+
+    def _cached(self, md5):
+        matches = self._cache.get(md5)
+
+        if matches is None:
+            self.misses += 1
+            return None
+
+        self._cache.move_to_end(md5)
+        self.hits += 1
+        return matches
+
+    def _remember(self, md5, matches):
+        self._cache[md5] = matches
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def lookup(self, md5):
+        """
+        Looks up a single hex digest.
+
+        :return: dict with md5, known and the matches, see WhitelistStore.find
+        """
+        md5 = self._normalize(md5)
+        matches = self._cached(md5)
+
+        if matches is None:
+            matches = self.store.find(md5)
+            self._remember(md5, matches)
+
+        return {"md5": md5, "known": bool(matches), "matches": matches}
+
+    def lookup_batch(self, md5s):
+        """
+        Looks up a batch of hex digests.
+
+        :return: list of dicts like lookup returns them, in the order of the input
+        """
+        md5s = [self._normalize(md5) for md5 in md5s]
+        results = {}
+        missing = []
+
+        for md5 in md5s:
+            if md5 in results:
+                continue
+
+            matches = self._cached(md5)
+            if matches is None:
+                missing.append(md5)
+                results[md5] = None
+            else:
+                results[md5] = matches
+
+        if missing:
+            for md5, known in zip(missing, self.store.contains_batch(missing)):
+                matches = self.store.find(md5) if known else []
+                self._remember(md5, matches)
+                results[md5] = matches
+
+        return [{"md5": md5, "known": bool(results[md5]), "matches": results[md5]} for md5 in md5s]
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "records": len(self.store),
+            "cache_size": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class LookupServer:
+    """
+    Minimal HTTP/1.1 server on asyncio streams, which answers lookups of a LookupService:
+
+    - GET /lookup/<md5>: a single digest
+    - POST /lookup: a batch, either a JSON list of digests, a JSON object {"hashes": [...]} or one digest per line
+    - GET /stats: cache and latency statistics
+
+    Lookups are answered on the event loop thread, they are binary searches on memory-mapped segments and take
+    microseconds. Connections are kept alive, so clients can send request after request without reconnecting.
+    """
+
+    def __init__(self, service, host="127.0.0.1", port=8765):
+        """
+        :param service: LookupService
+        :param host: address to listen on, only the local host by default
+        :param port: TCP port
+        """
+        self.service = service
+        self.host = host
+        self.port = port
+        self.latency = LatencyStats()
+        self.started = time.time()
+
+    def _parse_batch(self, body, content_type):
+        if content_type.startswith("application/json"):
+            try:
+                data = json.loads(body)
+            except ValueError as e:
+                raise HTTPError(400, f"Invalid JSON: {e}")
+            hashes = data.get("hashes") if isinstance(data, dict) else data
+            if not isinstance(hashes, list):
+                raise HTTPError(400, "Expected a list of MD5 digests")
+            return hashes
+
+        return [line.strip() for line in body.decode("utf-8", "replace").splitlines() if line.strip()]
+
+    def handle_request(self, method, target, headers, body):
+        """
+        Routes a request.
+
+        :return: status, JSON serializable response
+        """
+        path = target.split("?", 1)[0]
+
+        if path.startswith("/lookup/"):
+            if method != "GET":
+                raise HTTPError(405, "Use GET for single lookups")
+            return 200, self.service.lookup(path[len("/lookup/"):])
+
+        if path == "/lookup":
+            if method != "POST":
+                raise HTTPError(405, "Use POST for batch lookups")
+            return 200, {"results": self.service.lookup_batch(self._parse_batch(body, headers.get("content-type", "")))}
+
+        if path == "/stats":
+            return 200, dict(self.service.stats(), requests=self.latency.count, uptime=time.time() - self.started,
+                             latency_ms=self.latency.percentiles())
+
+        raise HTTPError(404, f"No such resource: {path}")
+
+    @staticmethod
+    async def _read_request(reader):
+        """
+        :return: method, target, headers, body or None at the end of the connection
+        """
+        line = await reader.readline()
+        if not line.strip():
+            return None
+
+        try:
+            method, target, _ = line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get("content-length") or "0"
+        if not (length.isascii() and length.isdigit()):
+            raise HTTPError(400, f"Invalid Content-Length: {length!r}")
+        length = int(length)
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, f"Request bodies are limited to {MAX_BODY_SIZE} bytes")
+
+        body = await reader.readexactly(length) if length else b""
+        return method, target, headers, body
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+
+                    start = time.perf_counter()
+                    method, target, headers, body = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    status, response = self.handle_request(method, target, headers, body)
+                    self.latency.add(time.perf_counter() - start)
+                except HTTPError as e:
+                    status, response = e.status, {"error": str(e)}
+
+                payload = json.dumps(response).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                             + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"Serving lookups of {len(self.service.store)} records on http://{self.host}:{self.port}")
+
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        """
+        Serves until interrupted.
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+        stats = self.service.stats()
+        logger.info(f"Answered {self.latency.count} requests, cache hit rate {stats['cache_hit_rate']}, "
+                    f"latency {self.latency.percentiles()}")
@@ -0,0 +1,230 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import external_sort
+from hashlist import HashlistWriter, find_hashlists, format_md5sum, hashlist_file_name, read_hashlist
+
+logger = logging.getLogger(__name__)
+
+# Records sorted in memory at once by every worker process
+RUN_SIZE = external_sort.RUN_SIZE
+
+# Number of runs merged at once, more runs are merged in several passes to bound the number of open files
+MERGE_FAN_IN = 128
+
+MANIFEST_FILE = "manifest.json"
+
+
+def _input_key(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _sort_input(path, run_size, work_dir):
+    """
+    Spills the records of a single hash list into sorted runs. Runs in a worker process.
+    """
+    lines = (format_md5sum(md5, p) for md5, p in read_hashlist(path))
+    return external_sort.sorted_runs(lines, None, run_size, work_dir)
+
+
+def _unique(lines):
+    previous = None
+    for line in lines:
+        if line != previous:
+            yield line
+            previous = line
+
+
+def collect_hashlists(paths):
+    """
+    Expands result directories into their full hash lists, other paths are taken as hash lists.
+
+    :return: sorted list of distinct paths
+    """
+    hashlists = set()
+
+    for path in paths:
+        if os.path.isdir(path):
+            hashlists.update(find_hashlists(path))
+        else:
+            hashlists.add(path)
+
+    return sorted(os.path.abspath(p) for p in hashlists)
+
+
+class MasterListBuilder:
+    """
+    Merges any number of hash lists into one master list sorted by MD5, with bounded memory. Every input is read by a
+    pool of worker processes and spilled into sorted runs, which are then merged with a k-way merge, in several passes,
+    if there are more than MERGE_FAN_IN runs. Records, which appear in several hash lists, are written once; the same
+    MD5 with different paths is kept as one record per path.
+
+    The progress is recorded in a manifest in the work directory, so an interrupted merge continues, where it stopped:
+    inputs spilled before are not read again, unless they changed, and merge passes done before are kept.
+    """
+
+    def __init__(self, output, work_dir=None, workers=None, run_size=RUN_SIZE, fan_in=MERGE_FAN_IN,
+                 output_format="md5sum", compression=None):
+        """
+        Creates a MasterListBuilder
+
+        :param output: path of the master list, without the extensions of format and compression
+        :param work_dir: directory for the runs and the manifest, defaults to OUTPUT.work
+        :param workers: number of worker processes sorting runs, defaults to the number of CPUs
+        :param run_size: number of records a worker sorts in memory at once
+        :param fan_in: number of runs merged at once
+        :param output_format: format of the master list, see HashlistWriter
+        :param compression: compression of the master list, None, "gzip" or "zstd"
+        """
+        self.output = output
+        self.work_dir = work_dir or f"{output}.work"
+        self.workers = workers or os.cpu_count() or 1
+        self.run_size = run_size
+        self.fan_in = max(fan_in, 2)
+        self.output_format = output_format
+        self.compression = compression
+        self.manifest_path = os.path.join(self.work_dir, MANIFEST_FILE)
+        self.manifest = {"inputs": {}, "runs": None}
+
+    def _save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def _remove(paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _load_manifest(self, inputs):
+        """
+        Takes over the progress of an interrupted merge of the same inputs.
+        """
+        if not os.path.isfile(self.manifest_path):
+            return
+
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        current = {path: _input_key(path) for path in inputs}
+        recorded = {path: entry["key"] for path, entry in manifest["inputs"].items()}
+
+        if manifest["runs"] is not None:
+            if recorded == current and all(os.path.exists(p) for p in manifest["runs"]):
+                logger.info(f"Resuming the merge of {len(manifest['runs'])} runs from {self.manifest_path}")
+                self.manifest = manifest
+            else:
+                logger.info("Inputs changed since the interrupted merge, starting over")
+                self._remove(manifest["runs"])
+            return
+
+        for path, entry in manifest["inputs"].items():
+            if current.get(path) == entry["key"] and all(os.path.exists(p) for p in entry["runs"]):
+                self.manifest["inputs"][path] = entry
+            else:
+                self._remove(entry["runs"])
+
+        logger.info(f"Resuming from {self.manifest_path}: {len(self.manifest['inputs'])} of {len(inputs)} hash lists "
+                    f"sorted already")
+
+    def _sort_inputs(self, inputs):
+        """
+        Spills all inputs, which were not spilled before, into sorted runs in parallel.
+        """
+        pending = [p for p in inputs if p not in self.manifest["inputs"]]
+
+        if pending:
+            # Keys are taken before reading, so a hash list, which changes meanwhile, is sorted again on resume
+            keys = {path: _input_key(path) for path in pending}
+
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(_sort_input, path, self.run_size, self.work_dir): path for path in pending}
+
+                for future in as_completed(futures):
+                    path = futures[future]
+                    self.manifest["inputs"][path] = {"key": keys[path], "runs": future.result()}
+                    self._save_manifest()
+                    logger.info(f"Sorted {path} into {len(self.manifest['inputs'][path]['runs'])} runs")
+
+        self.manifest["runs"] = [run for path in inputs for run in self.manifest["inputs"][path]["runs"]]
+        self._save_manifest()
+
+    def _merge_pass(self):
+        """
+        Merges the runs in groups of fan_in into fewer, deduplicated runs. The manifest is updated after every group,
+        so an interrupted pass continues with the next group.
+        """
+        runs = self.manifest["runs"]
+        merged = []
+
+        for i in range(0, len(runs), self.fan_in):
+            group = runs[i:i + self.fan_in]
+            merged.append(group[0] if len(group) == 1 else self._merge_group(group))
+
+            self.manifest["runs"] = merged + runs[i + self.fan_in:]
+            self._save_manifest()
+            self._remove(set(group) - set(merged))
+
+    def _merge_group(self, group):
+        fd, path = tempfile.mkstemp(prefix="merged-", dir=self.work_dir)
+
+        with open(fd, "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.writelines(_unique(external_sort.merge_runs(group)))
+
+        return path
+
+    def build(self, paths):
+        """
+        Merges the given hash lists into the master list.
+
+        :param paths: hash lists and result directories, whose full hash lists are taken
+        :return: dict of counts: inputs, runs, records written and distinct MD5 digests
+        """
+        inputs = collect_hashlists(paths)
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._load_manifest(inputs)
+
+        if self.manifest["runs"] is None:
+            self._sort_inputs(inputs)
+
+        stats = {"inputs": len(inputs), "runs": len(self.manifest["runs"]), "records": 0, "digests": 0}
+
+        while len(self.manifest["runs"]) > self.fan_in:
+            logger.info(f"Merging {len(self.manifest['runs'])} runs in groups of {self.fan_in}")
+            self._merge_pass()
+
+        # The master list only appears under its final name, once it is complete. It is written next to the output,
+        # not in the work directory, which may be on another file system, where os.replace fails.
+        tmp_writer = HashlistWriter(f"{self.output}.tmp", self.output_format, self.compression)
+        previous_md5 = None
+
+        try:
+            with tmp_writer as w:
+                for line in _unique(external_sort.merge_runs(self.manifest["runs"])):
+                    w.write_line(line)
+                    stats["records"] += 1
+                    if line[:32] != previous_md5:
+                        stats["digests"] += 1
+                        previous_md5 = line[:32]
+        except BaseException:
+            self._remove([tmp_writer.path])
+            raise
+
+        output_path = hashlist_file_name(self.output, self.output_format, self.compression)
+        os.replace(tmp_writer.path, output_path)
+        shutil.rmtree(self.work_dir)
+
+        logger.info(f"Merged {stats['inputs']} hash lists into {output_path}: {stats['records']} records, "
+                    f"{stats['digests']} distinct MD5 digests")
+        return stats
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+
+from scheduler import current_box
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    Measurement of a single stage. The code running inside the stage adds the bytes and files it processed and the exit
+    code of a subprocess, if there is one.
+    """
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.bytes = 0
+        self.files = 0
+        self.exit_code = None
+        self._t = time.perf_counter()
+
+    def add(self, nbytes=0, files=0):
+        self.bytes += nbytes
+        self.files += files
+
+    def throughput(self, nbytes=None):
+        """
+        Returns the bytes added per second since the stage started.
+
+        :param nbytes: bytes to divide by the duration instead of the bytes added
+        """
+        seconds = time.perf_counter() - self._t
+        return (self.bytes if nbytes is None else nbytes) / seconds if seconds > 0 else 0.0
+
+
+class MetricsRecorder:
+    """
+    Writes one JSON object per finished stage to a metrics file. The file is opened in append mode and every record is
+    flushed immediately, so the metrics of an aborted run are kept as well. Records of concurrently processed boxes are
+    written by several threads, a lock keeps the lines intact.
+    """
+
+    def __init__(self, path, run=None):
+        """
+        :param path: path of the metrics file, JSON lines
+        :param run: label of the run, the current UTC datetime if omitted
+        """
+        self.path = path
+        self.run = run or time.strftime("%Y-%m-%dT%H%M%S", time.gmtime())
+        self._lock = threading.Lock()
+        self._f = open(path, "a", encoding="utf-8", buffering=1)
+
+    def write(self, record):
+        line = json.dumps(dict(run=self.run, **record)) + "\n"
+
+        with self._lock:
+            self._f.write(line)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+_recorder = None
+
+
+def configure(path, run=None):
+    """
+    Starts recording metrics to the given file. Until this is called, stages are measured but not written anywhere.
+
+    :param path: path of the metrics file, JSON lines
+    :param run: label of the run, the current UTC datetime if omitted
+    """
+    global _recorder
+    close()
+    _recorder = MetricsRecorder(path, run)
+    logger.info(f"Recording metrics of run {_recorder.run} to {path}")
+
+
+def close():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Measures the duration of the enclosed block and records it together with the bytes and files processed, the exit
+    status and the box of the calling thread. An exception marks the stage as failed and is re-raised.
+
+    Example::
+
+        with metrics.stage("clone", vm=vm_name) as s:
+            clone(...)
+            s.add(nbytes=os.path.getsize(disk_fp))
+
+    :param name: name of the stage, e.g. "vagrant_up" or "hash_volume"
+    :param labels: additional values identifying the stage, they have to be JSON serializable
+    :return: Stage, which the enclosed block can add its bytes and files to
+    """
+    s = Stage(name, labels)
+    status = "ok"
+    error = None
+    start = time.time()
+    t = time.perf_counter()
+
+    try:
+        yield s
+    except GeneratorExit:
+        # A generator, which yields from within the stage, was closed by its consumer, that is no failure
+        raise
+    except BaseException as e:
+        status = "error"
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        seconds = time.perf_counter() - t
+
+        if s.exit_code:
+            status = "error"
+
+        record = {
+            "stage": name,
+            "box": current_box(),
+            "labels": labels,
+            "start": start,
+            "seconds": seconds,
+            "bytes": s.bytes,
+            "files": s.files,
+            "exit_code": s.exit_code,
+            "status": status,
+            "error": error,
+            # Peak memory of the whole process so far, including finished subprocesses
+            "max_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+            "pid": os.getpid(),
+        }
+
+        logger.debug(f"Stage {name} {labels} took {seconds:.2f}s, {s.bytes} bytes, status {status}")
+
+        recorder = _recorder
+        if recorder is not None:
+            recorder.write(record)
@@ -0,0 +1,517 @@
+# Make sure to install the sleuthkit bindings: pip3 install pytsk3
+import os
+import re
+import logging
+import threading
+import metrics
+import extents
+
+from disk_processor import DiskProcessor
+from file_hasher import FileHasher, FileDigest, HardLinks
+from file_policy import SkipStats
+from vdi_reader import open_vdi
+
+try:
+    import pytsk3
+except ImportError:
+    pytsk3 = None
+
+logger = logging.getLogger()
+
+# Size of the reads issued against the image
+READ_SIZE = 4 * 1024 * 1024
+
+# NTFS reserves the first 16 MFT records for metadata files like $MFT or $Extend, ntfs-3g hides them
+NTFS_FIRST_USER_RECORD = 16
+
+# Byte offset of the superblock in an ext file system
+EXT_SUPERBLOCK_OFFSET = 1024
+
+FS_TYPE_NAMES = {"NTFS": "ntfs", "FAT": "fat", "EXFAT": "exfat", "EXT": "ext", "HFS": "hfs", "ISO9660": "iso9660"}
+
+
+if pytsk3:
+    class FileObjectImgInfo(pytsk3.Img_Info):
+        """
+        Makes a seekable binary file object available to the sleuthkit.
+        """
+
+        def __init__(self, f, size):
+            self._f = f
+            self._size = size
+            self._lock = threading.Lock()
+            super().__init__(url="", type=pytsk3.TSK_IMG_TYPE_EXTERNAL)
+
+        def close(self):
+            self._f.close()
+
+        def read(self, offset, size):
+            with self._lock:
+                self._f.seek(offset)
+                return self._f.read(size)
+
+        def get_size(self):
+            return self._size
+
+
+class TskFileReader:
+    """
+    Adapts a pytsk3 file to the readinto() interface expected by FileHasher.hash_stream.
+    """
+
+    def __init__(self, tsk_file, size):
+        self.tsk_file = tsk_file
+        self.size = size
+        self.offset = 0
+
+    def readinto(self, buf):
+        n = min(len(buf), self.size - self.offset)
+        if n <= 0:
+            return 0
+
+        data = self.tsk_file.read_random(self.offset, n)
+        buf[:len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+
+class RawImageProcessor(DiskProcessor):
+    """
+    Hashes the files of a disk image without mounting it. The partition table and the file systems are parsed with the
+    sleuthkit and file contents are streamed straight from the image into the hasher, so neither root privileges nor
+    xmount are required and there is nothing to unmount afterwards.
+
+    Volumes are labeled like imagemounter labels its mountpoints ("<index>-<label or fstype>", see _volume_label) and
+    paths are prefixed accordingly, so the hash lists equal the ones produced for the mounted image. Like ntfs-3g, the NTFS metadata files
+    are omitted and only the default data stream of each file is hashed.
+    """
+
+    def __init__(self, img_path, output_format="md5sum", compression=None):
+        """
+        Creates a RawImageProcessor corresponding to the given image
+
+        :param img_path, absolute path to dd image or to the VDI of the current state of a VM
+        :param output_format: format of the hash lists, see HashlistWriter
+        :param compression: compression of the hash lists, None, "gzip" or "zstd"
+        """
+        if pytsk3 is None:
+            raise RuntimeError("The raw image backend requires pytsk3")
+
+        self.img_path = img_path
+        self.img_label = os.path.basename(img_path).split(".")[0]
+        self.mount_parent = "/tmp"
+        self.mount_stub = "img_mnt"
+        self.output_format = output_format
+        self.compression = compression
+        # Mountpoint prefix, which the volumes would get from imagemounter
+        self.mount_path = os.path.join(self.mount_parent, self.mount_stub)
+        self.is_mounted = False
+        # Set, while files are hashed in physical order, see hash_files
+        self.read_ahead = False
+        self._local = threading.local()
+        with metrics.stage("open_image", image=self.img_label, backend="raw") as s:
+            self.volumes = self._find_volumes()
+            s.add(files=len(self.volumes))
+        self.volume_mount_paths = [os.path.join(self.mount_path, label) for label, _ in self.volumes]
+
+    def _open_image(self):
+        """
+        Opens the image for the sleuthkit. Every thread opens its own handle, as the sleuthkit is not thread-safe.
+        VDI files are read in place through their block map, everything else is treated as raw image.
+        """
+        if self.img_path.lower().endswith(".vdi"):
+            vdi = open_vdi(self.img_path)
+            return FileObjectImgInfo(vdi, vdi.size)
+
+        f = open(self.img_path, "rb")
+        if self.read_ahead:
+            extents.advise_sequential(f.fileno())
+        return FileObjectImgInfo(f, os.fstat(f.fileno()).st_size)
+
+    def _open_fs(self, offset):
+        """
+        Returns a file system handle of the calling thread for the file system at the given offset.
+        """
+        handles = getattr(self._local, "handles", None)
+
+        if handles is None:
+            handles = self._local.handles = {"img": self._open_image()}
+
+        if offset not in handles:
+            handles[offset] = pytsk3.FS_Info(handles["img"], offset=offset)
+
+        return handles[offset]
+
+    @staticmethod
+    def _fs_type_name(fs):
+        name = str(fs.info.ftype).replace("TSK_FS_TYPE_", "")
+
+        for prefix, fs_type in FS_TYPE_NAMES.items():
+            if name.startswith(prefix):
+                return fs_type
+
+        return name.lower()
+
+    @staticmethod
+    def _get_safe_label(label):
+        """
+        Sanitizes a volume label the way imagemounter does for its mountpoints.
+        """
+        if not label:
+            return ""
+        if label == "/":
+            return "root"
+
+        safe_label = re.sub(r"[/ \(\)]+", "_", label)
+
+        if safe_label[0] == "_":
+            safe_label = safe_label[1:]
+        if len(safe_label) > 2 and safe_label[-1] == "_":
+            safe_label = safe_label[:-1]
+
+        return safe_label
+
+    @staticmethod
+    def _read_ntfs_label(fs):
+        """
+        Reads the volume name from the $VOLUME_NAME attribute of the $Volume metadata file.
+        """
+        try:
+            f = fs.open_meta(inode=3)
+            for attr in f:
+                if attr.info.type == pytsk3.TSK_FS_ATTR_TYPE_NTFS_VNAME:
+                    data = f.read_random(0, attr.info.size, attr.info.type, attr.info.id)
+                    return data.decode("utf-16-le").rstrip("\x00")
+        except IOError:
+            logger.debug("Could not read NTFS volume label")
+
+        return None
+
+    @staticmethod
+    def _read_ext_label(img, offset):
+        """
+        Reads the volume name and the last mount point from the superblock of an ext file system.
+
+        :return: (volume name, last mount point), each of them None, if it is not set
+        """
+        try:
+            sb = img.read(offset + EXT_SUPERBLOCK_OFFSET, 1024)
+        except IOError:
+            logger.debug("Could not read ext superblock")
+            return None, None
+
+        def field(start, size):
+            return sb[start:start + size].split(b"\0", 1)[0].decode("utf-8", "replace").strip() or None
+
+        return field(0x78, 16), field(0x88, 64)
+
+    @classmethod
+    def _volume_label(cls, index, label=None, last_mount_point=None, fs_type=None):
+        """
+        Builds the label of a volume the way imagemounter names its mountpoint, "<index>-<label or fstype>".
+
+        imagemounter detects volumes with pytsk3, if it is installed, and takes the address of a partition in the
+        volume system as its index, so unallocated and meta entries count as well; a file system without partition
+        table gets index 0. Like imagemounter does with the output of fsstat, the last mount point and the volume name
+        are combined into the label, e.g. "/ (cloudimg-rootfs)".
+
+        :param index: address of the partition in the volume system
+        :param label: volume name or None
+        :param last_mount_point: last mount point or None, only ext file systems record it
+        :param fs_type: type of the file system, e.g. "ntfs", used without a label
+        """
+        if last_mount_point:
+            label = f"{last_mount_point} ({label})" if label else last_mount_point
+
+        return f"{index}-{cls._get_safe_label(label) or fs_type or 'volume'}"
+
+    def _find_volumes(self):
+        """
+        Parses the partition table and detects the file system of every allocated partition. Images without partition
+        table are treated as a single file system.
+
+        :return: list of (label, byte offset) of all volumes with a supported file system
+        """
+        img = self._open_image()
+        candidates = []
+
+        try:
+            vs = pytsk3.Volume_Info(img)
+            for part in vs:
+                if part.flags == pytsk3.TSK_VS_PART_FLAG_ALLOC:
+                    candidates.append((part.addr, part.start * vs.info.block_size))
+        except IOError:
+            logger.info(f"No partition table found in {self.img_path}, looking for a file system at offset 0")
+            candidates.append((0, 0))
+
+        volumes = []
+
+        for index, offset in candidates:
+            try:
+                fs = self._open_fs(offset)
+            except IOError:
+                logger.info(f"No supported file system of volume {index} at offset {offset}")
+                continue
+
+            fs_type = self._fs_type_name(fs)
+            label, last_mount_point = None, None
+            if fs_type == "ntfs":
+                label = self._read_ntfs_label(fs)
+            elif fs_type == "ext":
+                label, last_mount_point = self._read_ext_label(img, offset)
+            vol_label = self._volume_label(index, label, last_mount_point, fs_type)
+            logger.info(f"Found {fs_type} volume {vol_label} at offset {offset}")
+            volumes.append((vol_label, offset))
+
+        img.close()
+
+        return volumes
+
+    def _walk(self, fs, is_ntfs, dir_inode=None, rel_dir=""):
+        """
+        Yields all allocated regular files of a file system in the same order as FileHasher.walk visits a mounted
+        volume.
+
+        :return: generator of (relative path, inode, size, mtime, mtime_ns, number of links)
+        """
+        d = fs.open_dir(inode=dir_inode) if dir_inode is not None else fs.open_dir(path="/")
+        files = []
+        subdirs = []
+
+        for entry in d:
+            info = entry.info
+            meta = info.meta
+
+            if meta is None or not int(info.name.flags) & int(pytsk3.TSK_FS_NAME_FLAG_ALLOC):
+                continue
+
+            name = info.name.name.decode("utf-8", "surrogateescape")
+
+            if name in (".", "..") or (is_ntfs and meta.addr < NTFS_FIRST_USER_RECORD):
+                continue
+
+            rel_path = f"{rel_dir}/{name}"
+
+            if meta.type == pytsk3.TSK_FS_META_TYPE_REG:
+                files.append((name, (rel_path, meta.addr, meta.size, meta.mtime + meta.mtime_nano / 1e9,
+                                     meta.mtime * 10 ** 9 + meta.mtime_nano, meta.nlink)))
+            elif meta.type == pytsk3.TSK_FS_META_TYPE_DIR:
+                subdirs.append((name, meta.addr, rel_path))
+
+        for _, f in sorted(files):
+            yield f
+
+        for _, inode, rel_path in sorted(subdirs):
+            yield from self._walk(fs, is_ntfs, inode, rel_path)
+
+    def _hash_entry(self, hasher, offset, volume_path, entry, stats=None):
+        rel_path, inode, size, mtime, _, _ = entry
+
+        try:
+            tsk_file = self._open_fs(offset).open_meta(inode=inode)
+            result = hasher.hash_stream(TskFileReader(tsk_file, size), stats, size)
+        except IOError as e:
+            logger.warning(f"Could not hash {rel_path}: {e}")
+            return None
+
+        if result is None:
+            return None
+
+        digests, size = result
+        return FileDigest(volume_path + rel_path, size, mtime, **digests)
+
+    @staticmethod
+    def _select(policy, entries, stats=None):
+        """
+        Drops the entries, which the policy rules out by path or size.
+        """
+        for entry in entries:
+            reason = policy.check_path(entry[0], entry[2])
+            if reason:
+                if stats is not None:
+                    stats.skip(reason, entry[2])
+                continue
+            yield entry
+
+    def _hard_links(self, label):
+        """
+        Returns HardLinks for the entries of a volume: files with several links share their inode.
+        """
+        volume_path = os.path.join(self.mount_path, label)
+        return HardLinks(lambda e: (e[1], e[5]) if e[5] > 1 else None, lambda d, e: d._replace(path=volume_path + e[0]))
+
+    def hash_volume(self, hasher, label, offset, stats=None, links=None):
+        """
+        Hashes all files of a single volume, which the policy of the hasher selects.
+
+        :param hasher: FileHasher, which provides the worker pool and the digest computation
+        :param label: label of the volume
+        :param offset: byte offset of the file system in the image
+        :param stats: optional SkipStats to count files skipped by the policy in
+        :param links: optional HardLinks of the volume, see _hard_links
+        :return: generator of FileDigest, the paths look like the ones of the mounted volume
+        """
+        fs = self._open_fs(offset)
+        volume_path = os.path.join(self.mount_path, label)
+        entries = self._walk(fs, self._fs_type_name(fs) == "ntfs")
+
+        if hasher.policy is not None:
+            entries = self._select(hasher.policy, entries, stats)
+        if hasher.physical_order:
+            entries = self._physical_order(offset, entries)
+
+        return hasher.map_ordered(lambda e: self._hash_entry(hasher, offset, volume_path, e, stats), entries, links)
+
+    def _data_runs(self, offset, inode):
+        """
+        Returns the runs of the default data stream of a file as (offset in the image, length) in bytes. Sparse runs are
+        left out.
+
+        :return: list of runs or None, if the data is resident in the MFT record or the file cannot be opened
+        """
+        fs = self._open_fs(offset)
+        block_size = fs.info.block_size
+
+        try:
+            tsk_file = fs.open_meta(inode=inode)
+        except IOError:
+            return None
+
+        runs = []
+        for attr in tsk_file:
+            if attr.info.type not in (pytsk3.TSK_FS_ATTR_TYPE_DEFAULT, pytsk3.TSK_FS_ATTR_TYPE_NTFS_DATA) \
+                    or attr.info.name:
+                continue
+            if int(attr.info.flags) & int(pytsk3.TSK_FS_ATTR_RES):
+                return None
+
+            for run in attr:
+                if int(run.flags) & (int(pytsk3.TSK_FS_ATTR_RUN_FLAG_SPARSE) | int(pytsk3.TSK_FS_ATTR_RUN_FLAG_FILLER)):
+                    continue
+                runs.append((offset + run.addr * block_size, run.len * block_size))
+
+        return runs
+
+    def _touches_changed_blocks(self, offset, inode, changed_blocks):
+        """
+        Checks, if the default data stream of a file lies in one of the changed blocks of the disk. Resident data is
+        stored in the MFT record and always counts as changed, the file is tiny anyway.
+        """
+        runs = self._data_runs(offset, inode)
+        if runs is None:
+            return True
+
+        return any(changed_blocks.touches(start, length) for start, length in runs)
+
+    def _physical_order(self, offset, entries):
+        """
+        Sorts the entries of a volume by the location of their data in the image, see extents.sort_physical.
+        """
+        def first_run(entry):
+            runs = self._data_runs(offset, entry[1])
+            return runs[0][0] if runs else None
+
+        return extents.sort_physical(entries, first_run)
+
+    def hash_volume_incremental(self, hasher, label, offset, cache, stats=None, changed_blocks=None, links=None):
+        """
+        Hashes the files of a single volume like hash_volume, but takes the digests of unchanged files from the cache.
+        By default a file is unchanged, if size, mtime and inode equal the cached ones. If the changed blocks of the
+        disk are known, a file is unchanged, if size and inode are equal and none of its data lies in a changed block,
+        so only files touched by the changes are read, no matter what happened to their timestamps.
+
+        :param hasher: FileHasher, which provides the worker pool and the digest computation
+        :param label: label of the volume
+        :param offset: byte offset of the file system in the image
+        :param cache: HashCache
+        :param stats: optional SkipStats to count files skipped by the policy in
+        :param changed_blocks: optional ChangedBlocks of the disk since the previous run
+        :param links: optional HardLinks of the volume, see _hard_links
+        :return: generator of (FileDigest, is_new), is_new is True for files, which were not taken from the cache
+        """
+        fs = self._open_fs(offset)
+        volume_path = os.path.join(self.mount_path, label)
+        entries = self._walk(fs, self._fs_type_name(fs) == "ntfs")
+
+        if hasher.policy is not None:
+            entries = self._select(hasher.policy, entries, stats)
+        if hasher.physical_order:
+            entries = self._physical_order(offset, entries)
+
+        def cache_entries():
+            for e in entries:
+                rel_path, inode, size, mtime, mtime_ns, _ = e
+                # Cached paths are relative to the volume like the ones of the mount backend
+                yield e, volume_path + rel_path, rel_path[1:], (size, mtime_ns, inode), mtime
+
+        def is_unchanged(entry, cached_key):
+            size, _, inode = entry[3]
+            return cached_key[0] == size and cached_key[2] == inode and \
+                not self._touches_changed_blocks(offset, inode, changed_blocks)
+
+        return cache.hash_entries(hasher, cache_entries(),
+                                  lambda e: self._hash_entry(hasher, offset, volume_path, e, stats),
+                                  self.img_label, label, is_unchanged if changed_blocks is not None else None, links)
+
+    def hash_files(self, result_dir, hasher=None, cache=None, volume_workers=1, journal=None, changed_blocks=None):
+        """
+        Hashes all files of all volumes of the image and writes one hash list per volume.
+
+        If a HashCache is given, only new or modified files are read and a delta hash list is written as well, see
+        DiskProcessor.hash_files and hash_volume_incremental.
+
+        :param result_dir: path to directory, where the resulting hash lists will be stored.
+        :param hasher: FileHasher to use, a default one with one worker per CPU is created if omitted
+        :param cache: optional HashCache for incremental hashing
+        :param volume_workers: number of volumes hashed concurrently, each one writes its own hash list
+        :param journal: optional BoxJournal to skip the volumes hashed by a previous run
+        :param changed_blocks: optional ChangedBlocks of the disk since the previous run, requires a cache
+        """
+        hasher = hasher or FileHasher(buffer_size=READ_SIZE)
+        offsets = dict(zip(self.volume_mount_paths, (offset for _, offset in self.volumes)))
+        # The files of a volume are read ascending through the image, which the kernel should read ahead
+        self.read_ahead = hasher.physical_order
+
+        def hash_volume(d, result_path):
+            label = os.path.basename(d)
+            logger.info(f"Hashing volume {label} of {self.img_path} with {hasher.workers} workers")
+            skipped = SkipStats()
+            links = self._hard_links(label)
+
+            with metrics.stage("hash_volume", image=self.img_label, volume=label, hasher="builtin",
+                               workers=hasher.workers, backend="raw", incremental=cache is not None,
+                               changed_bytes=changed_blocks.size if changed_blocks is not None else None,
+                               physical_order=hasher.physical_order) as s:
+                if cache is None:
+                    with self._writer(result_path) as w:
+                        for r in self.hash_volume(hasher, label, offsets[d], skipped, links):
+                            w.write_digest(r, self._strip_mount_prefix(r.path))
+                            s.add(r.size, 1)
+                else:
+                    with self._writer(result_path) as w, self._writer(f"{result_path}_delta") as w_delta:
+                        for r, is_new in self.hash_volume_incremental(hasher, label, offsets[d], cache, skipped,
+                                                                      changed_blocks, links):
+                            path = self._strip_mount_prefix(r.path)
+                            w.write_digest(r, path)
+                            if is_new:
+                                # Only files, which were actually read, count as processed
+                                w_delta.write_digest(r, path)
+                                s.add(r.size, 1)
+
+                self._report_skipped(d, skipped, s)
+                self._report_links(d, links, s)
+                self._report_throughput(d, s, links)
+
+        self._for_each_volume(hash_volume, result_dir, volume_workers, journal, delta=cache is not None)
+
+    def hash_with_hashrat(self, result_dir, volume_workers=1, journal=None):
+        """
+        hashrat reads files from mounted volumes, which this backend does not have.
+        """
+        raise RuntimeError("hashrat requires mounted volumes, use hash_files with the raw image backend")
+
+    def __del__(self):
+        """
+        Nothing was mounted, so there is nothing to clean up.
+        """
+        pass
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import json
+import logging
+
+from whitelist_store import WhitelistStore
+from evidence_filter import filter_hashlist, BATCH_SIZE
+from hashlist_diff import diff_hashlists, diff_latest_runs
+from hashlist import split_extensions
+from block_hasher import BlockHasher, merge_stores, BLOCK_SIZE
+from master_list import MasterListBuilder, RUN_SIZE
+from lookup_service import LookupService, LookupServer, CACHE_SIZE
+
+logger = logging.getLogger()
+
+
+def cmd_import(args):
+    """
+    Appends hash lists or whole result directories to the store.
+    """
+    store = WhitelistStore(args.store)
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            logger.info(f"Added {store.add_result_dir(path)} hash lists from {path}")
+        else:
+            store.add_hashlist(path)
+
+    if args.merge:
+        store.merge()
+
+    store.close()
+
+
+def cmd_merge(args):
+    """
+    Merges all segments of the store into one.
+    """
+    store = WhitelistStore(args.store)
+    store.merge(first_seen_only=args.first_seen_only)
+    store.close()
+
+
+def cmd_lookup(args):
+    """
+    Prints the provenance of the given hashes as JSON lines.
+    """
+    store = WhitelistStore(args.store)
+
+    for md5 in args.hashes:
+        print(json.dumps({"md5": md5.lower(), "matches": store.find(md5.lower())}))
+
+    store.close()
+
+
+def cmd_filter(args):
+    """
+    Removes known records from an evidence hash list.
+    """
+    store = WhitelistStore(args.store)
+    stats = filter_hashlist(store, args.evidence, args.output, args.known, args.batch_size)
+    store.close()
+
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(stats, f)
+
+
+def cmd_diff(args):
+    """
+    Writes the added, removed and changed records between two runs.
+    """
+    if args.box:
+        diff_latest_runs(args.result_dir, args.box, args.volume, args.output, tmp_dir=args.tmp_dir)
+    elif len(args.hashlists) == 2:
+        diff_hashlists(args.hashlists[0], args.hashlists[1], args.output or split_extensions(args.hashlists[1])[0],
+                       tmp_dir=args.tmp_dir)
+    else:
+        raise SystemExit("Specify either two hash lists or --box and --volume")
+
+
+def cmd_block_hash(args):
+    """
+    Builds a block hash store from a raw image.
+    """
+    stats = BlockHasher(args.workers, args.block_size).hash_image(args.image, args.output, args.tmp_dir)
+
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(stats, f)
+
+
+def cmd_block_merge(args):
+    """
+    Merges block hash stores into one.
+    """
+    merge_stores(args.stores, args.output)
+
+
+def cmd_master(args):
+    """
+    Merges hash lists into one sorted, deduplicated master list.
+    """
+    builder = MasterListBuilder(args.output, args.work_dir, args.workers, args.run_size,
+                                output_format=args.output_format,
+                                compression=None if args.compression == "none" else args.compression)
+    stats = builder.build(args.paths)
+
+    if args.stats:
+        with open(args.stats, "w") as f:
+            json.dump(stats, f)
+
+
+def cmd_serve(args):
+    """
+    Answers lookups in the store over HTTP.
+    """
+    store = WhitelistStore(args.store)
+
+    try:
+        LookupServer(LookupService(store, args.cache_size), args.host, args.port).run()
+    finally:
+        store.close()
+
+
+def parse_args():
+    """
+    Parses the command line arguments.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Tools for working with the hash lists accumulated by hashlab.")
+    parser.add_argument('--store', type=str, default="../results/whitelist",
+                        help="Path to the directory of the whitelist store.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_import = subparsers.add_parser("import", help="Append hash lists or result directories to the store.")
+    parser_import.add_argument('paths', nargs="+", help="Hash lists or result directories of hashlab.")
+    parser_import.add_argument('--merge', action='store_true', help="Merge all segments afterwards.")
+    parser_import.set_defaults(func=cmd_import)
+
+    parser_merge = subparsers.add_parser("merge", help="Merge all segments of the store into one.")
+    parser_merge.add_argument('--first-seen-only', action='store_true',
+                              help="Keep only the first run, in which a file was seen, instead of all of them. Shrinks "
+                                   "the store, but loses the provenance of the later runs.")
+    parser_merge.set_defaults(func=cmd_merge)
+
+    parser_lookup = subparsers.add_parser("lookup", help="Look up MD5 hashes in the store.")
+    parser_lookup.add_argument('hashes', nargs="+", help="MD5 hashes to look up.")
+    parser_lookup.set_defaults(func=cmd_lookup)
+
+    parser_filter = subparsers.add_parser("filter", help="Remove known records from an evidence hash list.")
+    parser_filter.add_argument('evidence', help="Evidence hash list with the MD5 hash first on each line, '-' for stdin.")
+    parser_filter.add_argument('-o', '--output', default="-", help="Output for unknown records, '-' for stdout.")
+    parser_filter.add_argument('--known', default=None, help="Optional output for known records.")
+    parser_filter.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Number of lines looked up at once.")
+    parser_filter.add_argument('--stats', default=None, help="Write counts and throughput as JSON to this file.")
+    parser_filter.set_defaults(func=cmd_filter)
+
+    parser_diff = subparsers.add_parser("diff", help="Compare two runs of the same box and volume.")
+    parser_diff.add_argument('hashlists', nargs="*", help="Hash lists of the older and the newer run.")
+    parser_diff.add_argument('--result-dir', default="../results",
+                             help="Result directory to take the two latest runs of --box and --volume from.")
+    parser_diff.add_argument('--box', default=None, help="Name of the box.")
+    parser_diff.add_argument('--volume', default=None, help="Label of the volume.")
+    parser_diff.add_argument('-o', '--output', default=None,
+                             help="Prefix of the resulting hash lists (default: path of the newer hash list without "
+                                  "its extensions).")
+    parser_diff.add_argument('--tmp-dir', default=None, help="Directory for temporary files of the external sort.")
+    parser_diff.set_defaults(func=cmd_diff)
+
+    parser_block_hash = subparsers.add_parser("block-hash", help="Hash all blocks of a raw image into a block hash store.")
+    parser_block_hash.add_argument('image', help="Raw image, e.g. a .dd cloned by hashlab.")
+    parser_block_hash.add_argument('-o', '--output', required=True, help="Path of the block hash store.")
+    parser_block_hash.add_argument('--workers', type=int, default=None, help="Number of worker threads.")
+    parser_block_hash.add_argument('--block-size', type=int, default=BLOCK_SIZE, help="Size of the hashed blocks.")
+    parser_block_hash.add_argument('--tmp-dir', default=None, help="Directory for the sorted runs of digests.")
+    parser_block_hash.add_argument('--stats', default=None, help="Write counts and duration as JSON to this file.")
+    parser_block_hash.set_defaults(func=cmd_block_hash)
+
+    parser_block_merge = subparsers.add_parser("block-merge", help="Merge block hash stores of several boxes.")
+    parser_block_merge.add_argument('stores', nargs="+", help="Block hash stores, e.g. BLOCK_DB/*.blk.")
+    parser_block_merge.add_argument('-o', '--output', required=True, help="Path of the merged store.")
+    parser_block_merge.set_defaults(func=cmd_block_merge)
+
+    parser_master = subparsers.add_parser("master", help="Merge hash lists into one master list sorted by MD5.")
+    parser_master.add_argument('paths', nargs="+", help="Hash lists or result directories of hashlab.")
+    parser_master.add_argument('-o', '--output', required=True,
+                               help="Path of the master list, the extensions of format and compression are appended.")
+    parser_master.add_argument('--workers', type=int, default=None, help="Number of processes sorting runs.")
+    parser_master.add_argument('--run-size', type=int, default=RUN_SIZE,
+                               help="Number of records each process sorts in memory at once.")
+    parser_master.add_argument('--work-dir', default=None,
+                               help="Directory for the sorted runs and the progress manifest (default: OUTPUT.work).")
+    parser_master.add_argument('--output-format', choices=["md5sum", "jsonl", "columnar"], default="md5sum",
+                               help="Format of the master list.")
+    parser_master.add_argument('--compression', choices=["none", "gzip", "zstd"], default="none",
+                               help="Compression of the master list.")
+    parser_master.add_argument('--stats', default=None, help="Write counts as JSON to this file.")
+    parser_master.set_defaults(func=cmd_master)
+
+    parser_serve = subparsers.add_parser("serve", help="Answer lookups in the store over HTTP.")
+    parser_serve.add_argument('--host', default="127.0.0.1", help="Address to listen on.")
+    parser_serve.add_argument('--port', type=int, default=8765, help="TCP port to listen on.")
+    parser_serve.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                              help="Number of looked up digests kept in memory.")
+    parser_serve.set_defaults(func=cmd_serve)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    # Logs go to stderr, so filtered records can be piped through stdout
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args = parse_args()
+    args.func(args)
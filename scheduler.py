@@ -0,0 +1,177 @@
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_context = threading.local()
+
+
+@contextmanager
+def box_context(box):
+    """
+    Attributes all log messages of the calling thread to the given box, while the context is active.
+
+    :param box: name of the box
+    """
+    previous = getattr(_context, "box", None)
+    _context.box = box
+    try:
+        yield
+    finally:
+        _context.box = previous
+
+
+def current_box():
+    """
+    Returns the name of the box, the calling thread is working on, or None.
+    """
+    return getattr(_context, "box", None)
+
+
+class BoxLogFilter(logging.Filter):
+    """
+    Adds the attribute "box" to every log record, which holds "[<box>] " if the record was emitted in a box_context
+    and is empty otherwise.
+    """
+
+    def filter(self, record):
+        box = current_box()
+        record.box = f"[{box}] " if box else ""
+        return True
+
+
+class ResourcePool:
+    """
+    Counts resources like RAM, CPUs and scratch space, which are shared by concurrently processed boxes. Acquiring
+    blocks until enough of every resource is available. Requests exceeding a limit are clamped to it, so a single large
+    box can still run on its own.
+    """
+
+    def __init__(self, **limits):
+        """
+        :param limits: maximum amount per resource, None means unlimited
+        """
+        self.limits = {k: v for k, v in limits.items() if v is not None}
+        self.used = {k: 0 for k in self.limits}
+        self._cond = threading.Condition()
+
+    def _clamp(self, amounts):
+        return {k: min(v, self.limits[k]) for k, v in amounts.items() if k in self.limits and v}
+
+    def acquire(self, **amounts):
+        amounts = self._clamp(amounts)
+
+        with self._cond:
+            self._cond.wait_for(lambda: all(self.used[k] + v <= self.limits[k] for k, v in amounts.items()))
+            for k, v in amounts.items():
+                self.used[k] += v
+
+    def release(self, **amounts):
+        amounts = self._clamp(amounts)
+
+        with self._cond:
+            for k, v in amounts.items():
+                self.used[k] -= v
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, **amounts):
+        self.acquire(**amounts)
+        try:
+            yield
+        finally:
+            self.release(**amounts)
+
+
+class PipelineScheduler:
+    """
+    Processes boxes in two stages with bounded concurrency: the VM stage (vagrant up, snapshot, clone, halt) and the
+    hash stage (mount, hash, clean up). As soon as the VM stage of a box is done, its hash stage is queued and the VM
+    stage of the next box can start, so the hypervisor and the CPUs are busy at the same time.
+
+    RAM and CPUs are reserved for the whole VM stage, scratch space from the clone until the end of the hash stage.
+    """
+
+    def __init__(self, vm_stage, hash_stage, vm_demand, resources=None, max_vms=1, max_hashers=1):
+        """
+        Creates a PipelineScheduler
+
+        :param vm_stage: callable, which is passed the vagrantfile and a callable to reserve scratch space, it returns
+        the result to hand over to the hash stage
+        :param hash_stage: callable, which is passed the vagrantfile and the result of the VM stage
+        :param vm_demand: callable, which returns (ram, cpus) of the VM of a vagrantfile
+        :param resources: ResourcePool limiting ram, cpus and scratch, unlimited if omitted
+        :param max_vms: number of VM stages running at the same time
+        :param max_hashers: number of hash stages running at the same time
+        """
+        self.vm_stage = vm_stage
+        self.hash_stage = hash_stage
+        self.vm_demand = vm_demand
+        self.resources = resources or ResourcePool()
+        self.max_vms = max_vms
+        self.max_hashers = max_hashers
+
+    @staticmethod
+    def box_name(vf):
+        return os.path.basename(os.path.dirname(vf))
+
+    def _run_box(self, vf, hash_pool, hash_futures):
+        scratch = []
+
+        def reserve_scratch(size):
+            self.resources.acquire(scratch=size)
+            scratch.append(size)
+
+        with box_context(self.box_name(vf)):
+            try:
+                ram, cpus = self.vm_demand(vf)
+                with self.resources.reserve(ram=ram, cpus=cpus):
+                    logger.info(f"Starting VM stage ({ram} MB RAM, {cpus} CPUs)")
+                    vm_result = self.vm_stage(vf, reserve_scratch)
+            except Exception:
+                logger.exception(f"VM stage of {vf} failed")
+                for size in scratch:
+                    self.resources.release(scratch=size)
+                return
+
+        hash_futures.append(hash_pool.submit(self._hash_box, vf, vm_result, scratch))
+
+    def _hash_box(self, vf, vm_result, scratch):
+        with box_context(self.box_name(vf)):
+            try:
+                logger.info("Starting hash stage")
+                self.hash_stage(vf, vm_result)
+                return True
+            except Exception:
+                logger.exception(f"Hash stage of {vf} failed")
+                return False
+            finally:
+                for size in scratch:
+                    self.resources.release(scratch=size)
+
+    def run(self, vfiles):
+        """
+        Processes all given boxes. A failing box is logged and does not stop the others.
+
+        :param vfiles: list of absolute paths to vagrantfiles
+        :return: number of boxes processed successfully
+        """
+        hash_futures = []
+
+        with ThreadPoolExecutor(max_workers=self.max_hashers) as hash_pool:
+            with ThreadPoolExecutor(max_workers=self.max_vms) as vm_pool:
+                vm_futures = [vm_pool.submit(self._run_box, vf, hash_pool, hash_futures) for vf in vfiles]
+
+            # Failures of boxes are logged by _run_box, anything else is a bug and must not vanish
+            for f in vm_futures:
+                f.result()
+
+            # All VM stages are done here, so no more hash stages are queued
+            succeeded = sum(1 for f in hash_futures if f.result())
+
+        logger.info(f"Processed {succeeded} of {len(vfiles)} boxes successfully")
+
+        return succeeded
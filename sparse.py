@@ -0,0 +1,121 @@
+import os
+import errno
+import logging
+import utils
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+ZERO_CHUNK = bytes(CHUNK_SIZE)
+
+
+def allocated_size(path):
+    """
+    Returns the number of bytes a file actually occupies on disk, which is less than its apparent size, if it has holes.
+
+    :param path: path to the file
+    """
+    return os.stat(path).st_blocks * 512
+
+
+def is_zero(chunk):
+    """
+    Checks, if a chunk of at most CHUNK_SIZE bytes consists of zeros only. Comparing against a prefix of a constant
+    zero buffer boils down to a memcmp and does not copy the chunk.
+    """
+    return ZERO_CHUNK.startswith(chunk)
+
+
+def data_extents(f, size=None):
+    """
+    Yields the regions of a file, which contain data. Holes are detected with SEEK_DATA/SEEK_HOLE, on file systems
+    without support for them the whole file is one extent. Objects providing their own data_extents() method, like
+    VDIImage, are asked directly.
+
+    Note that this moves the file offset of f, seek before reading.
+
+    :param f: file object
+    :param size: number of bytes to consider, defaults to the size of the file
+    :return: generator of (start, end) byte offsets
+    """
+    if hasattr(f, "data_extents"):
+        yield from f.data_extents()
+        return
+
+    fd = f.fileno()
+    size = os.fstat(fd).st_size if size is None else size
+    pos = 0
+
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No more data behind pos
+                return
+            if e.errno == errno.EINVAL:
+                yield pos, size
+                return
+            raise
+
+        if start >= size:
+            return
+
+        yield start, min(end, size)
+        pos = end
+
+
+def copy_sparse(src, dest_path, size):
+    """
+    Copies the first size bytes of a file object to a new file, but only reads the data extents of the source and only
+    writes chunks, which are not entirely zero. Everything else stays a hole in the destination.
+
+    :param src: seekable binary file object supporting readinto()
+    :param dest_path: path of the file to create
+    :param size: apparent size of the destination
+    :return: number of bytes written
+    """
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    written = 0
+
+    with open(dest_path, "wb") as dst:
+        dst.truncate(size)
+
+        for start, end in data_extents(src, size):
+            pos = start
+            src.seek(start)
+
+            while pos < end:
+                n = src.readinto(view[:min(CHUNK_SIZE, end - pos)])
+                if not n:
+                    break
+
+                if not is_zero(view[:n]):
+                    dst.seek(pos)
+                    dst.write(view[:n])
+                    written += n
+
+                pos += n
+
+    logger.info(f"Wrote {written} of {size} bytes to {dest_path}, the rest are holes")
+
+    return written
+
+
+def dig_holes(path):
+    """
+    Turns all-zero regions of an existing file into holes in place, requires fallocate of util-linux.
+
+    :param path: path to the file
+    :return: rc, status code of fallocate
+    """
+    rc = utils.run_shell_cmd(["fallocate", "--dig-holes", path])
+
+    if rc:
+        logger.error(f"Could not dig holes into {path}")
+    else:
+        logger.info(f"Dug holes into {path}, {allocated_size(path)} of {os.path.getsize(path)} bytes allocated")
+
+    return rc
@@ -0,0 +1,78 @@
+import os
+import hashlib
+
+import pytest
+
+import block_hasher
+from block_hasher import BlockHasher, BlockStore, constant_mask, merge_stores
+
+BS = 64
+
+
+def _blocks(*blocks):
+    return b"".join(blocks)
+
+
+@pytest.fixture(params=["numpy", "plain"])
+def with_numpy(request, monkeypatch):
+    if request.param == "plain":
+        monkeypatch.setattr(block_hasher, "np", None)
+    elif block_hasher.np is None:
+        pytest.skip("numpy is not installed")
+
+
+@pytest.mark.parametrize("block, constant", [
+    (bytes(BS), True),
+    (b"\xff" * BS, True),
+    (b"\x5a" * BS, True),
+    # Repeated 8-byte words, which are not a single repeated byte
+    (b"\x00\x01" * (BS // 2), False),
+    (b"\x01" + bytes(BS - 1), False),
+    (bytes(BS - 1) + b"\x01", False),
+    (b"\x07" * (BS // 2) + b"\x08" * (BS // 2), False),
+])
+def test_constant_mask(with_numpy, block, constant):
+    # The block is checked between two constant ones of another value, so neighbours do not leak into it
+    data = _blocks(b"\x11" * BS, block, b"\x22" * BS)
+    assert constant_mask(memoryview(data), 3, BS) == [True, constant, True]
+
+
+def test_spilled_runs_are_merged_into_store(tmp_path):
+    blocks = [bytes([1 + i % 7]) + bytes(BS - 1) for i in range(50)] + [b"\xff" * BS] * 10 + [bytes(BS)] * 5
+    image = tmp_path / "disk.dd"
+    image.write_bytes(_blocks(*blocks) + b"partial")
+    store_path = str(tmp_path / "disk.blk")
+
+    # Tiny batches and runs force many spills, which are deduplicated again while merging
+    stats = BlockHasher(workers=3, block_size=BS, batch_blocks=4, run_digests=3).hash_image(str(image), store_path)
+
+    expected = sorted({hashlib.md5(b).digest() for b in blocks[:50]})
+    store = BlockStore(store_path)
+    try:
+        assert list(store) == expected
+        assert all(d in store for d in expected)
+        assert hashlib.md5(bytes(BS)).digest() not in store
+    finally:
+        store.close()
+
+    assert (stats["blocks"], stats["hashed"], stats["constant"], stats["distinct"]) == (65, 50, 15, 7)
+    # Only the store is left behind, the runs are removed
+    assert sorted(os.listdir(tmp_path)) == ["disk.blk", "disk.dd"]
+
+
+def test_merge_stores(tmp_path):
+    digests = [hashlib.md5(bytes([i])).digest() for i in range(6)]
+    BlockStore.write(str(tmp_path / "a.blk"), sorted(digests[:4]), BS, 16)
+    BlockStore.write(str(tmp_path / "b.blk"), sorted(digests[2:]), BS, 16)
+
+    assert merge_stores([str(tmp_path / "a.blk"), str(tmp_path / "b.blk")], str(tmp_path / "all.blk")) == 6
+
+    store = BlockStore(str(tmp_path / "all.blk"))
+    try:
+        assert list(store) == sorted(digests)
+    finally:
+        store.close()
+
+    BlockStore.write(str(tmp_path / "c.blk"), [], 2 * BS, 16)
+    with pytest.raises(ValueError):
+        merge_stores([str(tmp_path / "a.blk"), str(tmp_path / "c.blk")], str(tmp_path / "mixed.blk"))
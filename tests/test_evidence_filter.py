@@ -0,0 +1,73 @@
+import pytest
+
+from evidence_filter import filter_hashlist
+from whitelist_store import WhitelistStore
+
+KNOWN = ["%032x" % i for i in range(1, 4)]
+UNKNOWN = "f" * 32
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = WhitelistStore(str(tmp_path / "store"))
+    # Two segments, so hits from either of them count
+    store.add_records([(KNOWN[0], "/bin/a"), (KNOWN[1], "/bin/b")], "box", "C", "run1")
+    store.add_records([(KNOWN[2], "/bin/c")], "box", "D", "run1")
+    yield store
+    store.close()
+
+
+@pytest.mark.parametrize("line, known", [
+    (f"{KNOWN[0]}  /evidence/a\n", True),
+    (f"{KNOWN[2]}  /evidence/c\n", True),
+    # Hashes are matched case-insensitively
+    (f"{KNOWN[1].upper()}  /evidence/B\n", True),
+    # Bare hashes and other separators than two spaces
+    (f"{KNOWN[1]}\n", True),
+    (f"{KNOWN[0]}\t/evidence/a\n", True),
+    (f"{KNOWN[0]}", True),
+    (f"{UNKNOWN}  /evidence/unknown\n", False),
+    (f"{UNKNOWN.upper()}\n", False),
+])
+def test_known_records_are_excluded(tmp_path, store, line, known):
+    evidence = tmp_path / "evidence.md5"
+    evidence.write_text(line)
+
+    stats = filter_hashlist(store, str(evidence), str(tmp_path / "unknown"), str(tmp_path / "known"))
+
+    assert (tmp_path / "known").read_text() == (line if known else "")
+    assert (tmp_path / "unknown").read_text() == ("" if known else line)
+    assert (stats["known"], stats["unknown"], stats["unparsable"]) == ((1, 0, 0) if known else (0, 1, 0))
+
+
+@pytest.mark.parametrize("line", [
+    "# comment\n",
+    "\n",
+    # Too short, too long or glued to the path
+    f"{KNOWN[0][:31]}  /evidence/a\n",
+    f"{KNOWN[0]}0  /evidence/a\n",
+    f"{KNOWN[0]}/evidence/a\n",
+    f" {KNOWN[0]}  /evidence/a\n",
+])
+def test_unparsable_lines_are_passed_through(tmp_path, store, line):
+    evidence = tmp_path / "evidence.md5"
+    evidence.write_text(line)
+
+    stats = filter_hashlist(store, str(evidence), str(tmp_path / "unknown"), str(tmp_path / "known"))
+
+    assert (tmp_path / "unknown").read_text() == line
+    assert (tmp_path / "known").read_text() == ""
+    assert stats["unparsable"] == 1
+
+
+def test_order_is_kept_across_batches(tmp_path, store):
+    lines = [f"{KNOWN[i % 3] if i % 2 else UNKNOWN}  /evidence/{i}\n" for i in range(11)] + ["garbage\n"]
+    evidence = tmp_path / "evidence.md5"
+    evidence.write_text("".join(lines))
+
+    stats = filter_hashlist(store, str(evidence), str(tmp_path / "unknown"), str(tmp_path / "known"), batch_size=3)
+
+    assert (tmp_path / "known").read_text() == "".join(lines[1:11:2])
+    assert (tmp_path / "unknown").read_text() == "".join(lines[0:11:2]) + "garbage\n"
+    assert {k: stats[k] for k in ("lines", "known", "unknown", "unparsable")} == \
+        {"lines": 12, "known": 5, "unknown": 6, "unparsable": 1}
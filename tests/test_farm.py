@@ -0,0 +1,120 @@
+import os
+import time
+import subprocess
+import multiprocessing
+
+import pytest
+
+from farm import FarmWorker, JobQueue, LeaseLostError
+
+STAND_INS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stand_ins")
+
+
+def _vm_job(job):
+    """
+    Processes a job like hashlab's farm mode does, with vagrant and VBoxManage replaced by the stand-ins. The worker
+    dies without a word after cloning the disk of a box named "crash" in the first attempt.
+    """
+    box_dir = os.path.dirname(job.vagrantfile)
+    subprocess.run(["vagrant", "up"], cwd=box_dir, check=True)
+    disk_fp = os.path.join(box_dir, "disk.vdi")
+    subprocess.run(["VBoxManage", "clonemedium", "disk", "uuid", disk_fp], cwd=box_dir, check=True)
+
+    queue = JobQueue(os.environ["FARM_DB"], lease_seconds=2)
+    try:
+        queue.set_stage(job, "hash", vm={"disk_fp": disk_fp})
+    finally:
+        queue.close()
+
+    if os.path.basename(box_dir) == "crash" and job.attempts == 1:
+        os._exit(1)
+
+
+def _run_worker(db_path, name):
+    queue = JobQueue(db_path, lease_seconds=2)
+    FarmWorker(queue, _vm_job, name=name, heartbeat_interval=0.5, poll_interval=0.2).run()
+    queue.close()
+
+
+@pytest.fixture
+def farm(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", STAND_INS + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("FAKE_VM_LOG", str(tmp_path / "calls.log"))
+    monkeypatch.setenv("FAKE_VM_DELAY", "0.2")
+    monkeypatch.setenv("FARM_DB", str(tmp_path / "farm.db"))
+    return tmp_path
+
+
+def _add_boxes(queue, root, names):
+    for name in names:
+        box_dir = root / "boxes" / name
+        box_dir.mkdir(parents=True)
+        (box_dir / "Vagrantfile").write_text("")
+        queue.add(name, str(box_dir / "Vagrantfile"))
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    queue = JobQueue(str(tmp_path / "farm.db"), lease_seconds=0.5, max_attempts=2)
+    queue.add("box", "Vagrantfile")
+
+    job = queue.claim("a")
+    assert job.attempts == 1
+    assert queue.claim("b") is None
+    assert queue.heartbeat(job)
+
+    time.sleep(0.6)
+    reclaimed = queue.claim("b")
+    assert (reclaimed.box, reclaimed.worker, reclaimed.attempts) == ("box", "b", 2)
+
+    # The first worker lost the job, it can neither renew nor report on it
+    assert not queue.heartbeat(job)
+    with pytest.raises(LeaseLostError):
+        queue.set_stage(job, "hash")
+
+    # Out of attempts, the next expiry fails the job for good
+    time.sleep(0.6)
+    assert queue.claim("c") is None
+    assert queue.counts() == {"failed": 1}
+    assert queue.retry_failed() == 1
+    assert queue.claim("c").attempts == 1
+    queue.close()
+
+
+def test_stage_data_survives_reclaim(tmp_path):
+    queue = JobQueue(str(tmp_path / "farm.db"), lease_seconds=0.2)
+    queue.add("box", "Vagrantfile")
+
+    queue.set_stage(queue.claim("a"), "hash", vm={"disk_fp": "disk.vdi"})
+    time.sleep(0.3)
+    job = queue.claim("b")
+
+    assert (job.stage, job.data) == ("hash", {"vm": {"disk_fp": "disk.vdi"}})
+    queue.close()
+
+
+def test_workers_share_queue_and_take_over_dead_worker(farm):
+    names = ["crash"] + [f"box{i}" for i in range(7)]
+    queue = JobQueue(str(farm / "farm.db"), lease_seconds=2)
+    _add_boxes(queue, farm, names)
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_run_worker, args=(str(farm / "farm.db"), f"worker{i}")) for i in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(timeout=60)
+        assert not w.is_alive()
+
+    jobs = {j["box"]: j for j in queue.jobs()}
+    assert {j["status"] for j in jobs.values()} == {"done"}
+    assert jobs["crash"]["attempts"] == 2
+    assert all(jobs[name]["attempts"] == 1 for name in names[1:])
+    # One of the workers died, the others kept working through the queue
+    assert sorted(w.exitcode for w in workers).count(0) == 2
+
+    calls = [line.split("\t") for line in (farm / "calls.log").read_text().splitlines()]
+    ups = [os.path.basename(cwd) for tool, cwd, args in calls if tool == "vagrant" and args == "up"]
+    assert sorted(ups) == sorted(names + ["crash"])
+    for name in names:
+        assert (farm / "boxes" / name / "disk.vdi").stat().st_size == 1024 * 1024
+    queue.close()
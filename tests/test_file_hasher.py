@@ -0,0 +1,38 @@
+import os
+
+from file_hasher import FileHasher, HardLinks
+
+
+def _make_links(root, name, nlink):
+    (root / name).write_bytes(name.encode() * 1000)
+    for i in range(1, nlink):
+        os.link(root / name, root / f"{name}.link{i}")
+
+
+def test_hard_links_are_read_once_and_forgotten(tmp_path):
+    _make_links(tmp_path, "a", 3)
+    _make_links(tmp_path, "b", 2)
+    (tmp_path / "c").write_bytes(b"c")
+    links = HardLinks()
+
+    digests = {os.path.basename(d.path): d for d in FileHasher(workers=2).hash_tree(str(tmp_path), links=links)}
+
+    assert sorted(digests) == ["a", "a.link1", "a.link2", "b", "b.link1", "c"]
+    assert digests["a.link2"].md5 == digests["a"].md5
+    assert (links.stats.files, links.stats.bytes) == (3, 3 * 1000)
+    # All links of both files were seen, so none of them is kept any longer
+    assert not links._first
+
+
+def test_links_beyond_window_are_read_again(tmp_path):
+    for name in ("a", "b", "c"):
+        _make_links(tmp_path, name, 2)
+    paths = [str(tmp_path / n) for n in ("a", "b", "c", "b.link1", "c.link1", "a.link1")]
+    links = HardLinks(window=2)
+
+    digests = list(FileHasher(workers=2).hash_paths(paths, links=links))
+
+    assert len(digests) == 6
+    # "a" was dropped, when "c" was found, so only the links of "b" and "c" were taken over
+    assert links.stats.files == 2
+    assert len(links._first) == 1
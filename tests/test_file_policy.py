@@ -0,0 +1,127 @@
+import re
+
+import pytest
+
+from file_policy import FilePolicy, detect_type, glob_to_regex, parse_size
+
+ELF = b"\x7fELF\x02\x01\x01" + bytes(9)
+PE = b"MZ\x90\x00\x03" + bytes(59)
+
+
+@pytest.mark.parametrize("glob, path, matches", [
+    # Anchored at the root of the volume
+    ("/pagefile.sys", "/pagefile.sys", True),
+    ("/pagefile.sys", "/backup/pagefile.sys", False),
+    ("/Windows/Temp/**", "/Windows/Temp/a/b.tmp", True),
+    ("/Windows/Temp/**", "/Old/Windows/Temp/a.tmp", False),
+    ("/Windows/Temp/**", "/Windows/Temporary/a.tmp", False),
+    # Unanchored globs match at any depth, but only whole path components
+    ("*.tmp", "/a.tmp", True),
+    ("*.tmp", "/a/b/c.tmp", True),
+    ("*.tmp", "/a/b.tmp/c", False),
+    ("Temp/**", "/Windows/Temp/a", True),
+    ("Temp/**", "/Windows/MyTemp/a", False),
+    # "*" and "?" stay within a directory, "**" crosses them
+    ("/Users/*/AppData/**", "/Users/alice/AppData/x", True),
+    ("/Users/*/AppData/**", "/Users/alice/old/AppData/x", False),
+    ("/Users/?/x", "/Users/a/x", True),
+    ("/Users/?/x", "/Users/ab/x", False),
+    ("/Users/?/x", "/Users///x", False),
+    ("/Windows/**/*.dll", "/Windows/a.dll", True),
+    ("/Windows/**/*.dll", "/Windows/System32/drivers/a.dll", True),
+    ("/Windows/**/*.dll", "/Program Files/a.dll", False),
+    ("**/INetCache/**", "/Users/a/AppData/Local/Microsoft/Windows/INetCache/IE/x.jpg", True),
+    ("/a/**", "/a/", True),
+    # Regular expression characters are literals
+    ("/$Recycle.Bin/**", "/$Recycle.Bin/S-1-5-21/x", True),
+    ("/$Recycle.Bin/**", "/$RecycleXBin/S-1-5-21/x", False),
+    ("/a+b(1).txt", "/a+b(1).txt", True),
+    ("/a+b(1).txt", "/aab1.txt", False),
+])
+def test_glob_to_regex(glob, path, matches):
+    assert bool(re.match(glob_to_regex(glob) + "$", path)) == matches
+
+
+@pytest.mark.parametrize("policy, path, size, reason", [
+    (dict(exclude=["/pagefile.sys"]), "/pagefile.sys", 1, "excluded"),
+    # Case is folded by default, as NTFS and FAT do
+    (dict(exclude=["/pagefile.sys"]), "/PAGEFILE.SYS", 1, "excluded"),
+    (dict(exclude=["/pagefile.sys"], case_sensitive=True), "/PAGEFILE.SYS", 1, None),
+    (dict(exclude=["*.TMP"]), "/a/b.tmp", 1, "excluded"),
+    (dict(include=["/Windows/**"]), "/windows/notepad.exe", 1, None),
+    (dict(include=["/Windows/**"]), "/Users/a.exe", 1, "not included"),
+    (dict(include=["/Windows/**"], case_sensitive=True), "/windows/notepad.exe", 1, "not included"),
+    # Several globs of a kind are alternatives
+    (dict(include=["*.dll", "*.exe"]), "/a/b.exe", 1, None),
+    # Excludes win over includes
+    (dict(include=["/Windows/**"], exclude=["/Windows/Temp/**"]), "/Windows/Temp/a", 1, "excluded"),
+    # Size limits are inclusive
+    (dict(min_size=10), "/a", 9, "too small"),
+    (dict(min_size=10), "/a", 10, None),
+    (dict(max_size=10), "/a", 10, None),
+    (dict(max_size=10), "/a", 11, "too large"),
+    (dict(min_size=0), "/empty", 0, None),
+    (dict(), "/anything", 0, None),
+])
+def test_check_path(policy, path, size, reason):
+    assert FilePolicy(**policy).check_path(path, size) == reason
+
+
+@pytest.mark.parametrize("path", [
+    "/pagefile.sys", "/hiberfil.sys", "/$RECYCLE.BIN/S-1-5-21/$R1.doc", "/System Volume Information/tracking.log",
+    "/Windows/Temp/x", "/Users/alice/AppData/Local/Temp/x",
+    "/Users/alice/AppData/Local/Google/Chrome/User Data/Default/Cache/f_000001",
+])
+def test_volatile_excludes(path):
+    policy = FilePolicy.from_config({"exclude_volatile": True})
+
+    assert policy.check_path(path, 1) == "excluded"
+    assert policy.check_path("/Windows/System32/kernel32.dll", 1) is None
+
+
+@pytest.mark.parametrize("value, size", [
+    (None, None), (4096, 4096), ("4096", 4096), ("512K", 512 * 1024), ("2G", 2 * 1024 ** 3), ("1 MiB", 1024 ** 2),
+    ("3mb", 3 * 1024 ** 2), ("1T", 1024 ** 4),
+])
+def test_parse_size(value, size):
+    assert parse_size(value) == size
+
+
+@pytest.mark.parametrize("value", ["", "1.5G", "-1", "12X", "G"])
+def test_parse_invalid_size(value):
+    with pytest.raises(ValueError):
+        parse_size(value)
+
+
+@pytest.mark.parametrize("header, file_type", [
+    (PE, "pe"), (ELF, "elf"), (b"\xcf\xfa\xed\xfe" + bytes(12), "macho"), (b"#!/bin/sh\n", "script"),
+    (b"PK\x03\x04", "zip"), (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "ole"),
+    # Truncated or unknown signatures
+    (b"M", None), (b"\x7fEL", None), (b"", None), (b"ZM\x90\x00", None), (b"hello world", None),
+])
+def test_detect_type(header, file_type):
+    assert detect_type(header) == file_type
+
+
+@pytest.mark.parametrize("types, header, reason", [
+    (["executable"], PE, None),
+    (["executable"], ELF, None),
+    (["executable"], b"#!/bin/sh\n", "type"),
+    (["executable"], b"", "type"),
+    (["pe"], ELF, "type"),
+    (["elf"], ELF, None),
+    (["elf", "script"], b"#!/bin/sh\n", None),
+    # Headers are handed over as views on the read buffer
+    (["pe"], memoryview(bytearray(PE)), None),
+    ([], b"anything", None),
+])
+def test_check_header(types, header, reason):
+    policy = FilePolicy(types=types)
+
+    assert policy.needs_header == bool(types)
+    assert policy.check_header(header) == reason
+
+
+def test_unknown_type_is_rejected():
+    with pytest.raises(ValueError):
+        FilePolicy(types=["exe"])
@@ -0,0 +1,100 @@
+import time
+import threading
+
+from file_hasher import FileDigest, FileHasher
+from hash_cache import HashCache
+
+
+def _hash(cache, hasher, root):
+    return {digest.path: is_new for digest, is_new in cache.hash_tree(hasher, str(root), "box", "C")}
+
+
+def test_interrupted_run_is_rolled_back(tmp_path):
+    root = tmp_path / "volume"
+    root.mkdir()
+    for i in range(10):
+        (root / f"{i}.txt").write_text(str(i))
+    cache = HashCache(str(tmp_path / "cache.db"))
+    cache.COMMIT_INTERVAL = 2
+
+    hasher = FileHasher(workers=2)
+    assert set(_hash(cache, hasher, root).values()) == {True}
+    assert set(_hash(cache, hasher, root).values()) == {False}
+
+    # A new file is hashed, but the run is interrupted before the volume is complete
+    (root / "new.txt").write_text("new")
+    results = cache.hash_tree(hasher, str(root), "box", "C")
+    interrupted = {next(results)[0].path for _ in range(6)}
+    results.close()
+
+    # The redone run reads the files of the interrupted run again, they were not delivered in its hash lists
+    redone = _hash(cache, hasher, root)
+    assert {path for path, is_new in redone.items() if is_new} == interrupted | {str(root / "new.txt")}
+    assert set(_hash(cache, hasher, root).values()) == {False}
+
+    cache.close()
+
+
+def test_entries_without_digest_are_skipped(tmp_path):
+    cache = HashCache(str(tmp_path / "cache.db"))
+    hasher = FileHasher(workers=2)
+    entries = [(i, f"/mnt/{i}", str(i), (i, i, i), 0.0) for i in range(20)]
+
+    def hash_entry(i):
+        # Every third file cannot be read
+        return None if i % 3 == 0 else FileDigest(f"/mnt/{i}", i, 0.0, f"md5-{i}", "", "")
+
+    first = [(d.path, is_new) for d, is_new in cache.hash_entries(hasher, entries, hash_entry, "box", "C")]
+    assert first == [(f"/mnt/{i}", True) for i in range(20) if i % 3]
+
+    # Every digest was stored under the key of its own entry
+    rows = cache.db.execute("SELECT path, size, md5 FROM files ORDER BY size").fetchall()
+    assert rows == [(str(i), i, f"md5-{i}") for i in range(20) if i % 3]
+
+    second = [(d.path, is_new) for d, is_new in cache.hash_entries(hasher, entries, hash_entry, "box", "C")]
+    assert second == [(f"/mnt/{i}", False) for i in range(20) if i % 3]
+    cache.close()
+
+
+def _slow_hash(hasher, path):
+    time.sleep(0.01)
+    return hasher._try_hash_file(path)
+
+
+def test_concurrent_caches_share_database(tmp_path, monkeypatch):
+    # Far less than hashing takes, so a write transaction held open across the files would lock out the other box
+    monkeypatch.setattr(HashCache, "LOCK_TIMEOUT", 0.5)
+    db_path = str(tmp_path / "cache.db")
+    hasher = FileHasher(workers=2)
+    roots = []
+    for box in ("a", "b"):
+        root = tmp_path / box
+        root.mkdir()
+        for i in range(300):
+            (root / f"{i}.txt").write_text(f"{box}{i}")
+        roots.append(root)
+
+    def run(box, root, results):
+        cache = HashCache(db_path)
+        cache.COMMIT_SECONDS = 0.1
+        try:
+            entries = ((str(p), str(p), p.name, cache._file_key(p.stat()), 0.0) for p in sorted(root.iterdir()))
+            results[box] = sum(is_new for _, is_new in cache.hash_entries(
+                hasher, entries, lambda path: _slow_hash(hasher, path), box, "C"))
+        except Exception as e:
+            results[box] = e
+        finally:
+            cache.close()
+
+    # Both boxes write their digests for seconds, neither one may be locked out by the other
+    results = {}
+    threads = [threading.Thread(target=run, args=(box, root, results)) for box, root in zip("ab", roots)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == {"a": 300, "b": 300}
+    cache = HashCache(db_path)
+    assert cache.db.execute("SELECT box, COUNT(*) FROM files GROUP BY box").fetchall() == [("a", 300), ("b", 300)]
+    cache.close()
@@ -0,0 +1,28 @@
+import asyncio
+
+import pytest
+
+from lookup_service import MAX_BODY_SIZE, HTTPError, LookupServer
+
+
+def _read(request):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(request)
+        reader.feed_eof()
+        return await LookupServer._read_request(reader)
+
+    return asyncio.run(read())
+
+
+def test_request_with_body():
+    method, target, headers, body = _read(b"POST /lookup HTTP/1.1\r\nContent-Length: 4\r\n\r\nabcd")
+    assert (method, target, headers["content-length"], body) == ("POST", "/lookup", "4", b"abcd")
+
+
+@pytest.mark.parametrize("length, status", [("abc", 400), ("-1", 400), ("1e3", 400), ("\xb2", 400),
+                                            (str(MAX_BODY_SIZE + 1), 413)])
+def test_invalid_content_length(length, status):
+    with pytest.raises(HTTPError) as e:
+        _read(f"POST /lookup HTTP/1.1\r\nContent-Length: {length}\r\n\r\n".encode("latin-1"))
+    assert e.value.status == status
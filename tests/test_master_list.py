@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import master_list
+from master_list import MasterListBuilder
+
+
+class Interrupted(Exception):
+    pass
+
+
+def _write_hashlist(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for md5, p in records:
+            f.write(f"{md5}  {p}\n")
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    _write_hashlist(first, [("b" * 32, "/bin/b"), ("a" * 32, "/bin/a"), ("c" * 32, "/bin/c")])
+    _write_hashlist(second, [("a" * 32, "/bin/a"), ("a" * 32, "/usr/bin/a"), ("d" * 32, "/bin/d")])
+    return [str(first), str(second)]
+
+
+def test_interrupted_merge_resumes_from_manifest(tmp_path, inputs, monkeypatch):
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    output = str(output_dir / "master")
+    work_dir = str(tmp_path / "work")
+
+    def interrupt(lines):
+        raise Interrupted()
+
+    # Interrupt the final merge, after all inputs were sorted into runs
+    with monkeypatch.context() as m:
+        m.setattr(master_list, "_unique", interrupt)
+        with pytest.raises(Interrupted):
+            MasterListBuilder(output, work_dir, workers=1, run_size=2).build(inputs)
+
+    assert os.path.isfile(os.path.join(work_dir, master_list.MANIFEST_FILE))
+    # Neither a partial master list nor its temporary file is left behind
+    assert os.listdir(output_dir) == []
+
+    def sort_again(self, inputs):
+        raise AssertionError("Inputs sorted again instead of resuming")
+
+    monkeypatch.setattr(MasterListBuilder, "_sort_inputs", sort_again)
+    stats = MasterListBuilder(output, work_dir, workers=1, run_size=2).build(inputs)
+
+    assert stats == {"inputs": 2, "runs": 4, "records": 5, "digests": 4}
+    with open(output, encoding="utf-8") as f:
+        assert f.read() == (f"{'a' * 32}  /bin/a\n{'a' * 32}  /usr/bin/a\n{'b' * 32}  /bin/b\n"
+                            f"{'c' * 32}  /bin/c\n{'d' * 32}  /bin/d\n")
+    assert os.listdir(output_dir) == ["master"]
+    assert not os.path.exists(work_dir)
@@ -0,0 +1,38 @@
+import pytest
+
+from raw_image_processor import EXT_SUPERBLOCK_OFFSET, RawImageProcessor
+
+
+class _Image:
+    """
+    Image with an ext superblock at the given offset, read like pytsk3.Img_Info.
+    """
+
+    def __init__(self, offset, volume_name=b"", last_mounted=b""):
+        sb = bytearray(1024)
+        sb[0x78:0x78 + len(volume_name)] = volume_name
+        sb[0x88:0x88 + len(last_mounted)] = last_mounted
+        self.data = bytes(offset + EXT_SUPERBLOCK_OFFSET) + bytes(sb)
+
+    def read(self, offset, size):
+        return self.data[offset:offset + size]
+
+
+@pytest.mark.parametrize("args, label", [
+    # Partitions keep their address in the volume system, e.g. 2 after the meta entries of an MBR
+    ((2, "System Reserved", None, "ntfs"), "2-System_Reserved"),
+    ((3, None, None, "ntfs"), "3-ntfs"),
+    ((0, None, None, None), "0-volume"),
+    ((5, "cloudimg-rootfs", "/", "ext"), "5-cloudimg-rootfs"),
+    ((5, None, "/", "ext"), "5-root"),
+    ((6, None, "/boot", "ext"), "6-boot"),
+    ((1, "(data)", None, "fat"), "1-data"),
+])
+def test_volume_label(args, label):
+    assert RawImageProcessor._volume_label(*args) == label
+
+
+def test_read_ext_label():
+    img = _Image(1048576, b"cloudimg-rootfs", b"/")
+    assert RawImageProcessor._read_ext_label(img, 1048576) == ("cloudimg-rootfs", "/")
+    assert RawImageProcessor._read_ext_label(_Image(0), 0) == (None, None)
@@ -0,0 +1,24 @@
+import argparse
+
+from hashlist import HashlistWriter, format_md5sum
+from results_tool import cmd_diff
+
+
+def _write(prefix, records):
+    with HashlistWriter(prefix, "jsonl", "gzip") as w:
+        for md5, path in records:
+            w.write_line(format_md5sum(md5, path))
+    return w.path
+
+
+def test_diff_prefix_drops_extensions(tmp_path):
+    old = _write(str(tmp_path / "old"), [("a" * 32, "/a"), ("b" * 32, "/b")])
+    new = _write(str(tmp_path / "new"), [("a" * 32, "/a"), ("c" * 32, "/b"), ("d" * 32, "/d")])
+
+    cmd_diff(argparse.Namespace(box=None, hashlists=[old, new], output=None, tmp_dir=None))
+
+    assert new.endswith(".jsonl.gz")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["new.jsonl.gz", "new_added", "new_changed", "new_removed",
+                                                          "old.jsonl.gz"]
+    assert (tmp_path / "new_added").read_text() == f"{'d' * 32}  /d\n"
+    assert (tmp_path / "new_changed").read_text() == f"{'c' * 32}  /b\n"
@@ -0,0 +1,50 @@
+import logging
+import threading
+
+from scheduler import PipelineScheduler, ResourcePool
+
+
+def _vagrantfiles(*boxes):
+    return [f"/boxes/{box}/Vagrantfile" for box in boxes]
+
+
+def _box(vf):
+    return PipelineScheduler.box_name(vf)
+
+
+def test_failing_stages_do_not_stop_other_boxes(caplog):
+    hashed = []
+    lock = threading.Lock()
+
+    def vm_demand(vf):
+        if _box(vf) == "unreadable":
+            raise OSError("Cannot read Vagrantfile")
+        return 1024, 1
+
+    def vm_stage(vf, reserve_scratch):
+        reserve_scratch(10)
+        if _box(vf) == "noboot":
+            raise RuntimeError("vagrant up failed")
+        return f"{_box(vf)}.img"
+
+    def hash_stage(vf, vm_result):
+        if _box(vf) == "nohash":
+            raise RuntimeError("mount failed")
+        with lock:
+            hashed.append(vm_result)
+
+    resources = ResourcePool(ram=2048, cpus=2, scratch=20)
+    scheduler = PipelineScheduler(vm_stage, hash_stage, vm_demand, resources, max_vms=2, max_hashers=2)
+
+    with caplog.at_level(logging.ERROR):
+        succeeded = scheduler.run(_vagrantfiles("a", "unreadable", "noboot", "nohash", "b"))
+
+    assert succeeded == 2
+    assert sorted(hashed) == ["a.img", "b.img"]
+    # Every failure is logged, including the one before the VM stage started
+    failures = [r.getMessage() for r in caplog.records]
+    assert any("unreadable" in m and "VM stage" in m for m in failures)
+    assert any("noboot" in m and "VM stage" in m for m in failures)
+    assert any("nohash" in m and "Hash stage" in m for m in failures)
+    # Scratch space of failed boxes is released as well
+    assert resources.used == {"ram": 0, "cpus": 0, "scratch": 0}
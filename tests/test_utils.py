@@ -0,0 +1,53 @@
+import json
+import subprocess
+
+import pytest
+
+import metrics
+import utils
+from async_runner import CommandRunner
+
+
+@pytest.fixture
+def records(tmp_path):
+    metrics.configure(str(tmp_path / "metrics.jsonl"))
+    yield lambda: [json.loads(line) for line in (tmp_path / "metrics.jsonl").read_text().splitlines()]
+    metrics.close()
+
+
+def test_stream_raises_on_nonzero_exit(records):
+    lines = []
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        for line in utils.stream_cmd_output(["sh", "-c", "echo a; echo b; exit 3"]):
+            lines.append(line)
+
+    # All output is delivered before the failure
+    assert lines == ["a\n", "b\n"]
+    assert e.value.returncode == 3
+    assert [(r["status"], r["exit_code"]) for r in records()] == [("error", 3)]
+
+
+def test_stream_closed_early_is_no_failure(records):
+    lines = utils.stream_cmd_output(["yes"])
+
+    assert next(lines) == "y\n"
+    lines.close()
+
+    assert [(r["status"], r["error"]) for r in records()] == [("ok", None)]
+
+
+def test_command_timeout_applies_to_control_commands_only(records):
+    runner = CommandRunner(2)
+    utils.set_command_runner(runner, control_timeout=0.5)
+
+    try:
+        # A short control command, which hangs, is killed
+        assert utils.run_shell_cmd(["sleep", "5"], utils.control_timeout()) < 0
+        # Streaming a hash list takes as long as it takes
+        assert list(utils.stream_cmd_output(["sh", "-c", "sleep 1; echo done"])) == ["done\n"]
+    finally:
+        utils.set_command_runner(None)
+        runner.close()
+
+    assert utils.control_timeout() is None
@@ -0,0 +1,130 @@
+import os
+import uuid
+
+import pytest
+
+import sparse
+from vdi_reader import PRE_HEADER, HEADER_1PLUS, VDI_SIGNATURE, VDI_TYPE_DIFF, VDI_BLOCK_FREE, VDI_BLOCK_ZERO
+from virtualbox_vm_handler import VMHandler
+
+MB = 1024 * 1024
+BLOCK_SIZE = MB
+DISK_SIZE = 7 * MB + MB // 2
+VDI_TYPE_DYNAMIC = 1
+OFF_BLOCKS = 512
+OFF_DATA = 4096
+
+
+def _block(fill):
+    return bytes([fill]) * BLOCK_SIZE
+
+
+def _write_vdi(path, blocks, image_uuid, parent_uuid=None):
+    """
+    Writes a VDI of DISK_SIZE bytes. blocks maps block indexes to their data or VDI_BLOCK_ZERO, missing blocks are
+    free. Data blocks are stored in reverse order, so the block map is not the identity.
+    """
+    count = -(-DISK_SIZE // BLOCK_SIZE)
+    block_map = [VDI_BLOCK_FREE] * count
+    stored = []
+
+    for index in sorted(blocks, reverse=True):
+        if blocks[index] == VDI_BLOCK_ZERO:
+            block_map[index] = VDI_BLOCK_ZERO
+        else:
+            block_map[index] = len(stored)
+            stored.append(blocks[index])
+
+    image_type = VDI_TYPE_DIFF if parent_uuid else VDI_TYPE_DYNAMIC
+    linkage = uuid.UUID(parent_uuid) if parent_uuid else uuid.UUID(int=0)
+
+    with open(path, "wb") as f:
+        f.write(PRE_HEADER.pack(b"<<< Oracle VM VirtualBox Disk Image >>>\n", VDI_SIGNATURE, 0x00010001))
+        f.write(HEADER_1PLUS.pack(HEADER_1PLUS.size, image_type, b"", OFF_BLOCKS, OFF_DATA, DISK_SIZE, BLOCK_SIZE, 0,
+                                  count, len(stored), uuid.UUID(image_uuid).bytes_le, uuid.uuid4().bytes_le,
+                                  linkage.bytes_le, bytes(16)))
+        f.seek(OFF_BLOCKS)
+        f.write(b"".join(entry.to_bytes(4, "little") for entry in block_map))
+        f.seek(OFF_DATA)
+        f.write(b"".join(stored))
+
+
+def _raw_image(blocks):
+    """
+    Returns the content of the virtual disk, blocks maps block indexes to their data.
+    """
+    image = bytearray(DISK_SIZE)
+    for index, data in blocks.items():
+        image[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE] = data
+    return bytes(image[:DISK_SIZE])
+
+
+def _extents(path):
+    with open(path, "rb") as f:
+        return list(sparse.data_extents(f))
+
+
+def _export(leaf_path, dest_path, monkeypatch):
+    handler = VMHandler("vm-uuid", "vagrant", "vagrant")
+    # The VDI is located through showvminfo, which is answered by the fixture instead
+    handler._info = object()
+    monkeypatch.setattr(VMHandler, "retrieve_hdd_path", staticmethod(lambda uuid_vm, info=None: leaf_path))
+    handler.dump_vm_vdi(dest_path)
+
+
+@pytest.fixture
+def chain(tmp_path):
+    base_uuid, diff_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+    # Block 1 is free and block 2 zeroed, block 3 is allocated, but holds zeros only
+    base_blocks = {0: _block(0xA0), 2: VDI_BLOCK_ZERO, 3: _block(0), 5: _block(0xA5), 6: _block(0xA6),
+                   7: _block(0xA7)}
+    # Block 0 is discarded, block 1 written, block 6 overwritten, all others are taken from the base
+    diff_blocks = {0: VDI_BLOCK_ZERO, 1: _block(0xD1), 6: _block(0xD6)}
+
+    base_path = str(tmp_path / "disk.vdi")
+    _write_vdi(base_path, base_blocks, base_uuid)
+    os.mkdir(tmp_path / "Snapshots")
+    diff_path = str(tmp_path / "Snapshots" / f"{{{diff_uuid}}}.vdi")
+    _write_vdi(diff_path, diff_blocks, diff_uuid, base_uuid)
+
+    # Holes are only detected on file systems supporting SEEK_HOLE
+    probe = str(tmp_path / "probe")
+    with open(probe, "wb") as f:
+        f.truncate(2 * MB)
+    if _extents(probe):
+        pytest.skip("File system of the temporary directory does not report holes")
+
+    return base_path, diff_path
+
+
+def test_dynamic_vdi_is_exported_sparsely(tmp_path, chain, monkeypatch):
+    dest = str(tmp_path / "base.dd")
+    _export(chain[0], dest, monkeypatch)
+
+    with open(dest, "rb") as f:
+        assert f.read() == _raw_image({0: _block(0xA0), 5: _block(0xA5), 6: _block(0xA6), 7: _block(0xA7)})
+    # Free, zeroed and all-zero blocks are holes
+    assert _extents(dest) == [(0, MB), (5 * MB, DISK_SIZE)]
+
+
+def test_differencing_vdi_is_exported_with_its_parent(tmp_path, chain, monkeypatch):
+    dest = str(tmp_path / "leaf.dd")
+    _export(chain[1], dest, monkeypatch)
+
+    with open(dest, "rb") as f:
+        assert f.read() == _raw_image({1: _block(0xD1), 5: _block(0xA5), 6: _block(0xD6), 7: _block(0xA7)})
+    assert _extents(dest) == [(MB, 2 * MB), (5 * MB, DISK_SIZE)]
+
+
+def test_truncated_vdi_falls_back_to_clonemedium(tmp_path, chain, monkeypatch):
+    base_path = chain[0]
+    os.truncate(base_path, os.path.getsize(base_path) - MB // 2)
+    cloned = []
+    monkeypatch.setattr(VMHandler, "retrieve_hdd_uuid", staticmethod(lambda uuid_vm, is_verbose=False, info=None: "hdd"))
+    monkeypatch.setattr(VMHandler, "write_raw_img", staticmethod(lambda uuid_hdd, file_path: cloned.append(file_path)))
+    monkeypatch.setattr(sparse, "dig_holes", lambda path: 0)
+
+    dest = str(tmp_path / "base.dd")
+    _export(base_path, dest, monkeypatch)
+
+    assert cloned == [dest]
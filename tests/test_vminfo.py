@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from vminfo import VMInfo
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def _load(name):
+    with open(os.path.join(FIXTURES, f"showvminfo_{name}.txt"), encoding="utf-8") as f:
+        return VMInfo.parse(f.read())
+
+
+def test_running_vm():
+    info = _load("running")
+
+    assert (info.name, info.uuid, info.state) == ("win10_default_1614593521862_41877",
+                                                  "6f1b9c3e-2a44-4d8b-9b61-0e5a7c2d9f10", "running")
+    # Values with trailing text after the closing quote do not swallow the following lines
+    assert info.values["VideoMode"] == '"1024,768,32"@0,0 1'
+    assert info.values["vrde"] == "off"
+    assert info.values["Forwarding(1)"] == "winrm,tcp,127.0.0.1,55985,,5985"
+    assert info.values["GuestAdditionsFacility_VirtualBox Base Driver"] == "50,1614593601402"
+    assert info.snapshots == {}
+    assert info.current_snapshot is None
+    assert info.find_snapshot("base") is None
+
+    disk = info.find_disk()
+    assert disk.controller == "SATA Controller"
+    assert disk.medium.endswith("/WindowsBaseBox-disk001.vmdk")
+    assert disk.uuid == "3c0e7a52-81d4-4f0b-a1c6-5d2e9b7f4a31"
+
+
+def test_nested_snapshots():
+    info = _load("snapshots")
+    root = info.root_snapshot
+
+    assert [(s.node, s.name) for s in root.walk()] == [("", "base"), ("-1", "provisioned"), ("-1-1", "cumulate"),
+                                                       ("-1-2", "experiment"), ("-2", "cumulate")]
+    assert info.current_snapshot.uuid == "71c3e5a7-9d0f-4b2c-8a46-b8d0f2a4c6e8"
+    assert info.current_snapshot.parent.name == "provisioned"
+    assert info.current_snapshot.description == ("Cumulated state of run 2\n\nInstalled:\n- KB4601347\n"
+                                                 '- "Chrome" 88.0')
+    # Keys following the multi-line description are parsed as usual
+    assert info.values["CurrentSnapshotName"] == "cumulate"
+
+    # Of two snapshots with the same name, the current one wins
+    assert info.find_snapshot("cumulate") is info.current_snapshot
+    assert info.find_snapshot("experiment").uuid == "a0b2c4d6-e8f0-4a1c-9e3b-5d7f9b1d3f57"
+    assert info.find_snapshot("base") is root
+    assert info.find_snapshot("missing") is None
+
+    assert info.find_disk(["SATA Controller"]).uuid == "8e2f4a6c-1b3d-4c5e-9f70-a1b2c3d4e5f6"
+
+
+def test_multiple_controllers():
+    info = _load("controllers")
+
+    assert [(c.name, c.type, c.instance, c.port_count, c.bootable) for c in info.controllers] == [
+        ("IDE Controller", "PIIX4", 0, 2, True), ("SATA", "IntelAhci", 0, 2, True),
+        ("SATA-Data", "IntelAhci", 1, 1, False)]
+    # Empty slots and drives are no attachments, a dash in a controller name does not confuse the slots
+    assert [(a.controller, a.port, a.device) for a in info.attachments] == [("SATA", 0, 0), ("SATA", 1, 0),
+                                                                           ("SATA-Data", 0, 0)]
+
+    assert info.find_disk(["IDE Controller", "SATA"]).uuid == "c7e9a1b3-d5f7-4a9c-8e0b-2d4f6a8c0e13"
+    assert info.find_disk(["sata-data"]).medium == "/home/hashlab/disks/data.vdi"
+    assert info.find_disk(["SATA"], port=1).medium.endswith("-configdrive.vmdk")
+    assert info.find_disk(["IDE Controller"]) is None
+
+
+@pytest.mark.parametrize("name", ["running", "snapshots", "controllers"])
+def test_no_values_are_lost(name):
+    with open(os.path.join(FIXTURES, f"showvminfo_{name}.txt"), encoding="utf-8") as f:
+        lines = f.read().splitlines()
+
+    # Every line holds a key of its own, except the continuation lines of the multi-line description
+    assert len(_load(name).values) == len(lines) - (4 if name == "snapshots" else 0)
@@ -0,0 +1,43 @@
+from whitelist_store import WhitelistStore
+
+MD5 = ["%032x" % i for i in range(10)]
+
+
+def test_paths_with_line_breaks_round_trip(tmp_path):
+    store = WhitelistStore(str(tmp_path / "store"))
+    store.add_records([(MD5[1], "/before"), (MD5[2], "/weird\nname"), (MD5[3], "/after")], "box", "C", "run1")
+    store.close()
+
+    # The path table is loaded again, before new paths are appended
+    store = WhitelistStore(str(tmp_path / "store"))
+    store.add_records([(MD5[4], "/new"), (MD5[3], "/after"), (MD5[5], "/weird\nname")], "box", "C", "run2")
+
+    assert [r["path"] for r in store.find(MD5[2])] == ["/weird\nname"]
+    assert [(r["path"], r["run"]) for r in store.find(MD5[3])] == [("/after", "run1"), ("/after", "run2")]
+    assert [r["path"] for r in store.find(MD5[4])] == ["/new"]
+    assert [r["path"] for r in store.find(MD5[5])] == ["/weird\nname"]
+    # Known paths are not appended again
+    assert len(store._path_offsets) == 4
+    store.close()
+
+
+def test_merge_keeps_provenance(tmp_path):
+    store = WhitelistStore(str(tmp_path / "store"))
+    # Small runs, so appending spills and merges several of them
+    store.RUN_SIZE = 3
+    records = [(MD5[i % 7], f"/file{i % 7}") for i in range(20, 0, -1)]
+    assert store.add_records(records, "box", "C", "run1") == 20
+    store.add_records([(MD5[1], "/file1"), (MD5[2], "/other")], "box", "C", "run2")
+    store.add_records([(MD5[1], "/file1")], "box2", "D", "run1")
+
+    segment = list(store.segments[0])
+    assert segment == sorted(segment)
+
+    # Only identical records are dropped, every run containing a file is kept
+    assert store.merge() == 7 + 2 + 1
+    assert [(r["path"], r["box"], r["run"]) for r in store.find(MD5[1])] == [
+        ("/file1", "box", "run1"), ("/file1", "box", "run2"), ("/file1", "box2", "run1")]
+
+    assert store.merge(first_seen_only=True) == 7 + 1
+    assert [(r["path"], r["run"]) for r in store.find(MD5[2])] == [("/file2", "run1"), ("/other", "run2")]
+    store.close()
@@ -1,8 +1,11 @@
 __author__ = "6ru"
 
+import os
 import logging
 import subprocess
+import threading
 import yaml
+import metrics
 #from pydub import AudioSegment
 #from pydub.playback import play
 
@@ -22,42 +25,161 @@ def read_config(config):
     return params
 
 
-def run_shell_cmd(cmd):
+def _command_label(cmd):
+    # Program and subcommand, e.g. "VBoxManage clonemedium", without arguments like paths or UUIDs
+    return " ".join(os.path.basename(c) if i == 0 else c for i, c in enumerate(cmd[:2]))
+
+
+# Optional CommandRunner, which executes the commands instead of Popen, see set_command_runner
+_runner = None
+# Timeout of short control commands, see set_command_runner
+_control_timeout = None
+
+
+def set_command_runner(runner, control_timeout=None):
     """
-    Takes a command and executes it with the help of Popen.
+    Lets run_shell_cmd, run_cmd_with_output and stream_cmd_output execute their commands with the given
+    async_runner.CommandRunner, which limits the number of concurrent commands and enforces timeouts. Passing None
+    restores plain Popen.
 
-    :param cmd: the command to execute in form of a list
-    :return: rc, status code of the process
+    :param runner: CommandRunner or None
+    :param control_timeout: timeout in seconds of short control commands like VBoxManage showvminfo or umount, see
+    control_timeout; long running commands like cloning or hashing are not timed out
+    """
+    global _runner, _control_timeout
+    _runner = runner
+    _control_timeout = control_timeout
+
+
+def get_command_runner():
+    return _runner
+
+
+def control_timeout():
+    """
+    Returns the timeout to pass to short control commands, None for no timeout.
+    """
+    return _control_timeout
+
+
+def _communicate(cmd, timeout=None):
+    """
+    Runs a command to completion and returns rc, stdout and stderr as strings.
     """
-    # Run cmd
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if _runner is not None:
+        result = _runner.run_sync(cmd, timeout=timeout)
+        return result.returncode, result.stdout, result.stderr
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               encoding="utf-8", errors="surrogateescape")
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.error(f"{cmd[0]} timed out after {timeout}s, killing it")
+        process.kill()
+        stdout, stderr = process.communicate()
+
+    return process.returncode, stdout, stderr
 
-    # Catch stdout and stderr
-    stdout, stderr = process.communicate()
 
-    rc = process.wait()
+def run_shell_cmd(cmd, timeout=None):
+    """
+    Takes a command and executes it with the help of Popen or the command runner, if one is set.
+
+    :param cmd: the command to execute in form of a list
+    :param timeout: optional timeout in seconds, after which the command is killed
+    :return: rc, status code of the process
+    """
+    with metrics.stage("command", command=_command_label(cmd)) as s:
+        # Run cmd and catch stdout and stderr
+        rc, stdout, stderr = _communicate(cmd, timeout)
+        s.add(nbytes=len(stdout))
+        s.exit_code = rc
 
     # Logs result
     if stdout:
-        logger.info(stdout.strip().decode("utf-8"))
+        logger.info(stdout.strip())
     if stderr:
-        logger.info(stderr.strip().decode("utf-8"))
+        logger.info(stderr.strip())
 
     return rc
 
 
-def run_cmd_with_output(cmd):
+def run_cmd_with_output(cmd, timeout=None):
     """
-    Takes a command and executes it with the help of Popen. The stdout will be received and returned.
+    Takes a command and executes it with the help of Popen or the command runner, if one is set. The stdout will be
+    received and returned.
     :param cmd: the command to execute in form of a list
+    :param timeout: optional timeout in seconds, after which the command is killed
     :return: stdout, a string containing the contents stdout
     """
-    # Run cmd
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # Catch stdout and stderr
-    stdout, stderr = process.communicate()
+    with metrics.stage("command", command=_command_label(cmd)) as s:
+        rc, stdout, stderr = _communicate(cmd, timeout)
+        s.add(nbytes=len(stdout))
+        s.exit_code = rc
+
+    return stdout
 
-    return stdout.decode("utf-8")
+
+def stream_cmd_output(cmd, timeout=None):
+    """
+    Takes a command and executes it with the help of Popen or the command runner, if one is set. In contrast to
+    run_cmd_with_output, stdout is not buffered but yielded line by line as soon as the process produces it, so memory
+    use does not depend on the amount of output. Stderr is drained in the background and logged. If the consumer
+    closes the generator early, the command is killed.
+
+    :param cmd: the command to execute in form of a list
+    :param timeout: optional timeout in seconds, only enforced by the command runner
+    :return: generator of lines of stdout, including their line endings
+    :raises subprocess.CalledProcessError: if the command exits with a nonzero status, after all of its output
+    """
+    with metrics.stage("command", command=_command_label(cmd)) as s:
+        if _runner is not None:
+            lines = _runner.stream(cmd, timeout=timeout, on_stderr=lambda line: logger.info(line.strip()))
+            try:
+                while True:
+                    try:
+                        line = next(lines)
+                    except StopIteration as e:
+                        # The generator returns the CommandResult
+                        rc = s.exit_code = e.value.returncode
+                        break
+                    s.add(nbytes=len(line))
+                    yield line
+            finally:
+                # Kills the command, if the consumer stopped early
+                lines.close()
+
+            if rc:
+                raise subprocess.CalledProcessError(rc, cmd)
+            return
+
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   encoding="utf-8", errors="surrogateescape")
+
+        def drain_stderr():
+            for line in process.stderr:
+                logger.info(line.strip())
+
+        stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+        stderr_thread.start()
+
+        try:
+            for line in process.stdout:
+                s.add(nbytes=len(line))
+                yield line
+        except GeneratorExit:
+            # The consumer stopped early, the rest of the output is not needed
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            rc = process.wait()
+            stderr_thread.join()
+
+        s.exit_code = rc
+        if rc:
+            raise subprocess.CalledProcessError(rc, cmd)
 
 
 def run_basic_shell_cmd(cmd):
@@ -65,8 +187,9 @@ def run_basic_shell_cmd(cmd):
     Takes a command and executes it with the help of Popen.
     """
 
-    # Run cmd
-    subprocess.run(cmd, shell=True, check=True)
+    with metrics.stage("command", command=_command_label(cmd.split())):
+        # Run cmd
+        subprocess.run(cmd, shell=True, check=True)
 
 
 def wait_for_confirm():
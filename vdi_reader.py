@@ -0,0 +1,338 @@
+import io
+import os
+import uuid
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+VDI_SIGNATURE = 0xBEDA107F
+VDI_TYPE_DIFF = 4
+
+# Special block map entries
+VDI_BLOCK_FREE = 0xFFFFFFFF
+VDI_BLOCK_ZERO = 0xFFFFFFFE
+
+# Pre-header (64 byte text, signature, version) and the fields of the version 1.1 header, which are needed for reading
+PRE_HEADER = struct.Struct("<64sII")
+HEADER_1PLUS = struct.Struct("<II4x256sII16x4xQIIII16s16s16s16s")
+
+
+class VDIImage(io.RawIOBase):
+    """
+    Read-only, seekable view on the virtual disk contained in a VirtualBox VDI file. Blocks are resolved through the
+    block map, unallocated blocks read as zeros. Differencing images (snapshots) delegate unallocated blocks to their
+    parent, so the leaf of a snapshot chain exposes the disk exactly like VBoxManage clonemedium would, without
+    creating a copy.
+    """
+
+    def __init__(self, path, parent=None):
+        """
+        Opens a VDI file
+
+        :param path: path to the VDI file
+        :param parent: VDIImage of the parent, required for differencing images
+        """
+        super().__init__()
+        self.path = path
+        self.parent = parent
+        self._f = open(path, "rb")
+        self._pos = 0
+        self._parse_header()
+
+        if self.image_type == VDI_TYPE_DIFF and parent is None:
+            raise ValueError(f"{path} is a differencing image, but no parent was given")
+        if parent is not None and parent.uuid != self.parent_uuid:
+            raise ValueError(f"{parent.path} is not the parent of {path}")
+
+    def _parse_header(self):
+        _, signature, self.version = PRE_HEADER.unpack(self._f.read(PRE_HEADER.size))
+
+        if signature != VDI_SIGNATURE:
+            raise ValueError(f"{self.path} is not a VDI file")
+        if self.version >> 16 != 1:
+            raise ValueError(f"Unsupported VDI version {self.version:#x} of {self.path}")
+
+        (_, self.image_type, _, off_blocks, self.off_data, self.size, self.block_size, self.block_extra,
+         blocks, self.blocks_allocated, uuid_create, _, uuid_linkage, _) = HEADER_1PLUS.unpack(
+            self._f.read(HEADER_1PLUS.size))
+
+        self.uuid = str(uuid.UUID(bytes_le=uuid_create))
+        self.parent_uuid = str(uuid.UUID(bytes_le=uuid_linkage))
+
+        self._f.seek(off_blocks)
+        self.block_map = struct.unpack(f"<{blocks}I", self._f.read(4 * blocks))
+
+        stored = max((entry + 1 for entry in self.block_map if entry < VDI_BLOCK_ZERO), default=0)
+        if self.off_data + stored * (self.block_size + self.block_extra) > os.fstat(self._f.fileno()).st_size:
+            raise ValueError(f"{self.path} is truncated")
+
+    @staticmethod
+    def read_uuids(path):
+        """
+        Reads the UUID and the parent UUID of a VDI file without loading its block map.
+
+        :param path: path to the VDI file
+        :return: uuid, parent_uuid
+        """
+        with open(path, "rb") as f:
+            _, signature, _ = PRE_HEADER.unpack(f.read(PRE_HEADER.size))
+            if signature != VDI_SIGNATURE:
+                raise ValueError(f"{path} is not a VDI file")
+            fields = HEADER_1PLUS.unpack(f.read(HEADER_1PLUS.size))
+
+        return str(uuid.UUID(bytes_le=fields[10])), str(uuid.UUID(bytes_le=fields[12]))
+
+    def is_block_allocated(self, index):
+        """
+        Checks, if a block holds data in this image itself, i.e. it was written since the parent state.
+        """
+        return self.block_map[index] < VDI_BLOCK_ZERO
+
+    def chain(self):
+        """
+        Returns the images of the chain, starting with the base image and ending with this one.
+        """
+        return (self.parent.chain() if self.parent is not None else []) + [self]
+
+    def written_blocks(self):
+        """
+        Returns the indexes of the blocks, which this image itself defines, i.e. the ones written or discarded since
+        the parent state. Blocks marked as zero count as well, as they hide the data of the parent.
+        """
+        return [i for i, entry in enumerate(self.block_map) if entry != VDI_BLOCK_FREE]
+
+    def _resolve_block(self, index):
+        """
+        Returns the state of a block as seen through the chain: None for unallocated or zeroed blocks, otherwise the
+        image, which holds its data.
+        """
+        entry = self.block_map[index]
+
+        if entry == VDI_BLOCK_FREE and self.parent is not None:
+            return self.parent._resolve_block(index)
+        if entry >= VDI_BLOCK_ZERO:
+            return None
+
+        return self
+
+    def data_extents(self):
+        """
+        Yields the regions of the virtual disk, which are backed by allocated blocks anywhere in the chain. All other
+        regions read as zeros.
+
+        :return: generator of (start, end) byte offsets
+        """
+        start = None
+
+        for index in range(len(self.block_map)):
+            if self._resolve_block(index) is None:
+                if start is not None:
+                    yield start, min(index * self.block_size, self.size)
+                    start = None
+            elif start is None:
+                start = index * self.block_size
+
+        if start is not None:
+            yield start, self.size
+
+    def _read_block(self, index, offset, size):
+        """
+        Reads from a single block, following the chain of parents for unallocated blocks.
+        """
+        entry = self.block_map[index]
+
+        if entry == VDI_BLOCK_FREE and self.parent is not None:
+            return self.parent._read_block(index, offset, size)
+        if entry >= VDI_BLOCK_ZERO:
+            return bytes(size)
+
+        self._f.seek(self.off_data + entry * (self.block_size + self.block_extra) + self.block_extra + offset)
+        data = self._f.read(size)
+
+        if len(data) < size:
+            # A truncated file would otherwise make readinto spin forever
+            raise ValueError(f"Block {index} of {self.path} is truncated")
+
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+
+        return self._pos
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast("B")
+        n = max(0, min(len(view), self.size - self._pos))
+        done = 0
+
+        while done < n:
+            index, offset = divmod(self._pos, self.block_size)
+            chunk = self._read_block(index, offset, min(n - done, self.block_size - offset))
+            view[done:done + len(chunk)] = chunk
+            done += len(chunk)
+            self._pos += len(chunk)
+
+        return done
+
+    def close(self):
+        if self.parent is not None:
+            self.parent.close()
+        self._f.close()
+        super().close()
+
+
+class ChangedBlocks:
+    """
+    Set of blocks of a virtual disk, which changed since an earlier state.
+    """
+
+    def __init__(self, block_size, indexes):
+        self.block_size = block_size
+        self.indexes = frozenset(indexes)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    @property
+    def size(self):
+        return len(self.indexes) * self.block_size
+
+    def touches(self, start, length):
+        """
+        Checks, if a byte range of the virtual disk overlaps with a changed block.
+        """
+        if length <= 0:
+            return False
+
+        first, last = start // self.block_size, (start + length - 1) // self.block_size
+
+        if last - first < len(self.indexes):
+            return any(i in self.indexes for i in range(first, last + 1))
+
+        return any(first <= i <= last for i in self.indexes)
+
+
+def disk_state(image):
+    """
+    Describes the images of a VDI chain, so a later run can tell, which images were added, removed or modified since.
+
+    :param image: VDIImage of the leaf
+    :return: dict mapping the UUID of each image to [size, mtime_ns, written blocks], size and mtime of its file and
+    the indexes of the blocks defined by the image
+    """
+    state = {}
+
+    for img in image.chain():
+        st = os.stat(img.path)
+        state[img.uuid] = [st.st_size, st.st_mtime_ns, img.written_blocks()]
+
+    return state
+
+
+def changed_blocks_since(image, previous_state):
+    """
+    Determines the blocks of the virtual disk, which changed since the state of an earlier run. Snapshots freeze the
+    differencing images of a chain, so every block written since lives in an image, which was not part of the chain
+    back then, and every block of an image, which is no longer part of the chain, e.g. after restoring an older
+    snapshot, is reverted. If one of the images of both chains was modified, e.g. because a snapshot was deleted and
+    merged into it, its blocks may have been overwritten in place and the changes cannot be told from the block maps.
+
+    :param image: VDIImage of the leaf
+    :param previous_state: disk_state of the earlier run
+    :return: ChangedBlocks or None, if the changes cannot be determined
+    """
+    if not previous_state:
+        return None
+
+    state = disk_state(image)
+    known = [img for img in image.chain() if img.uuid in previous_state]
+
+    if not known:
+        logger.info(f"No image of the chain of {image.path} is known from the previous run")
+        return None
+
+    for img in known:
+        if state[img.uuid][:2] != previous_state[img.uuid][:2]:
+            logger.info(f"{img.path} was modified since the previous run, changed blocks are unknown")
+            return None
+
+    indexes = set()
+    for uuid_img, (_, _, written) in state.items():
+        if uuid_img not in previous_state:
+            indexes.update(written)
+    for uuid_img, (_, _, written) in previous_state.items():
+        if uuid_img not in state:
+            indexes.update(written)
+
+    return ChangedBlocks(image.block_size, indexes)
+
+
+def find_vdi_chain(leaf_path, search_dirs=()):
+    """
+    Resolves the chain of VDI files from the base image to the given leaf. Parents are looked up by UUID among the VDI
+    files in the directory of the leaf, its parent directory (VirtualBox keeps differencing images in the "Snapshots"
+    subdirectory of the VM) and the given search directories.
+
+    :param leaf_path: path to the VDI of the current state
+    :param search_dirs: additional directories to search for parent images
+    :return: list of paths, starting with the base image
+    """
+    leaf_dir = os.path.dirname(os.path.abspath(leaf_path))
+    dirs = [leaf_dir, os.path.dirname(leaf_dir)] + list(search_dirs)
+    candidates = {}
+
+    for d in dirs:
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            if name.lower().endswith(".vdi") and os.path.isfile(path):
+                try:
+                    candidates[VDIImage.read_uuids(path)[0]] = path
+                except ValueError:
+                    logger.debug(f"Skipping {path}")
+
+    chain = [leaf_path]
+
+    while True:
+        _, parent_uuid = VDIImage.read_uuids(chain[0])
+        if parent_uuid == str(uuid.UUID(int=0)):
+            break
+        if parent_uuid not in candidates:
+            raise FileNotFoundError(f"Parent {parent_uuid} of {chain[0]} not found in {dirs}")
+        chain.insert(0, candidates[parent_uuid])
+
+    return chain
+
+
+def open_vdi(leaf_path, search_dirs=()):
+    """
+    Opens the virtual disk of a VDI including all of its parents.
+
+    :param leaf_path: path to the VDI of the current state
+    :param search_dirs: additional directories to search for parent images
+    :return: VDIImage of the leaf
+    """
+    image = None
+
+    for path in find_vdi_chain(leaf_path, search_dirs):
+        image = VDIImage(path, parent=image)
+
+    logger.info(f"Opened {leaf_path} ({image.size} bytes virtual disk)")
+
+    return image
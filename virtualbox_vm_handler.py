@@ -1,7 +1,10 @@
 import re
 import subprocess
 import utils
+import sparse
 import logging
+from vdi_reader import open_vdi
+from vminfo import VMInfo
 
 logger = logging.getLogger(__name__)
 
@@ -17,36 +20,86 @@ class VMHandler:
         self.user = user
         self.password = password
         self.snap_list = []
+        self._info = None
+
+    def vm_info(self):
+        """
+        Returns the parsed showvminfo output of the VM. It is read once and cached, until the handler changes the state
+        of the VM.
+
+        :return: VMInfo
+        """
+        if self._info is None:
+            self._info = VMHandler.read_vm_info(self.uuid)
+
+        return self._info
+
+    def invalidate_vm_info(self):
+        self._info = None
 
     def start(self, type="headless"):
+        self.invalidate_vm_info()
         self.start_vm(self.uuid, type)
 
     def gen_snap(self, snap_name, desc=""):
-        self.snap_list.append(self.generate_snapshot(self.uuid, snap_name, desc))
+        self.invalidate_vm_info()
+        self.take_snapshot(self.uuid, snap_name, desc)
+        snap_uuid = VMHandler.retrieve_snapshot_uuid(self.uuid, snap_name, self.vm_info())
+        logging.info(f"Generated snapshot '{snap_name}': {snap_uuid}")
+        self.snap_list.append(snap_uuid)
 
     def del_snap(self, snap_name):
-        snap_uuid = VMHandler.retrieve_snapshot_uuid(self.uuid, snap_name)
+        snap_uuid = VMHandler.retrieve_snapshot_uuid(self.uuid, snap_name, self.vm_info())
 
         if snap_uuid in self.snap_list:
+            self.invalidate_vm_info()
             self.delete_snapshot(self.uuid, snap_name)
 
     def save(self):
+        self.invalidate_vm_info()
         self.save_state(self.uuid)
 
     def restore(self, uuid_snap):
+        self.invalidate_vm_info()
         self.restore_state(self.uuid, uuid_snap)
 
-    def dump_vm_vdi(self, file_path):
+    def dump_vm_vdi(self, file_path, is_sparse=True):
         """
         Dumps a VDI to disk and does the required work beforehand.
 
-        :param uuid_vm: UUID of VM
-        :param file_path: path to the destination VDI
+        If is_sparse is set, the raw image keeps unallocated and all-zero regions as holes. The VDI chain of the VM is
+        exported directly, which only reads allocated blocks. If it cannot be opened, VBoxManage clones the disk and
+        zero regions are turned into holes afterwards.
+
+        :param file_path: path to the destination raw image
+        :param is_sparse: boolean - defines, whether the raw image should be written as sparse file
         :return:
         """
-        uuid_hdd = VMHandler.retrieve_hdd_uuid(self.uuid, is_verbose=True)
+        if is_sparse:
+            try:
+                vdi = open_vdi(VMHandler.retrieve_hdd_path(self.uuid, self.vm_info()))
+            except (OSError, ValueError, TypeError) as e:
+                logging.info(f"Cannot read VDI of {self.uuid} directly, falling back to clonemedium: {e}")
+            else:
+                logging.info(f"Exporting HDD sparsely to {file_path}")
+                sparse.copy_sparse(vdi, file_path, vdi.size)
+                vdi.close()
+                return
+
+        uuid_hdd = VMHandler.retrieve_hdd_uuid(self.uuid, is_verbose=True, info=self.vm_info())
         VMHandler.write_raw_img(uuid_hdd, file_path)
 
+        if is_sparse:
+            sparse.dig_holes(file_path)
+
+    def locate_vm_vdi(self):
+        """
+        Locates the VDI, which holds the current state of the VM, so it can be read in place instead of being dumped.
+
+        :return: path to the VDI, a differencing image, if the VM has snapshots
+        """
+        return VMHandler.retrieve_hdd_path(self.uuid, self.vm_info())
+
     @staticmethod
     def run_basic_shell_cmd(cmd):
         """
@@ -57,25 +110,28 @@ class VMHandler:
         subprocess.run(cmd, shell=True, check=True)
 
     @staticmethod
-    def run_shell_cmd(cmd):
+    def run_shell_cmd(cmd, timeout=None):
         """
-        Takes a command and executes it with the help of Popen.
+        Takes a command and executes it with the help of Popen or the command runner set in utils.
 
         :param cmd: the command to execute in form of a list
+        :param timeout: optional timeout in seconds, after which the command is killed
         :return: rc, status code of the process
         """
 
-        return utils.run_shell_cmd(cmd)
+        return utils.run_shell_cmd(cmd, timeout)
 
     @staticmethod
-    def run_cmd_with_output(cmd):
+    def run_cmd_with_output(cmd, timeout=None):
         """
-        Takes a command and executes it with the help of Popen. The stdout will received and returned.
+        Takes a command and executes it with the help of Popen or the command runner set in utils. The stdout will
+        received and returned.
 
         :param cmd: the command to execute in form of a list
+        :param timeout: optional timeout in seconds, after which the command is killed
         :return: stdout, a string containing the contents stdout
         """
-        return utils.run_cmd_with_output(cmd)
+        return utils.run_cmd_with_output(cmd, timeout)
 
     @staticmethod
     def retrieve_vm_uuid(vm_name):
@@ -85,8 +141,8 @@ class VMHandler:
         :return: uuid_vm, string representing the UUID of the specified VM
         """
         cmd_list = ["VBoxManage", "list", "vms"]
-        result_string = VMHandler.run_cmd_with_output(cmd_list)
-        pattern = re.compile(r"\"" + vm_name + r"\"\s\{([-\w\d]*)\}", re.I | re.MULTILINE)
+        result_string = VMHandler.run_cmd_with_output(cmd_list, utils.control_timeout())
+        pattern = re.compile(r"\"" + vm_name + r"\"\s\{([_-\w\d]*)\}", re.I | re.MULTILINE)
         match = re.search(pattern, result_string)
 
         if match:
@@ -98,25 +154,31 @@ class VMHandler:
             return None
 
     @staticmethod
-    def retrieve_snapshot_uuid(uuid_vm, snap_name):
+    def read_vm_info(uuid_vm):
+        """
+        Runs showvminfo once and parses its output.
+
+        :param uuid_vm: UUID or name of the VM
+        :return: VMInfo
+        """
+        cmd = ["VBoxManage", "showvminfo", uuid_vm, "--machinereadable"]
+
+        return VMInfo.parse(VMHandler.run_cmd_with_output(cmd, utils.control_timeout()))
+
+    @staticmethod
+    def retrieve_snapshot_uuid(uuid_vm, snap_name, info=None):
         """
         Retrieves the UUID of a snapshot, which is defined by name
 
         :param uuid_vm: UUID of the VM in question
         :param snap_name: name of the snapshot
+        :param info: VMInfo of the VM, read from VBoxManage if omitted
         :return: snap_uuid, string representation of the UUID of the named snapshot
         """
+        snapshot = (info or VMHandler.read_vm_info(uuid_vm)).find_snapshot(snap_name)
 
-        cmd = ["VBoxManage", "showvminfo", uuid_vm, "--machinereadable"]
-
-        result_string = VMHandler.run_cmd_with_output(cmd)
-
-        pattern = re.compile(r"SnapshotName(-\d){?}=\"(" + snap_name + r")[]\"\nSnapshotUUID=\"([-\w\d]*)\"", re.I | re.MULTILINE)
-        match = re.search(pattern, result_string)
-
-        #print(match.groups)
-        if match:
-            snap_uuid = match.group(-1)
+        if snapshot:
+            snap_uuid = snapshot.uuid
             logging.info(f"UUID of snapshot '{snap_name}': {snap_uuid}")
             return snap_uuid
 
@@ -124,6 +186,19 @@ class VMHandler:
             logging.error(f"Snapshot UUID of '{snap_name}' could not be found.")
             return None
 
+    @staticmethod
+    def take_snapshot(uuid_vm, snap_name, description=""):
+        """
+        Takes a snapshot without looking up its UUID afterwards.
+
+        :param uuid_vm: UUID of the VM
+        :param snap_name: name for the snapshot to create
+        :param description: description of the snapshot to create
+        :return: rc, status code of VBoxManage
+        """
+        cmd = ["VBoxManage", "snapshot", uuid_vm, "take", snap_name, "--description", description]
+        return VMHandler.run_shell_cmd(cmd, utils.control_timeout())
+
     @staticmethod
     def generate_snapshot(uuid_vm, snap_name, description=""):
         """
@@ -132,10 +207,9 @@ class VMHandler:
         :param uuid_vm: UUID of the VM
         :param snap_name: name for the snapshot to create
         :param description: description of the snapshot to create
-        :return:
+        :return: snap_uuid, UUID of the new snapshot
         """
-        cmd = ["VBoxManage", "snapshot", uuid_vm, "take", snap_name, "--description", description]
-        VMHandler.run_shell_cmd(cmd)
+        VMHandler.take_snapshot(uuid_vm, snap_name, description)
 
         snap_uuid = VMHandler.retrieve_snapshot_uuid(uuid_vm, snap_name)
         logging.info(f"Generated snapshot '{snap_name}': {snap_uuid}")
@@ -154,7 +228,7 @@ class VMHandler:
         """
 
         cmd = ["VBoxManage", "snapshot", uuid_vm, "delete", snap_name]
-        VMHandler.run_shell_cmd(cmd)
+        VMHandler.run_shell_cmd(cmd, utils.control_timeout())
 
         logging.info(f"Deleted snapshot '{snap_name}'")
 
@@ -170,7 +244,7 @@ class VMHandler:
 
         # Defines command
         cmd = ["VBoxManage", "snapshot", uuid_vm, "restore", uuid_snap]
-        rc = VMHandler.run_shell_cmd(cmd)
+        rc = VMHandler.run_shell_cmd(cmd, utils.control_timeout())
         if rc:
             # Special logging, if an error occurs
             logging.error(f"Not able to restore snapshot {uuid_snap}")
@@ -185,7 +259,7 @@ class VMHandler:
 
         # Stop VM and save state
         cmd_savestate = ["VBoxManage", "controlvm", uuid_vm, "savestate"]
-        rc = VMHandler.run_shell_cmd(cmd_savestate)
+        rc = VMHandler.run_shell_cmd(cmd_savestate, utils.control_timeout())
         if rc:
             # Special logging, if an error occurs
             logging.error(f"Not able to save state {uuid_vm}")
@@ -200,37 +274,42 @@ class VMHandler:
         """
 
         cmd_start = ["VBoxManage", "startvm", uuid_vm, "--type", type]
-        VMHandler.run_shell_cmd(cmd_start)
+        VMHandler.run_shell_cmd(cmd_start, utils.control_timeout())
 
     STORAGE_CTL = ["IDE Controller", "SATA"]
 
     @staticmethod
-    def retrieve_hdd_uuid(uuid_vm, is_verbose=False):
+    def retrieve_hdd_uuid(uuid_vm, is_verbose=False, info=None):
         """
         Retrieves the UUID of the attached HDD of a VM.
 
         :param uuid_vm: UUID of the VM
         :param is_verbose: boolean - defines, wether UUID of HDD should be logged
+        :param info: VMInfo of the VM, read from VBoxManage if omitted
         """
-
-        cmd_info = ["VBoxManage", "showvminfo", uuid_vm, "--machinereadable"]
-        match = None
-        uuid_hdd = None
-        #print(f"Looking for {VMHandler.STORAGE_CTL}")
-        # Make sure to receive showvminfo output
-        for ctl in VMHandler.STORAGE_CTL:
-            result = VMHandler.run_cmd_with_output(cmd_info)
-            pt = re.compile(f"(\"{ctl}-ImageUUID-0-0\")(=)\"([-\w\d]*)\"", re.I)
-
-            match = re.search(pt, result)
-            if match:
-                uuid_hdd = match.group(3)
-                break
+        disk = (info or VMHandler.read_vm_info(uuid_vm)).find_disk(VMHandler.STORAGE_CTL)
+        uuid_hdd = disk.uuid if disk else None
 
         logging.info(f"UUID of HDD: {uuid_hdd}")
 
         return uuid_hdd
 
+    @staticmethod
+    def retrieve_hdd_path(uuid_vm, info=None):
+        """
+        Retrieves the path of the image file currently attached as HDD of a VM.
+
+        :param uuid_vm: UUID of the VM
+        :param info: VMInfo of the VM, read from VBoxManage if omitted
+        :return: path_hdd, path to the image file
+        """
+        disk = (info or VMHandler.read_vm_info(uuid_vm)).find_disk(VMHandler.STORAGE_CTL)
+        path_hdd = disk.medium if disk else None
+
+        logging.info(f"Path of HDD: {path_hdd}")
+
+        return path_hdd
+
     @staticmethod
     def write_raw_img(uuid_hdd, file_path):
         """
@@ -246,75 +325,11 @@ class VMHandler:
         Even if not existing in file system, there might be a registered hdd
         '''
         cmd_del = ["VBoxManage", "closemedium", file_path, "--delete"]
-        VMHandler.run_shell_cmd(cmd_del)
+        VMHandler.run_shell_cmd(cmd_del, utils.control_timeout())
         logging.info(f"Deleting {file_path}, if existing")
 
         # Write raw img to disk
         cmd_clone = ["VBoxManage", "clonemedium", uuid_hdd, file_path, "--format", "RAW"]
         logging.info(f"Cloning HDD to {file_path}")
+        # Takes as long as the disk is large, so it is not timed out
         VMHandler.run_shell_cmd(cmd_clone)
-
-    @staticmethod
-    def retrieve_vm_uuid(vm_name):
-        """
-        Retrieves the UUID to a string identifier of a VM
-        :param vm_name: string, name of the VM
-        :return: uuid_vm, string representing the UUID of the specified VM
-        """
-        cmd_list = ["VBoxManage", "list", "vms"]
-        result_string = VMHandler.run_cmd_with_output(cmd_list)
-        pattern = re.compile(r"\"" + vm_name + r"\"\s\{([_-\w\d]*)\}", re.I | re.MULTILINE)
-        match = re.search(pattern, result_string)
-
-        if match:
-            uuid_vm = match.group(1)
-            logging.info(f"UUID of {vm_name}: {uuid_vm}")
-            return uuid_vm
-        else:
-            logging.error(f"Could not retrieve UUID of given VM name {vm_name}")
-            return None
-
-    @staticmethod
-    def retrieve_snapshot_uuid(uuid_vm, snap_name):
-        """
-        Retrieves the UUID of a snapshot, which is defined by name
-
-        :param uuid_vm: UUID of the VM in question
-        :param snap_name: name of the snapshot
-        :return: snap_uuid, string representation of the UUID of the named snapshot
-        """
-
-        cmd = ["VBoxManage", "showvminfo", uuid_vm, "--machinereadable"]
-        result_string = VMHandler.run_cmd_with_output(cmd)
-
-        pattern = re.compile(r"SnapshotName(-\d\d?){0,}=\"(" + snap_name + r")\"\nSnapshotUUID(-\d\d?){0,}=\"([-\w\d]*)\"", re.I | re.MULTILINE)
-        match = re.search(pattern, result_string)
-
-        if match:
-            matches = match.groups()
-
-            snap_uuid = matches[-1]
-            logging.info(f"UUID of snapshot '{snap_name}': {snap_uuid}")
-            return snap_uuid
-
-        else:
-            logging.error(f"Snapshot UUID of '{snap_name}' could not be found.")
-            return None
-
-    @staticmethod
-    def generate_snapshot(uuid_vm, snap_name, description=""):
-        """
-        Generates a snapshot
-
-        :param uuid_vm: UUID of the VM
-        :param snap_name: name for the snapshot to create
-        :param description: description of the snapshot to create
-        :return:
-        """
-        cmd = ["VBoxManage", "snapshot", uuid_vm, "take", snap_name, "--description", description]
-        VMHandler.run_shell_cmd(cmd)
-
-        snap_uuid = VMHandler.retrieve_snapshot_uuid(uuid_vm, snap_name)
-        logging.info(f"Generated snapshot '{snap_name}': {snap_uuid}")
-
-        return snap_uuid
\ No newline at end of file
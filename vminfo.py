@@ -0,0 +1,229 @@
+import re
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Values of attachment slots without a medium
+NO_MEDIUM = ("none", "emptydrive")
+
+# Keys of attachment slots without the controller name, e.g. "0-0" of "SATA-0-0" or "ImageUUID-1-0"
+SLOT_PATTERN = re.compile(r"^(?:(?P<attr>[A-Za-z]+)-)?(?P<port>\d+)-(?P<device>\d+)$")
+# "SnapshotName", "SnapshotUUID-1-2"
+SNAPSHOT_PATTERN = re.compile(r"^Snapshot(?P<attr>Name|UUID|Description)(?P<node>(?:-\d+)*)$")
+
+Controller = namedtuple("Controller", ["name", "type", "instance", "port_count", "bootable"])
+Attachment = namedtuple("Attachment", ["controller", "port", "device", "medium", "uuid"])
+
+
+class Snapshot:
+    """
+    Node of the snapshot tree of a VM.
+    """
+
+    def __init__(self, node):
+        """
+        :param node: position in the tree as used in the keys of showvminfo, "" for the root, "-1-2" for the second
+        child of the first child of the root
+        """
+        self.node = node
+        self.name = None
+        self.uuid = None
+        self.description = None
+        self.parent = None
+        self.children = []
+
+    def walk(self):
+        """
+        Yields this snapshot and all of its descendants, parents before children.
+        """
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def __repr__(self):
+        return f"Snapshot({self.name!r}, {self.uuid!r})"
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        # VBoxManage escapes quotes and backslashes inside values
+        return re.sub(r'\\(.)', r'\1', value[1:-1])
+    return value
+
+
+def _is_complete(value):
+    """
+    Checks, if a value is complete or continues on the next line, which happens for multi-line descriptions.
+    """
+    if not value.startswith('"'):
+        return True
+
+    # Strip escaped characters, then the value is complete, if it has the closing quote. Some values carry text after
+    # it, e.g. VideoMode="1024,768,32"@0,0 1
+    stripped = re.sub(r'\\.', "", value[1:])
+    return '"' in stripped
+
+
+def parse_machinereadable(text):
+    """
+    Parses the output of "VBoxManage showvminfo --machinereadable" into a dict. Keys and values are unquoted, values
+    spanning several lines are joined.
+
+    :param text: output of showvminfo
+    :return: dict mapping the keys to their values, in the order of the output
+    """
+    values = {}
+    pending = None
+
+    for line in text.splitlines():
+        if pending is not None:
+            pending[1] += "\n" + line
+        else:
+            key, sep, value = line.partition("=")
+            if not sep:
+                continue
+            pending = [_unquote(key), value]
+
+        if _is_complete(pending[1]):
+            values[pending[0]] = _unquote(pending[1])
+            pending = None
+
+    if pending is not None:
+        logger.debug(f"Unterminated value of {pending[0]} in showvminfo output")
+        values[pending[0]] = pending[1].lstrip('"')
+
+    return values
+
+
+class VMInfo:
+    """
+    Structured view on the output of "VBoxManage showvminfo --machinereadable": the storage controllers, the media
+    attached to them and the snapshot tree.
+    """
+
+    def __init__(self, values):
+        """
+        :param values: dict as returned by parse_machinereadable
+        """
+        self.values = values
+        self.name = values.get("name")
+        self.uuid = values.get("UUID")
+        self.state = values.get("VMState")
+        self.controllers = self._parse_controllers(values)
+        self.attachments = self._parse_attachments(values, self.controllers)
+        self.snapshots = self._parse_snapshots(values)
+        # E.g. "SnapshotName-1-2"
+        current_node = values.get("CurrentSnapshotNode")
+        self.current_snapshot = self.snapshots.get(current_node[len("SnapshotName"):]) if current_node else None
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Creates a VMInfo from the output of showvminfo.
+        """
+        return cls(parse_machinereadable(text))
+
+    @staticmethod
+    def _parse_controllers(values):
+        controllers = []
+        i = 0
+
+        while f"storagecontrollername{i}" in values:
+            controllers.append(Controller(
+                name=values[f"storagecontrollername{i}"],
+                type=values.get(f"storagecontrollertype{i}"),
+                instance=int(values.get(f"storagecontrollerinstance{i}", 0)),
+                port_count=int(values.get(f"storagecontrollerportcount{i}", 0)),
+                bootable=values.get(f"storagecontrollerbootable{i}") == "on",
+            ))
+            i += 1
+
+        return controllers
+
+    @staticmethod
+    def _parse_attachments(values, controllers):
+        # Controller names may contain dashes themselves, so the longest matching name wins
+        names = sorted((c.name for c in controllers), key=len, reverse=True)
+        media = {}
+        uuids = {}
+
+        for key, value in values.items():
+            name = next((n for n in names if key.startswith(f"{n}-")), None)
+            match = SLOT_PATTERN.match(key[len(name) + 1:]) if name else None
+            if not match:
+                continue
+
+            slot = (name, int(match.group("port")), int(match.group("device")))
+            if match.group("attr") is None:
+                media[slot] = value
+            elif match.group("attr") == "ImageUUID":
+                uuids[slot] = value
+
+        return [Attachment(ctl, port, device, medium, uuids.get((ctl, port, device)))
+                for (ctl, port, device), medium in media.items() if medium not in NO_MEDIUM]
+
+    @staticmethod
+    def _parse_snapshots(values):
+        snapshots = {}
+
+        for key, value in values.items():
+            match = SNAPSHOT_PATTERN.match(key)
+            if not match:
+                continue
+
+            node = match.group("node")
+            snapshot = snapshots.setdefault(node, Snapshot(node))
+            setattr(snapshot, match.group("attr").lower(), value)
+
+        # Nodes are listed parents first, so every parent exists, when its children are linked
+        for node, snapshot in snapshots.items():
+            if node:
+                parent = snapshots.get(node.rsplit("-", 1)[0])
+                if parent is not None:
+                    snapshot.parent = parent
+                    parent.children.append(snapshot)
+
+        return snapshots
+
+    @property
+    def root_snapshot(self):
+        return self.snapshots.get("")
+
+    def find_snapshot(self, name):
+        """
+        Looks up a snapshot by name. Names need not be unique, the current snapshot is preferred, otherwise the first
+        one in tree order is returned.
+
+        :param name: name of the snapshot
+        :return: Snapshot or None
+        """
+        if self.current_snapshot is not None and self.current_snapshot.name == name:
+            return self.current_snapshot
+
+        if self.root_snapshot is not None:
+            for snapshot in self.root_snapshot.walk():
+                if snapshot.name == name:
+                    return snapshot
+
+        return None
+
+    def find_disk(self, controllers=None, port=0, device=0):
+        """
+        Looks up the medium attached to a slot. If several controllers are given, the first one having a medium in
+        that slot wins.
+
+        :param controllers: names of the controllers to look at in order, all controllers if omitted
+        :param port: port of the slot
+        :param device: device of the slot
+        :return: Attachment or None
+        """
+        by_slot = {(a.controller.lower(), a.port, a.device): a for a in self.attachments}
+        names = controllers if controllers is not None else [c.name for c in self.controllers]
+
+        for name in names:
+            attachment = by_slot.get((name.lower(), port, device))
+            if attachment is not None:
+                return attachment
+
+        return None
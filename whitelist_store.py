@@ -0,0 +1,435 @@
+import os
+import mmap
+import json
+import heapq
+import struct
+import logging
+import itertools
+from array import array
+
+import external_sort
+from hashlist import read_hashlist, parse_result_name, find_hashlists
+
+try:
+    import numpy as np
+except ImportError:
+    # Batch lookups fall back to sorted binary searches
+    np = None
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAGIC = b"HLWLSEG1"
+SEGMENT_HEADER = struct.Struct("<8sQ")
+# Raw MD5 digest, index into the path table, index into the source table
+RECORD = struct.Struct("<16sII")
+
+
+class Segment:
+    """
+    Memory-mapped, immutable file of fixed-width records sorted by digest. Lookups are binary searches on the mapping,
+    so only the touched pages are ever read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._digests = None
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = SEGMENT_HEADER.unpack_from(self._mm, 0)
+
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is no whitelist segment")
+
+    def close(self):
+        # Views handed out by digest_array() have to be gone, before the mapping can be closed
+        self._digests = None
+        self._mm.close()
+        self._f.close()
+
+    def __len__(self):
+        return self.count
+
+    def digest_at(self, i):
+        offset = SEGMENT_HEADER.size + i * RECORD.size
+        return self._mm[offset:offset + 16]
+
+    def record_at(self, i):
+        return RECORD.unpack_from(self._mm, SEGMENT_HEADER.size + i * RECORD.size)
+
+    def lower_bound(self, digest, lo=0):
+        """
+        Returns the index of the first record with a digest not less than the given one.
+        """
+        hi = self.count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.digest_at(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def find(self, digest):
+        """
+        Returns all records with the given raw digest.
+        """
+        i = self.lower_bound(digest)
+        records = []
+
+        while i < self.count and self.digest_at(i) == digest:
+            records.append(self.record_at(i))
+            i += 1
+
+        return records
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.record_at(i)
+
+    def digest_array(self):
+        """
+        Returns a numpy view on the digests of the mapping, no data is copied.
+        """
+        if self._digests is None:
+            records = np.frombuffer(self._mm, dtype=[("digest", "S16"), ("path_id", "<u4"), ("source_id", "<u4")],
+                                    count=self.count, offset=SEGMENT_HEADER.size)
+            self._digests = records["digest"]
+
+        return self._digests
+
+    def contains_sorted(self, digests):
+        """
+        Checks a batch of raw digests, which must be sorted ascending. With numpy the whole batch is looked up with a
+        single vectorized searchsorted, otherwise every search starts where the previous one ended.
+
+        :param digests: sorted list of raw digests
+        :return: list of booleans in the order of the input
+        """
+        if np is not None:
+            queries = np.array(digests, dtype="S16")
+            found = np.zeros(len(digests), dtype=bool)
+            if self.count:
+                known = self.digest_array()
+                idx = np.minimum(np.searchsorted(known, queries), self.count - 1)
+                found = known[idx] == queries
+            return found.tolist()
+
+        found = []
+        lo = 0
+
+        for digest in digests:
+            lo = self.lower_bound(digest, lo)
+            found.append(lo < self.count and self.digest_at(lo) == digest)
+
+        return found
+
+    @staticmethod
+    def write(path, records):
+        """
+        Writes sorted records to a new segment file. The file appears atomically under its final name.
+
+        :param path: path of the segment
+        :param records: iterable of (digest, path_id, source_id), sorted
+        :return: number of records
+        """
+        tmp_path = f"{path}.tmp"
+        count = 0
+
+        # The count is only known afterwards, so it is patched into the header
+        with open(tmp_path, "wb") as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 0))
+            for r in records:
+                f.write(RECORD.pack(*r))
+                count += 1
+            f.seek(0)
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, count))
+
+        os.replace(tmp_path, path)
+        return count
+
+
+class WhitelistStore:
+    """
+    Consolidated store of all hash lists ever produced. It consists of
+
+    - segments: memory-mapped files of fixed-width records (MD5, path ID, source ID) sorted by MD5, one per append
+    - a deduplicated path table: paths.dat holds all distinct paths, paths.idx their offsets. Paths may contain line
+      breaks, so they are only ever delimited by the offsets
+    - a table of sources (box, volume, run) and the list of segments in meta.json
+
+    Appending a run writes a single new segment, its records are sorted in runs of RUN_SIZE records, merge() combines
+    all segments into one. Lookups binary search every segment, so nothing has to be loaded into RAM.
+    """
+
+    RUN_SIZE = external_sort.RUN_SIZE
+
+    def __init__(self, store_dir):
+        """
+        Opens or creates a store
+
+        :param store_dir: directory of the store
+        """
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self._meta_path = os.path.join(store_dir, "meta.json")
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"sources": [], "segments": [], "next_segment": 1}
+
+        self.segments = [Segment(os.path.join(store_dir, name)) for name in self.meta["segments"]]
+        self._path_ids = None
+        self._path_offsets = self._load_path_offsets()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+    def __len__(self):
+        return sum(len(s) for s in self.segments)
+
+    def _save_meta(self):
+        tmp_path = f"{self._meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _load_path_offsets(self):
+        offsets = array("Q")
+        idx_path = os.path.join(self.store_dir, "paths.idx")
+
+        if os.path.exists(idx_path):
+            with open(idx_path, "rb") as f:
+                offsets.frombytes(f.read())
+
+        return offsets
+
+    def _read_paths(self, f, start, stop):
+        """
+        Reads the paths with IDs from start to stop of the path table, each one ends right before the next one starts.
+
+        :param f: paths.dat opened in binary mode
+        :return: generator of paths
+        """
+        f.seek(self._path_offsets[start])
+
+        for path_id in range(start, stop):
+            if path_id + 1 < len(self._path_offsets):
+                data = f.read(self._path_offsets[path_id + 1] - self._path_offsets[path_id])
+            else:
+                data = f.read()
+            # Strip the line break, which only keeps paths.dat readable
+            yield data[:-1].decode("utf-8", "surrogateescape")
+
+    def get_path(self, path_id):
+        """
+        Resolves a path ID through the path table.
+        """
+        with open(os.path.join(self.store_dir, "paths.dat"), "rb") as f:
+            return next(self._read_paths(f, path_id, path_id + 1))
+
+    def get_source(self, source_id):
+        """
+        Resolves a source ID.
+
+        :return: dict with box, volume and run
+        """
+        return self.meta["sources"][source_id]
+
+    def _intern_paths(self, paths):
+        """
+        Maps paths to IDs and appends unknown ones to the path table.
+
+        :param paths: iterable of paths
+        :return: generator of path IDs in the order of the input, the path table is appended to while it is consumed
+        """
+        if self._path_ids is None:
+            # Only needed for appending, so the table is loaded lazily
+            self._path_ids = {}
+            dat_path = os.path.join(self.store_dir, "paths.dat")
+            if self._path_offsets:
+                with open(dat_path, "rb") as f:
+                    for i, path in enumerate(self._read_paths(f, 0, len(self._path_offsets))):
+                        self._path_ids[path] = i
+
+        with open(os.path.join(self.store_dir, "paths.dat"), "ab") as dat, \
+                open(os.path.join(self.store_dir, "paths.idx"), "ab") as idx:
+            offset = dat.tell()
+
+            for path in paths:
+                path_id = self._path_ids.get(path)
+
+                if path_id is None:
+                    path_id = len(self._path_offsets)
+                    self._path_ids[path] = path_id
+                    self._path_offsets.append(offset)
+                    idx.write(struct.pack("<Q", offset))
+                    data = path.encode("utf-8", "surrogateescape") + b"\n"
+                    dat.write(data)
+                    offset += len(data)
+
+                yield path_id
+
+    def has_source(self, box, volume, run):
+        return {"box": box, "volume": volume, "run": run} in self.meta["sources"]
+
+    def add_records(self, records, box, volume, run):
+        """
+        Appends the records of one run of one volume as a new segment.
+
+        :param records: iterable of (md5 hex digest, path)
+        :param box: name of the box
+        :param volume: label of the volume
+        :param run: datetime label of the run
+        :return: number of records added
+        """
+        source_id = len(self.meta["sources"])
+        # Paths are interned while the records stream by, tee only buffers the record in between
+        records, paths = itertools.tee(records)
+        path_ids = self._intern_paths(p for _, p in paths)
+        # Fixed-width lines sort like the records of the segment, the path ID is zero-padded
+        lines = (f"{md5.lower()}{path_id:010d}\n" for (md5, _), path_id in zip(records, path_ids))
+        entries = ((bytes.fromhex(line[:32]), int(line[32:42]), source_id)
+                   for line in external_sort.external_sort(lines, run_size=self.RUN_SIZE, tmp_dir=self.store_dir))
+
+        name = f"seg-{self.meta['next_segment']:06d}.bin"
+        count = Segment.write(os.path.join(self.store_dir, name), entries)
+
+        self.meta["sources"].append({"box": box, "volume": volume, "run": run})
+        self.meta["segments"].append(name)
+        self.meta["next_segment"] += 1
+        self._save_meta()
+        self.segments.append(Segment(os.path.join(self.store_dir, name)))
+
+        logger.info(f"Added {count} records of {box}/{volume} ({run}) as {name}")
+
+        return count
+
+    def add_hashlist(self, hashlist_path, box=None, volume=None, run=None):
+        """
+        Appends a hash list. Box, volume and run are taken from the name of the result file, unless given.
+
+        :param hashlist_path: path to a hash list in the format of md5sum
+        :return: number of records added
+        """
+        parsed = parse_result_name(hashlist_path) or (None, None, None)
+        run = run or parsed[0] or ""
+        box = box or parsed[1] or os.path.basename(hashlist_path)
+        volume = volume or parsed[2] or ""
+
+        return self.add_records(read_hashlist(hashlist_path), box, volume, run)
+
+    def add_result_dir(self, result_dir):
+        """
+        Appends all hash lists of a result directory, which are not yet part of the store.
+
+        :param result_dir: path to the result directory
+        :return: number of hash lists added
+        """
+        added = 0
+
+        for path in find_hashlists(result_dir):
+            run, box, volume = parse_result_name(path)
+            if not self.has_source(box, volume, run):
+                self.add_hashlist(path, box, volume, run)
+                added += 1
+
+        return added
+
+    def merge(self, first_seen_only=False):
+        """
+        Merges all segments into a single one with a k-way merge, so the records are never held in memory at once.
+        Identical records are kept once, a file seen in several runs keeps one record per run, so every run containing
+        it can still be told.
+
+        :param first_seen_only: if set, records with the same digest and path are only kept once, with the provenance
+        of the first run, in which the file was seen. The store shrinks, but the later runs are lost
+        :return: number of records in the merged segment
+        """
+        if len(self.segments) < 2 and not first_seen_only:
+            return len(self)
+
+        # Digest and path, or the whole record
+        merged = self._dedup(heapq.merge(*self.segments), 2 if first_seen_only else 3)
+
+        name = f"seg-{self.meta['next_segment']:06d}.bin"
+        path = os.path.join(self.store_dir, name)
+        count = Segment.write(path, merged)
+
+        old = self.segments
+        self.segments = [Segment(path)]
+        self.meta["segments"] = [name]
+        self.meta["next_segment"] += 1
+        self._save_meta()
+
+        for segment in old:
+            segment.close()
+            os.remove(segment.path)
+
+        logger.info(f"Merged {len(old)} segments into {name} with {count} records")
+
+        return count
+
+    @staticmethod
+    def _dedup(records, width):
+        previous = None
+
+        for r in records:
+            if previous is None or r[:width] != previous[:width]:
+                yield r
+            previous = r
+
+    def find(self, md5):
+        """
+        Looks up a hex MD5 digest.
+
+        :param md5: hex digest
+        :return: list of dicts with path, box, volume and run of every record with this digest
+        """
+        digest = bytes.fromhex(md5)
+        results = []
+
+        for segment in self.segments:
+            for _, path_id, source_id in segment.find(digest):
+                results.append(dict(path=self.get_path(path_id), **self.get_source(source_id)))
+
+        return results
+
+    def contains(self, md5):
+        """
+        Checks, if a hex MD5 digest is known.
+        """
+        digest = bytes.fromhex(md5)
+
+        for segment in self.segments:
+            i = segment.lower_bound(digest)
+            if i < len(segment) and segment.digest_at(i) == digest:
+                return True
+
+        return False
+
+    def contains_batch(self, md5s):
+        """
+        Checks a batch of hex MD5 digests at once, which is much faster than calling contains() for each of them.
+
+        :param md5s: list of hex digests
+        :return: list of booleans in the order of the input
+        """
+        digests = [bytes.fromhex(md5) for md5 in md5s]
+        order = sorted(range(len(digests)), key=digests.__getitem__)
+        sorted_digests = [digests[i] for i in order]
+        found_sorted = [False] * len(digests)
+
+        for segment in self.segments:
+            for i, found in enumerate(segment.contains_sorted(sorted_digests)):
+                found_sorted[i] = found_sorted[i] or found
+
+        found = [False] * len(digests)
+        for i, j in enumerate(order):
+            found[j] = found_sorted[i]
+
+        return found